@@ -0,0 +1,91 @@
+"""Compare decompression backends on a generated multi-block .xz image
+
+Usage:
+    uv run python -m benchmarks.bench_decoders [--size-mb 256] [--block-mb 8]
+"""
+
+import argparse
+import hashlib
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from src.console import console
+from src.imaging.decoders import DECODERS, read_xz_blocks
+
+
+def _generate_image(path: Path, size: int) -> None:
+    """Write a partly compressible image: random data interleaved with zeros"""
+    chunk = 1024 * 1024
+    with open(path, "wb") as f:
+        for i in range(size // chunk):
+            f.write(
+                os.urandom(chunk // 4) + bytes(chunk - chunk // 4)
+                if i % 2
+                else bytes(chunk)
+            )
+
+
+def _compress_multi_block(source: Path, target: Path, block_size: int) -> None:
+    """Compress into independent blocks, using xz when installed"""
+    if shutil.which("xz"):
+        with open(target, "wb") as out:
+            subprocess.run(
+                ["xz", "-T0", "-1", f"--block-size={block_size}", "-c", str(source)],
+                stdout=out,
+                check=True,
+            )
+        return
+
+    # Concatenated single-block streams are still valid .xz files
+    with open(source, "rb") as f, open(target, "wb") as out:
+        while data := f.read(block_size):
+            out.write(lzma.compress(data, preset=1))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--block-mb", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pitool_bench_") as tmp:
+        image = Path(tmp) / "bench.img"
+        compressed = Path(tmp) / "bench.img.xz"
+
+        _generate_image(image, args.size_mb * 1024 * 1024)
+        expected = hashlib.sha256(image.read_bytes()).hexdigest()
+        _compress_multi_block(image, compressed, args.block_mb * 1024 * 1024)
+
+        console.print(
+            f"[cyan]{compressed.name}[/cyan]: {args.size_mb} MB, "
+            f"{len(read_xz_blocks(compressed))} blocks"
+        )
+
+        for decoder in DECODERS:
+            if not decoder.available() or not decoder.accepts(compressed):
+                continue
+
+            hasher = hashlib.sha256()
+            start = time.perf_counter()
+            for chunk in decoder.iter_chunks(compressed):
+                hasher.update(chunk)
+            elapsed = time.perf_counter() - start
+
+            status = (
+                "[green]ok[/green]"
+                if hasher.hexdigest() == expected
+                else "[red]MISMATCH[/red]"
+            )
+            console.print(
+                f"  {decoder.name:<12} {elapsed:7.2f}s "
+                f"{args.size_mb / elapsed:8.1f} MB/s  {status}"
+            )
+
+
+if __name__ == "__main__":
+    main()
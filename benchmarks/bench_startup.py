@@ -0,0 +1,84 @@
+"""Check CLI startup stays within an import time budget
+
+Runs a trivial command under ``python -X importtime`` and fails when the
+imports take longer than the budget, listing the slowest top level imports.
+
+Usage:
+    uv run python -m benchmarks.bench_startup [--budget-ms 200] [--runs 5]
+        [--command "passwd --help"]
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+from pathlib import Path
+
+from src.console import console
+
+MAIN = Path(__file__).parent.parent / "main.py"
+
+# Imported by the interpreter itself before main.py runs (site also runs the
+# .pth files of whatever else is installed), nothing pitool can change
+INTERPRETER_IMPORTS = {"site", "encodings", "_frozen_importlib_external", "io"}
+
+
+def _import_times(command: list[str]) -> dict[str, int]:
+    """Cumulative import time in microseconds per top level import"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(MAIN), *command],
+        cwd=MAIN.parent,
+        # A fixed width, so help output renders the same in every terminal
+        env={**os.environ, "COLUMNS": "80"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # Skips the "self [us] | cumulative | imported package" header too
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _self, cumulative, name = line.removeprefix("import time:").split("|")
+        # Nested imports are indented below the import that triggered them
+        if name.startswith("  ") or name.strip() in INTERPRETER_IMPORTS:
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=200.0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--command", default="passwd --help")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    command = shlex.split(args.command)
+
+    # The fastest run is the least disturbed by whatever else the machine does
+    times = min(
+        (_import_times(command) for _ in range(max(args.runs, 1))),
+        key=lambda t: sum(t.values()),
+    )
+    total_ms = sum(times.values()) / 1000
+
+    console.print(
+        f"[cyan]pitool {args.command}[/cyan]: {len(times)} top level imports, "
+        f"{total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)"
+    )
+    for name, micros in sorted(times.items(), key=lambda i: -i[1])[: args.top]:
+        console.print(f"  {micros / 1000:7.1f} ms  {name}")
+
+    if total_ms > args.budget_ms:
+        console.print(f"[red]Over budget by {total_ms - args.budget_ms:.1f} ms[/red]")
+        sys.exit(1)
+
+    console.print("[green]✓[/green] Within budget")
+
+
+if __name__ == "__main__":
+    main()
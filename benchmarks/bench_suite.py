@@ -0,0 +1,338 @@
+"""Time the provisioning hot paths and compare them against a baseline
+
+Runs offline: images are generated, downloads are served from a local HTTP
+server and flashing writes to a regular file. Every benchmark reports a rate
+(higher is better), the best of --repeat runs. Results can be written as JSON
+and are compared against a stored baseline, failing when any rate dropped by
+more than the threshold. Without a baseline the run fails too, as baselines are
+machine specific and saved locally with --save-baseline.
+
+Usage:
+    uv run python -m benchmarks.bench_suite [--size-mb 256] [--pis 1000]
+        [--repeat 3] [--only hash] [--output results.json]
+        [--baseline benchmarks/baseline.json] [--threshold 0.15]
+        [--save-baseline]
+"""
+
+import argparse
+import hashlib
+import json
+import platform
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+from rich.table import Table
+
+from benchmarks.bench_decoders import _compress_multi_block, _generate_image
+from src.config.models import PiConfig
+from src.console import console
+from src.imaging.cloudinit import render_fleet
+from src.imaging.downloader import (
+    _download_streaming,
+    _extract_image,
+    _tee_decompress,
+)
+from src.imaging.models import RaspberryPiImage
+from src.imaging.ranged import download_ranged
+from src.imaging.writer import write_image
+from src.utils import calculate_hash
+from tests.servers import range_handler
+
+DEFAULT_BASELINE = Path(__file__).parent / "baseline.json"
+DEFAULT_THRESHOLD = 0.15
+
+# Chunk digest sizes, the linear hash is computed alongside in every case
+HASH_CHUNK_SIZES = {
+    "64k": 64 * 1024,
+    "1m": 1024**2,
+    "4m": 4 * 1024**2,
+    "16m": 16 * 1024**2,
+}
+
+MB = 1024 * 1024
+
+
+@dataclass
+class Result:
+    seconds: float
+    rate: float
+    unit: str
+
+
+@dataclass
+class Workspace:
+    """Inputs shared by every benchmark, generated once per run"""
+
+    root: Path
+    image: Path
+    compressed: Path
+    sha256: str
+    url: str
+    compressed_url: str
+    pis: list[PiConfig]
+
+
+def _fleet(count: int) -> list[PiConfig]:
+    return [
+        PiConfig.from_dict(
+            {
+                "name": f"pi-{i}",
+                "hostname": f"pi-{i}",
+                "wifi": {"ssid": "bench", "password": "bench", "country_code": "DE"},
+                "user": {
+                    "name": "pi",
+                    "password": "$6$bench$hash",
+                    "ssh_public_key": "ssh-ed25519 AAAA bench",
+                },
+                "timezone": "Europe/Berlin",
+                "locale": "en_US.UTF-8",
+                "packages": ["git", "vim"],
+            }
+        )
+        for i in range(count)
+    ]
+
+
+def _timed(run: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def _bench_hash(chunk_size: int) -> Callable[[Workspace], Result]:
+    def bench(ws: Workspace) -> Result:
+        seconds = _timed(
+            lambda: calculate_hash(str(ws.image), chunk_size=chunk_size, text="hash")
+        )
+        return Result(seconds, ws.image.stat().st_size / MB / seconds, "MB/s")
+
+    return bench
+
+
+def _bench_extract(ws: Workspace) -> Result:
+    output = ws.root / "extracted.img"
+    output.unlink(missing_ok=True)
+    size = ws.image.stat().st_size
+    seconds = _timed(lambda: _extract_image(ws.compressed, size, output_path=output))
+    return Result(seconds, size / MB / seconds, "MB/s")
+
+
+def _bench_download(ws: Workspace) -> Result:
+    destination = ws.root / "downloaded.img"
+    destination.unlink(missing_ok=True)
+    seconds = _timed(lambda: download_ranged(ws.url, destination))
+    return Result(seconds, destination.stat().st_size / MB / seconds, "MB/s")
+
+
+def _bench_download_stream(ws: Workspace) -> Result:
+    """Download, decompress and hash in one pass, as `flash --stream` does"""
+    size = ws.image.stat().st_size
+    image = RaspberryPiImage(
+        name="bench",
+        description="",
+        icon="",
+        url=ws.compressed_url,
+        extract_size=size,
+        extract_sha256=ws.sha256,
+        image_download_size=ws.compressed.stat().st_size,
+        release_date="",
+        init_format="cloudinit-rpi",
+        devices=[],
+        capabilities=[],
+    )
+    destination = ws.root / "streamed.img"
+    destination.unlink(missing_ok=True)
+    seconds = _timed(lambda: _download_streaming(image, destination))
+    return Result(seconds, size / MB / seconds, "MB/s")
+
+
+def _bench_render(force: bool) -> Callable[[Workspace], Result]:
+    def bench(ws: Workspace) -> Result:
+        out_dir = ws.root / "rendered"
+        if force:
+            # Not timed: the first render also warms the template cache
+            render_fleet(ws.pis, out_dir, policy="stable", force=True)
+        seconds = _timed(
+            lambda: render_fleet(ws.pis, out_dir, policy="stable", force=force)
+        )
+        return Result(seconds, len(ws.pis) / seconds, "Pis/s")
+
+    return bench
+
+
+def _bench_flash(ws: Workspace) -> Result:
+    target = ws.root / "card.img"
+    target.unlink(missing_ok=True)
+    seconds = _timed(lambda: write_image(ws.image, str(target)))
+    return Result(seconds, ws.image.stat().st_size / MB / seconds, "MB/s")
+
+
+def _bench_flash_url(ws: Workspace) -> Result:
+    """Download, decompress and flash in one pipeline, as `flash --pipeline` does"""
+    target = ws.root / "card.img"
+    tee = ws.root / "tee.img.xz"
+    target.unlink(missing_ok=True)
+    tee.unlink(missing_ok=True)
+    hasher = hashlib.sha256()
+    seconds = _timed(
+        lambda: write_image(
+            _tee_decompress(ws.compressed_url, tee),
+            str(target),
+            on_data=hasher.update,
+        )
+    )
+    if (
+        hasher.hexdigest() != ws.sha256
+        or tee.read_bytes() != ws.compressed.read_bytes()
+    ):
+        raise RuntimeError("Pipelined flash produced a corrupt image or cache copy")
+    return Result(seconds, ws.image.stat().st_size / MB / seconds, "MB/s")
+
+
+BENCHMARKS: dict[str, Callable[[Workspace], Result]] = {
+    **{f"hash_{label}": _bench_hash(size) for label, size in HASH_CHUNK_SIZES.items()},
+    "extract_xz": _bench_extract,
+    "download_ranged": _bench_download,
+    "download_stream": _bench_download_stream,
+    "render_fleet": _bench_render(force=True),
+    "render_fleet_unchanged": _bench_render(force=False),
+    "flash_file": _bench_flash,
+    "flash_url": _bench_flash_url,
+}
+
+
+def compare(
+    results: dict[str, Result], baseline: dict[str, dict], threshold: float
+) -> list[str]:
+    """Names of benchmarks whose rate dropped more than threshold below baseline"""
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline and result.rate < baseline[name]["rate"] * (1 - threshold)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--pis", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only", action="append", help="Run benchmarks starting with this prefix"
+    )
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store the results as baseline"
+    )
+    args = parser.parse_args()
+
+    selected = {
+        name: bench
+        for name, bench in BENCHMARKS.items()
+        if not args.only or name.startswith(tuple(args.only))
+    }
+
+    try:
+        baseline = json.loads(args.baseline.read_text())["results"]
+    except FileNotFoundError:
+        baseline = {}
+        if not args.save_baseline:
+            console.print(
+                f"[yellow]No baseline at {args.baseline}, nothing to compare "
+                "against. Run with --save-baseline first.[/yellow]"
+            )
+
+    results: dict[str, Result] = {}
+
+    with tempfile.TemporaryDirectory(prefix="pitool_bench_") as tmp:
+        root = Path(tmp)
+        image = root / "bench.img"
+        compressed = root / "bench.img.xz"
+
+        with console.status("Generating inputs..."):
+            _generate_image(image, args.size_mb * MB)
+            _compress_multi_block(image, compressed, 8 * MB)
+            sha256 = calculate_hash(str(image), chunk_size=MB, text="")
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), range_handler(root))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        ws = Workspace(
+            root=root,
+            image=image,
+            compressed=compressed,
+            sha256=sha256,
+            url=f"{base_url}/{image.name}",
+            compressed_url=f"{base_url}/{compressed.name}",
+            pis=_fleet(args.pis),
+        )
+
+        try:
+            for name, bench in selected.items():
+                runs = [bench(ws) for _ in range(max(args.repeat, 1))]
+                results[name] = max(runs, key=lambda r: r.rate)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    regressions = compare(results, baseline, args.threshold)
+
+    table = Table("Benchmark", "Time", "Rate", "Baseline", "Change")
+    for name, result in results.items():
+        reference = baseline.get(name)
+        change = ""
+        if reference:
+            delta = result.rate / reference["rate"] - 1
+            color = "red" if name in regressions else "green" if delta > 0 else "dim"
+            change = f"[{color}]{delta:+.1%}[/{color}]"
+        table.add_row(
+            name,
+            f"{result.seconds:.3f}s",
+            f"{result.rate:,.1f} {result.unit}",
+            f"{reference['rate']:,.1f}" if reference else "",
+            change,
+        )
+    console.print(table)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "size_mb": args.size_mb,
+            "pis": args.pis,
+            "repeat": args.repeat,
+        },
+        "results": {name: asdict(result) for name, result in results.items()},
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        console.print(f"[green]✓[/green] Wrote {args.output}")
+
+    if args.save_baseline:
+        # Keep baseline entries of benchmarks that weren't run this time
+        report["results"] = {**baseline, **report["results"]}
+        args.baseline.write_text(json.dumps(report, indent=2))
+        console.print(f"[green]✓[/green] Saved baseline {args.baseline}")
+    elif regressions:
+        console.print(
+            f"[red]{len(regressions)} benchmark(s) regressed by more than "
+            f"{args.threshold:.0%}: {', '.join(regressions)}[/red]"
+        )
+        sys.exit(1)
+    elif not baseline:
+        # A comparison against nothing mustn't pass as no regressions
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,62 @@
-from pathlib import Path
+import importlib
 
 import typer
+from typer.core import TyperGroup
 
-from src.config.loader import load_config
-from src.config.passwd import generate_hashed_password
-from src.console import console
-from src.imaging.cloudinit import generate_cloudinit_files
-from src.imaging.downloader import (
-    clear_download_cache,
-    download_image,
-    fetch_image_list,
-    prompt_for_image,
-)
-from src.imaging.flasher import flash_device, list_devices, prompt_for_device
-from src.networking.connect import connect_to_pi, download_from_pi, wait_for_pi
-from src.platform import get_platform_handler
+# Command name -> module in src.commands defining it. Modules are only
+# imported when their command runs, so e.g. `pitool passwd` doesn't pay for
+# requests, jinja2 or the platform handlers.
+COMMANDS = {
+    "flash": "flash",
+    "bake": "flash",
+    "render": "render",
+    "passwd": "passwd",
+    "connect": "fleet",
+    "wait": "fleet",
+    "exec": "fleet",
+    "trust": "trust",
+    "cache": "cache",
+}
 
-app = typer.Typer()
 
+class LazyGroup(TyperGroup):
+    """Click group importing a command's module on first use"""
 
-@app.command("flash")
-def flash(clear_cache: bool = False):
-    """Flash a configured Raspberry Pi image"""
+    def list_commands(self, ctx: typer.Context) -> list[str]:
+        return [*super().list_commands(ctx), *COMMANDS]
 
-    if clear_cache:
-        clear_download_cache()
+    def get_command(self, ctx: typer.Context, cmd_name: str):
+        if cmd_name not in COMMANDS:
+            return super().get_command(ctx, cmd_name)
 
-    # Gather the configuration
-    # TODO: enable multiple pis
-    pi_config = load_config()
+        module = importlib.import_module(f"src.commands.{COMMANDS[cmd_name]}")
+        return typer.main.get_group(module.app).commands[cmd_name]
 
-    # download image
-    images = fetch_image_list()
-    selected_image = prompt_for_image(images)
-    download_path = download_image(selected_image)
 
-    # flash device
-    devices = list_devices()
-    selected_device = prompt_for_device(devices)
-    flash_device(download_path, selected_device)
+app = typer.Typer(cls=LazyGroup)
 
-    # generate boot partition cloud-init files
-    platform = get_platform_handler()
-    mount_partition = platform.mount_boot_partition(selected_device.node)
-    generate_cloudinit_files(pi_config.raspberry_pis[0], Path(mount_partition))
 
-    # finish
-    platform.unmount_and_eject(selected_device.node)
-
-
-@app.command("passwd")
-def passwd():
-    generate_hashed_password()
-
-
-@app.command("connect")
-def connect():
-    """Wait for Pi to come online and connect via SSH"""
-    pi_config = load_config()
-    pi = pi_config.raspberry_pis[0]
-
-    wait_for_pi(pi.hostname)
-    connect_to_pi(pi.user.name, pi.hostname)
+@app.callback()
+def cli(
+    progress: str = typer.Option(
+        "rich",
+        envvar="PITOOL_PROGRESS",
+        help="Progress output: rich bars, json (one event per line) or none",
+    ),
+):
+    """Provision your Raspberry Pis from the command line"""
+    from src.progress import set_mode
 
+    try:
+        set_mode(progress)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from None
 
-@app.command("trust")
-def trust():
-    """Download and trust Pi's mkcert root CA certificate"""
+    if progress == "json":
+        from src.console import console
 
-    try:
-        pi_config = load_config()
-        pi = pi_config.raspberry_pis[0]
-
-        wait_for_pi(pi.hostname)
-        with download_from_pi(
-            pi.user.name,
-            pi.hostname,
-            "~/.local/share/mkcert/rootCA.pem",
-        ) as cert_path:
-            platform = get_platform_handler()
-            platform.trust_certificate(cert_path)
-
-        console.print("\n[green]✓ Certificate trusted successfully![/green]")
-        console.print("[dim]Restart your browser to see changes[/dim]")
-
-    except Exception as e:
-        console.print(f"[red]Error: {e}[/red]")
-        raise typer.Exit(1) from None
+        # Keep stdout for the events, messages and tables go to stderr
+        console.stderr = True
 
 
 def main():
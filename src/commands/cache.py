@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import typer
+from rich.table import Table
+
+from src.console import console
+from src.imaging import cache
+
+app = typer.Typer()
+cache_app = typer.Typer(help="Manage cached OS images")
+app.add_typer(cache_app, name="cache")
+
+
+@cache_app.callback()
+def cache_callback():
+    """Manage cached OS images"""
+    cache.migrate_legacy_files()
+
+
+@cache_app.command("ls")
+def cache_ls():
+    """List cached images, least recently used first"""
+
+    entries = sorted(cache.load_manifest().values(), key=lambda e: e.last_used)
+
+    table = Table("SHA256", "Image", "Base", "Size", "Last used", "Verified", "Pinned")
+    for entry in entries:
+        table.add_row(
+            entry.sha256[:12],
+            entry.filename,
+            entry.base[:12],
+            f"{entry.size / (1024**2):.1f} MB",
+            datetime.fromtimestamp(entry.last_used).strftime("%Y-%m-%d %H:%M"),
+            "✓" if entry.verified else "",
+            "📌" if entry.pinned else "",
+        )
+
+    console.print(table)
+    console.print(
+        f"[dim]{sum(e.size for e in entries) / (1024**3):.1f} GB used of "
+        f"{cache.max_cache_size() / (1024**3):.1f} GB "
+        f"(set {cache.MAX_SIZE_ENV} to change)[/dim]"
+    )
+
+
+@cache_app.command("prune")
+def cache_prune(
+    max_size: str = typer.Option(
+        None, help="Size cap such as 20G, defaults to the configured cap"
+    ),
+):
+    """Evict least recently used unpinned images until under the size cap"""
+
+    try:
+        limit = cache.parse_size(max_size) if max_size else cache.max_cache_size()
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from None
+
+    evicted = cache.evict(limit)
+    for entry in evicted:
+        console.print(f"[yellow]Evicted[/yellow] {entry.filename}")
+
+    console.print(f"[green]✓[/green] Pruned {len(evicted)} image(s)")
+
+
+@cache_app.command("pin")
+def cache_pin(
+    image: str = typer.Argument(help="SHA256 prefix or image filename"),
+    unpin: bool = False,
+):
+    """Protect a cached image from eviction"""
+
+    try:
+        entry = cache.set_pinned(image, not unpin)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from None
+
+    state = "Unpinned" if unpin else "Pinned"
+    console.print(f"[green]✓[/green] {state} {entry.filename}")
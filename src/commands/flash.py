@@ -0,0 +1,275 @@
+from collections.abc import Callable
+from pathlib import Path
+
+import typer
+from rich.table import Table
+
+from src.config.loader import load_config
+from src.config.models import PiConfig
+from src.console import console
+from src.imaging import cache
+from src.imaging.bake import bake_variant
+from src.imaging.cloudinit import render_cloudinit_files
+from src.imaging.decoders import is_compressed
+from src.imaging.downloader import (
+    clear_download_cache,
+    download_image,
+    fetch_image_list,
+    open_image_stream,
+    prompt_for_image,
+)
+from src.imaging.flasher import (
+    flash_device,
+    flash_devices,
+    flash_stream,
+    list_devices,
+    prompt_for_device,
+    prompt_for_devices,
+)
+from src.imaging.models import RaspberryPiImage
+from src.imaging.ranged import DEFAULT_CONNECTIONS
+from src.imaging.writer import TargetsFailedError
+from src.platform import FSYNC_ENV, get_platform_handler, set_fsync_policy
+from src.platform.models import ExternalDevice
+
+app = typer.Typer()
+
+
+@app.command("flash")
+def flash(
+    clear_cache: bool = False,
+    stream: bool = False,
+    connections: int = DEFAULT_CONNECTIONS,
+    bmap: bool = False,
+    verify: bool = False,
+    offline: bool = typer.Option(
+        False, help="Only use the cached image list and cached images"
+    ),
+    all_pis: bool = typer.Option(
+        False, "--all", help="Flash one device per configured Pi at once"
+    ),
+    bake: bool = typer.Option(
+        False, help="Flash a pre-baked image per Pi instead of writing cloud-init after"
+    ),
+    compressed: bool = typer.Option(
+        False, help="Keep only the compressed image cached, decompress while flashing"
+    ),
+    pipeline: bool = typer.Option(
+        False, help="Flash while downloading, caching the compressed image on the way"
+    ),
+    fsync: str = typer.Option(
+        "end",
+        envvar=FSYNC_ENV,
+        help="When cards are synced on Linux: at the end, at intervals or never",
+    ),
+):
+    """Flash a configured Raspberry Pi image"""
+
+    try:
+        set_fsync_policy(fsync)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from None
+
+    for name, enabled in (("--compressed", compressed), ("--pipeline", pipeline)):
+        if enabled and (bake or bmap or stream):
+            raise typer.BadParameter(
+                f"{name} can't be combined with --bake, --bmap or --stream"
+            )
+
+    if clear_cache:
+        clear_download_cache()
+
+    # Gather the configuration
+    pi_config = load_config()
+
+    selected_image = _select_image(offline)
+
+    # Images not cached yet are flashed as they download
+    if pipeline and not cache.contains(selected_image.extract_sha256):
+        _flash_while_downloading(
+            selected_image, pi_config.raspberry_pis, all_pis, verify
+        )
+        return
+
+    # download image
+    download_path = download_image(
+        selected_image,
+        stream=stream,
+        connections=connections,
+        compressed=compressed or pipeline,
+    )
+    base_sha256 = selected_image.extract_sha256 if bake else None
+    # Set when flashing from the compressed image, which is checked on the fly
+    sha256 = selected_image.extract_sha256 if is_compressed(download_path) else None
+
+    if all_pis:
+        _flash_all(download_path, pi_config.raspberry_pis, verify, base_sha256, sha256)
+        return
+
+    # flash device
+    pi = pi_config.raspberry_pis[0]
+    devices = list_devices()
+    selected_device = prompt_for_device(devices)
+    platform = get_platform_handler()
+
+    if base_sha256:
+        variant_path = bake_variant(download_path, base_sha256, pi)
+        if not flash_device(variant_path, selected_device, bmap=bmap, verify=verify):
+            return
+    else:
+        if not flash_device(
+            download_path, selected_device, bmap=bmap, verify=verify, sha256=sha256
+        ):
+            return
+
+        # generate boot partition cloud-init files
+        platform.write_boot_files(selected_device.node, render_cloudinit_files(pi))
+
+    # finish
+    platform.unmount_and_eject(selected_device.node)
+
+
+def _select_image(offline: bool) -> RaspberryPiImage:
+    images = fetch_image_list(offline=offline)
+    if offline:
+        images = [i for i in images if cache.contains(i.extract_sha256)]
+        if not images:
+            raise typer.BadParameter("No cached images available offline")
+    return prompt_for_image(images)
+
+
+def _select_and_download(
+    offline: bool, stream: bool, connections: int
+) -> tuple[RaspberryPiImage, Path]:
+    selected_image = _select_image(offline)
+    download_path = download_image(
+        selected_image, stream=stream, connections=connections
+    )
+    return selected_image, download_path
+
+
+def _flash_while_downloading(
+    image: RaspberryPiImage, pis: list[PiConfig], all_pis: bool, verify: bool
+):
+    """Download, decompress and flash in one pipeline, teeing into the cache
+
+    If the image doesn't match its SHA256 at the end, neither the cards nor
+    the cached copy are used: no cloud-init is written and nothing is cached.
+    """
+
+    devices = list_devices()
+    if all_pis:
+        selected_devices = prompt_for_devices(devices, limit=len(pis))
+    else:
+        selected_devices = [prompt_for_device(devices)]
+    assignments = list(zip(pis, selected_devices, strict=False))
+
+    for pi, device in assignments:
+        console.print(f"  [cyan]{device.node}[/cyan] → {pi.name} ({pi.hostname})")
+
+    with open_image_stream(image) as image_stream:
+        failures = _flash_cards(
+            lambda: flash_stream(
+                image_stream, selected_devices, verify, sha256=image.extract_sha256
+            )
+        )
+
+    if failures is not None:
+        _finish_cards(assignments, failures)
+
+
+def _flash_cards(flash: Callable[[], bool]) -> dict[str, str] | None:
+    """Run flash, returning the reason per card that failed, None if cancelled"""
+    try:
+        return {} if flash() else None
+    except TargetsFailedError as e:
+        return e.failures
+
+
+def _finish_cards(
+    assignments: list[tuple[PiConfig, ExternalDevice]], failures: dict[str, str]
+):
+    """Write cloud-init to and eject the cards that flashed, then report the rest"""
+    platform = get_platform_handler()
+    for pi, device in assignments:
+        if device.node in failures:
+            continue
+        platform.write_boot_files(device.node, render_cloudinit_files(pi))
+        platform.unmount_and_eject(device.node)
+
+    if failures:
+        raise TargetsFailedError(failures)
+
+
+def _flash_all(
+    download_path: Path,
+    pis: list[PiConfig],
+    verify: bool = False,
+    base_sha256: str | None = None,
+    sha256: str | None = None,
+):
+    """Flash several devices at once, assigning Pis in config order"""
+
+    devices = list_devices()
+    selected_devices = prompt_for_devices(devices, limit=len(pis))
+    assignments = list(zip(pis, selected_devices, strict=False))
+
+    for pi, device in assignments:
+        console.print(f"  [cyan]{device.node}[/cyan] → {pi.name} ({pi.hostname})")
+
+    platform = get_platform_handler()
+
+    if base_sha256:
+        # Every card gets its own image, so they are written one after another
+        failures: dict[str, str] = {}
+        for pi, device in assignments:
+            variant_path = bake_variant(download_path, base_sha256, pi)
+            try:
+                if not flash_device(variant_path, device, verify=verify):
+                    # Declining one card cancels the cards after it too
+                    break
+            except RuntimeError as e:
+                failures[device.node] = str(e)
+                continue
+            platform.unmount_and_eject(device.node)
+        if failures:
+            raise TargetsFailedError(failures)
+        return
+
+    failures = _flash_cards(
+        lambda: flash_devices(
+            download_path, selected_devices, verify=verify, sha256=sha256
+        )
+    )
+    if failures is None:
+        return
+
+    # generate boot partition cloud-init files per device
+    _finish_cards(assignments, failures)
+
+
+@app.command("bake")
+def bake(
+    stream: bool = False,
+    connections: int = DEFAULT_CONNECTIONS,
+    offline: bool = typer.Option(
+        False, help="Only use the cached image list and cached images"
+    ),
+):
+    """Pre-bake a cached image per configured Pi with cloud-init written in"""
+
+    pi_config = load_config()
+    selected_image, download_path = _select_and_download(offline, stream, connections)
+
+    table = Table("Pi", "Hostname", "Variant", "Image")
+    # Variants baked earlier in the run must survive the later ones' eviction
+    batch: set[str] = set()
+    for pi in pi_config.raspberry_pis:
+        with console.status(f"Baking {pi.name}..."):
+            variant_path = bake_variant(
+                download_path, selected_image.extract_sha256, pi, batch
+            )
+        table.add_row(pi.name, pi.hostname, variant_path.stem[:12], str(variant_path))
+
+    console.print(table)
+    console.print("[green]✓[/green] Flash them with `pitool flash --bake`")
@@ -0,0 +1,81 @@
+import asyncio
+
+import typer
+from rich.markup import escape
+from rich.table import Table
+
+from src.config.loader import load_config
+from src.config.models import PiConfig
+from src.console import console
+from src.networking.connect import connect_to_pi, wait_for_pi, wait_for_pis
+from src.networking.readiness import DEFAULT_TIMEOUT
+from src.networking.ssh import DEFAULT_CONCURRENCY, run_fleet
+
+app = typer.Typer()
+
+
+@app.command("connect")
+def connect():
+    """Wait for Pi to come online and connect via SSH"""
+    pi_config = load_config()
+    pi = pi_config.raspberry_pis[0]
+
+    wait_for_pi(pi.hostname)
+    connect_to_pi(pi.user.name, pi.hostname)
+
+
+@app.command("wait")
+def wait(
+    timeout: float = typer.Option(DEFAULT_TIMEOUT, help="Seconds to wait per Pi"),
+):
+    """Wait for every configured Pi to accept SSH connections"""
+    pi_config = load_config()
+
+    results = wait_for_pis(
+        [pi.hostname for pi in pi_config.raspberry_pis], timeout=timeout
+    )
+
+    offline = [result.host for result in results if not result.online]
+    if offline:
+        console.print(f"[red]{len(offline)} Pi(s) did not come online[/red]")
+        raise typer.Exit(1)
+
+    console.print(f"[green]✓[/green] All {len(results)} Pi(s) online")
+
+
+@app.command("exec")
+def exec_command(
+    command: str = typer.Argument(help="Shell command to run on every Pi"),
+    concurrency: int = typer.Option(
+        DEFAULT_CONCURRENCY, help="Maximum number of Pis running at once"
+    ),
+):
+    """Run a command on every configured Pi over SSH"""
+    pi_config = load_config()
+    pis = pi_config.raspberry_pis
+    width = max(len(pi.name) for pi in pis)
+
+    def print_line(pi: PiConfig, stream: str, line: str) -> None:
+        color = "red" if stream == "stderr" else "cyan"
+        console.print(
+            f"[{color}]{pi.name:<{width}}[/{color}] │ {escape(line)}", highlight=False
+        )
+
+    results = asyncio.run(run_fleet(pis, command, print_line, concurrency))
+
+    table = Table("Pi", "Host", "Exit", "Time")
+    for result in results:
+        status = (
+            "[green]0[/green]"
+            if result.returncode == 0
+            else f"[red]{result.returncode}[/red]"
+        )
+        table.add_row(
+            result.pi.name, result.pi.hostname, status, f"{result.elapsed:.1f}s"
+        )
+    console.print(table)
+
+    failed = sum(result.returncode != 0 for result in results)
+    if failed:
+        console.print(f"[red]{failed} of {len(results)} Pi(s) failed[/red]")
+        raise typer.Exit(1)
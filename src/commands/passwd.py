@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import typer
+
+from src.config.passwd import (
+    DEFAULT_ROUNDS,
+    generate_hashed_password,
+    hash_passwords_batch,
+)
+from src.console import console
+
+app = typer.Typer()
+
+
+@app.command("passwd")
+def passwd(
+    rounds: int = typer.Option(DEFAULT_ROUNDS, help="SHA-512-crypt rounds"),
+    batch: str = typer.Option(
+        None,
+        help="File of name:password lines (- for stdin) to hash into pitool.yml",
+    ),
+):
+    """Generate a password hash, or hash many straight into pitool.yml"""
+    if batch is None:
+        generate_hashed_password(rounds=rounds)
+        return
+
+    try:
+        updated = hash_passwords_batch(batch, Path.cwd() / "pitool.yml", rounds)
+    except (OSError, ValueError) as e:
+        raise typer.BadParameter(str(e)) from None
+
+    console.print(f"[green]✓[/green] Set password for {len(updated)} Pi(s)")
@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import typer
+
+from src.config.loader import load_config
+from src.console import console
+from src.imaging.cloudinit import (
+    INSTANCE_ID_POLICIES,
+    output_dir_name,
+    render_fleet,
+)
+
+app = typer.Typer()
+
+
+@app.command("render")
+def render(
+    out: str = typer.Option(..., help="Directory to write one bundle per Pi into"),
+    instance_id: str = typer.Option(
+        "random",
+        help=f"instance_id suffix policy: {', '.join(INSTANCE_ID_POLICIES)}",
+    ),
+    force: bool = typer.Option(False, help="Re-render Pis whose inputs are unchanged"),
+):
+    """Render cloud-init files for every configured Pi"""
+
+    pi_config = load_config()
+    out_dir = Path(out)
+
+    try:
+        rendered, skipped = render_fleet(
+            pi_config.raspberry_pis, out_dir, policy=instance_id, force=force
+        )
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from None
+
+    for pi in rendered:
+        console.print(
+            f"[green]✓[/green] {pi.name} → {out_dir / output_dir_name(pi.name)}"
+        )
+
+    console.print(
+        f"[green]✓[/green] Rendered {len(rendered)} Pi(s), {len(skipped)} unchanged"
+    )
@@ -0,0 +1,81 @@
+import asyncio
+
+import typer
+
+from src.config.loader import load_config
+from src.console import console
+from src.networking.certs import (
+    ROOT_CA_PATH,
+    group_by_content,
+    load_trusted,
+    mark_trusted,
+)
+from src.networking.connect import wait_for_pis
+from src.networking.fetch import fetch_fleet
+from src.platform import get_platform_handler
+
+app = typer.Typer()
+
+
+@app.command("trust")
+def trust(
+    force: bool = typer.Option(False, help="Trust certificates even if seen before"),
+):
+    """Download and trust every Pi's mkcert root CA certificate"""
+
+    try:
+        pi_config = load_config()
+        pis = pi_config.raspberry_pis
+
+        online = {
+            result.host
+            for result in wait_for_pis([pi.hostname for pi in pis])
+            if result.online
+        }
+        for pi in pis:
+            if pi.hostname not in online:
+                console.print(f"[red]✗[/red] {pi.name}: offline")
+        pis = [pi for pi in pis if pi.hostname in online]
+
+        with console.status("[cyan]Fetching root CA certificates...[/cyan]"):
+            results = asyncio.run(fetch_fleet(pis, [ROOT_CA_PATH]))
+
+        certificates = {}
+        for result in results:
+            if result.error:
+                console.print(f"[red]✗[/red] {result.pi.name}: {result.error}")
+            elif ROOT_CA_PATH not in result.files:
+                console.print(f"[yellow]![/yellow] {result.pi.name}: no root CA")
+            else:
+                certificates[result.pi.name] = result.files[ROOT_CA_PATH]
+
+        trusted = set() if force else load_trusted()
+        platform = get_platform_handler()
+        installed = 0
+
+        for digest, (cert_path, names) in group_by_content(certificates).items():
+            label = f"{digest[:12]} ({', '.join(names)})"
+            # Trust may have been removed since, only skip what's still trusted
+            if digest in trusted and platform.is_certificate_trusted(str(cert_path)):
+                console.print(f"[dim]Already trusted {label}[/dim]")
+                continue
+
+            console.print(f"[cyan]Trusting {label}[/cyan]")
+            platform.trust_certificate(str(cert_path))
+            mark_trusted(digest)
+            installed += 1
+
+        if installed:
+            console.print("\n[green]✓ Certificate trusted successfully![/green]")
+            console.print("[dim]Restart your browser to see changes[/dim]")
+        else:
+            console.print("\n[green]✓ Nothing new to trust[/green]")
+
+        if len(certificates) < len(pi_config.raspberry_pis):
+            raise typer.Exit(1)
+
+    except typer.Exit:
+        raise
+    except Exception as e:
+        console.print(f"[red]Error: {e}[/red]")
+        raise typer.Exit(1) from None
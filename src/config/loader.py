@@ -1,17 +1,388 @@
+"""Fleet config loading
+
+A config file may contain:
+
+- ``include:`` other config files (relative to the including file) whose
+  defaults, groups and Pis are merged in before its own
+- ``defaults:`` settings every Pi inherits
+- ``groups:`` named sets of settings a Pi opts into with ``group:``
+- ``raspberry_pis:`` the Pis, each deep-merged over defaults and its group
+
+Everything is validated up front and every problem is reported at once with
+the file and the field it concerns. The parsed config is cached keyed by the
+mtime of every file involved, falling back to their content hash, so
+unchanged configs aren't parsed again. The cache is also keyed by the source
+of this package, so a pitool update never loads configs pickled by the
+previous version.
+"""
+
+import hashlib
+import pickle
+import re
+from dataclasses import dataclass, field
+from functools import cache
 from pathlib import Path
+from typing import Any
 
 import typer
 import yaml
 
-from .models import PiToolConfig
+from src.imaging.cache import CACHE_DIR
+
+from .models import PiConfig, PiToolConfig
+
+# The C loader is several times faster, fall back when libyaml is missing
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+CONFIG_CACHE_DIR = CACHE_DIR / "config"
+CACHE_VERSION = 1
+
+TOP_LEVEL_KEYS = {"include", "defaults", "groups", "raspberry_pis"}
+
+HOSTNAME_PATTERN = re.compile(r"^(?!-)[A-Za-z0-9-]{1,63}(?<!-)$")
+COUNTRY_CODE_PATTERN = re.compile(r"^[A-Z]{2}$")
+
+# field: (type or nested schema, required)
+PI_SCHEMA: dict[str, tuple[Any, bool]] = {
+    "name": (str, True),
+    "hostname": (str, True),
+    "group": (str, False),
+    "wifi": (
+        {
+            "ssid": (str, True),
+            "password": (str, True),
+            "country_code": (str, True),
+        },
+        True,
+    ),
+    "user": (
+        {
+            "name": (str, True),
+            "password": (str, True),
+            "ssh_public_key": (str, True),
+        },
+        True,
+    ),
+    "timezone": (str, True),
+    "locale": (str, True),
+    "update": (bool, False),
+    "upgrade": (bool, False),
+    "packages": (list, False),
+    "reboot": (bool, False),
+}
+
+
+class ConfigError(ValueError):
+    """Invalid config, with one message per problem"""
+
+    def __init__(self, errors: list[str]):
+        self.errors = errors
+        super().__init__("\n".join(errors))
+
+
+@dataclass
+class _Document:
+    defaults: dict = field(default_factory=dict)
+    groups: dict[str, dict] = field(default_factory=dict)
+    # (raw Pi, file it's defined in, index in that file's raspberry_pis)
+    pis: list[tuple[dict, Path, int]] = field(default_factory=list)
+    files: list[Path] = field(default_factory=list)
+
+
+def deep_merge(base: dict, override: dict) -> dict:
+    """Merge override into a copy of base, recursing into nested mappings"""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _type_name(value: Any) -> str:
+    return "null" if value is None else type(value).__name__
+
+
+def _validate(
+    data: dict, schema: dict[str, tuple[Any, bool]], where: str, errors: list[str]
+) -> None:
+    for key in data:
+        if key not in schema:
+            errors.append(f"{where}.{key}: unknown field")
+
+    for key, (expected, required) in schema.items():
+        if key not in data:
+            if required:
+                errors.append(f"{where}.{key}: required")
+            continue
+
+        value = data[key]
+        if isinstance(expected, dict):
+            if isinstance(value, dict):
+                _validate(value, expected, f"{where}.{key}", errors)
+            else:
+                errors.append(
+                    f"{where}.{key}: expected a mapping, got {_type_name(value)}"
+                )
+        elif expected is list:
+            if value is not None and (
+                not isinstance(value, list)
+                or not all(isinstance(item, str) for item in value)
+            ):
+                errors.append(f"{where}.{key}: expected a list of strings")
+        elif not isinstance(value, expected):
+            hint = " (quote it)" if expected is str and value is not None else ""
+            errors.append(
+                f"{where}.{key}: expected {expected.__name__}, "
+                f"got {_type_name(value)}{hint}"
+            )
+
+
+def _validate_values(pi: dict, where: str, errors: list[str]) -> None:
+    hostname = pi.get("hostname")
+    if isinstance(hostname, str) and not HOSTNAME_PATTERN.match(hostname):
+        errors.append(f"{where}.hostname: invalid hostname {hostname!r}")
+
+    country_code = (pi.get("wifi") or {}).get("country_code")
+    if isinstance(country_code, str) and not COUNTRY_CODE_PATTERN.match(country_code):
+        errors.append(
+            f"{where}.wifi.country_code: expected two upper case letters, "
+            f"got {country_code!r}"
+        )
+
+
+def _read_document(
+    path: Path, errors: list[str], stack: tuple[Path, ...] = ()
+) -> _Document:
+    document = _Document(files=[path])
+
+    if path in stack:
+        chain = " -> ".join(p.name for p in (*stack, path))
+        errors.append(f"{stack[-1].name}: include cycle ({chain})")
+        return document
+
+    try:
+        data = yaml.load(path.read_text(), Loader=Loader)
+    except FileNotFoundError:
+        where = f"{stack[-1].name}: include" if stack else "config"
+        errors.append(f"{where}: file not found: {path}")
+        return document
+    except yaml.YAMLError as e:
+        errors.append(f"{path.name}: invalid YAML: {e}")
+        return document
+
+    if data is None:
+        return document
+    if not isinstance(data, dict):
+        errors.append(f"{path.name}: expected a mapping at the top level")
+        return document
+
+    for key in data:
+        if key not in TOP_LEVEL_KEYS:
+            errors.append(f"{path.name}: {key}: unknown top level key")
+
+    includes = data.get("include") or []
+    if isinstance(includes, str):
+        includes = [includes]
+    if not isinstance(includes, list):
+        errors.append(f"{path.name}: include: expected a path or a list of paths")
+        includes = []
+
+    for include in includes:
+        included = _read_document(
+            (path.parent / str(include)).resolve(), errors, (*stack, path)
+        )
+        document.defaults = deep_merge(document.defaults, included.defaults)
+        for name, group in included.groups.items():
+            document.groups[name] = deep_merge(document.groups.get(name, {}), group)
+        document.pis += included.pis
+        document.files += included.files
+
+    defaults = data.get("defaults") or {}
+    if isinstance(defaults, dict):
+        document.defaults = deep_merge(document.defaults, defaults)
+    else:
+        errors.append(f"{path.name}: defaults: expected a mapping")
+
+    groups = data.get("groups") or {}
+    if isinstance(groups, dict):
+        for name, group in groups.items():
+            if isinstance(group, dict):
+                document.groups[name] = deep_merge(document.groups.get(name, {}), group)
+            else:
+                errors.append(f"{path.name}: groups.{name}: expected a mapping")
+    else:
+        errors.append(f"{path.name}: groups: expected a mapping")
+
+    pis = data.get("raspberry_pis") or []
+    if isinstance(pis, list):
+        document.pis += [(pi, path, index) for index, pi in enumerate(pis)]
+    else:
+        errors.append(f"{path.name}: raspberry_pis: expected a list")
+
+    return document
+
+
+Sources = dict[str, tuple[Path, int]]
+
+
+def _parse(config_path: Path) -> tuple[PiToolConfig, Sources, list[Path]]:
+    errors: list[str] = []
+    document = _read_document(config_path, errors)
+
+    if not document.pis and not errors:
+        errors.append(f"{config_path.name}: raspberry_pis: at least one Pi is required")
+
+    pis = []
+    sources: Sources = {}
+    hostnames: dict[str, str] = {}
+
+    for raw, path, index in document.pis:
+        where = f"{path.name}: raspberry_pis[{index}]"
+        if not isinstance(raw, dict):
+            errors.append(f"{where}: expected a mapping")
+            continue
+        if isinstance(raw.get("name"), str):
+            where += f" ({raw['name']})"
+
+        group_name = raw.get("group")
+        group = {}
+        if group_name is not None:
+            if group_name not in document.groups:
+                errors.append(f"{where}.group: unknown group {group_name!r}")
+            else:
+                group = document.groups[group_name]
+
+        merged = deep_merge(deep_merge(document.defaults, group), raw)
+
+        pi_errors: list[str] = []
+        _validate(merged, PI_SCHEMA, where, pi_errors)
+        _validate_values(merged, where, pi_errors)
+        errors += pi_errors
+        if pi_errors:
+            continue
+
+        name, hostname = merged["name"], merged["hostname"]
+        if name in sources:
+            errors.append(f"{where}.name: duplicate Pi name {name!r}")
+            continue
+        if hostname.lower() in hostnames:
+            errors.append(
+                f"{where}.hostname: {hostname!r} is already used by "
+                f"{hostnames[hostname.lower()]!r}"
+            )
+            continue
+
+        merged.pop("group", None)
+        pis.append(PiConfig.from_dict(merged))
+        sources[name] = (path, index)
+        hostnames[hostname.lower()] = name
+
+    if errors:
+        raise ConfigError(errors)
+
+    return PiToolConfig(raspberry_pis=pis), sources, list(dict.fromkeys(document.files))
+
+
+def _stat_key(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _digest(files: list[Path]) -> str:
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(str(path).encode() + b"\0" + path.read_bytes())
+    return digest.hexdigest()
+
+
+@cache
+def _code_digest() -> str:
+    """Hash of the loader and models, whose classes end up in the pickles"""
+    return _digest(sorted(Path(__file__).parent.glob("*.py")))
+
+
+def _cache_path(config_path: Path) -> Path:
+    key = hashlib.sha256(
+        f"{CACHE_VERSION}:{_code_digest()}:{config_path}".encode()
+    ).hexdigest()
+    return CONFIG_CACHE_DIR / f"{key[:32]}.pickle"
+
+
+def _load_cached(config_path: Path) -> tuple[PiToolConfig, Sources] | None:
+    cache_path = _cache_path(config_path)
+    try:
+        entry = pickle.loads(cache_path.read_bytes())
+        files: dict[Path, tuple[int, int]] = entry["files"]
+
+        if all(_stat_key(path) == key for path, key in files.items()):
+            return entry["config"], entry["sources"]
+
+        # Touched but possibly unchanged (e.g. a git checkout), compare contents
+        if _digest(list(files)) == entry["digest"]:
+            entry["files"] = {path: _stat_key(path) for path in files}
+            _write_cache(cache_path, entry)
+            return entry["config"], entry["sources"]
+    except Exception:
+        # Unpickling raises almost anything on a damaged or foreign entry,
+        # which just means parsing the config again
+        return None
+
+    return None
+
+
+def _write_cache(cache_path: Path, entry: dict) -> None:
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(pickle.dumps(entry))
+        tmp_path.replace(cache_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+
+
+def parse_config(config_path: Path) -> tuple[PiToolConfig, Sources]:
+    """Parse and validate a config file, using the cache when it's unchanged
+
+    Returns:
+        The config and, by Pi name, the file and raspberry_pis index each Pi
+        is defined at
+
+    Raises:
+        FileNotFoundError: If config_path doesn't exist
+        ConfigError: Listing every problem found
+    """
+    config_path = config_path.resolve()
+    if not config_path.exists():
+        raise FileNotFoundError(config_path)
+
+    cached = _load_cached(config_path)
+    if cached is not None:
+        return cached
+
+    config, sources, files = _parse(config_path)
+
+    _write_cache(
+        _cache_path(config_path),
+        {
+            "files": {path: _stat_key(path) for path in files},
+            "digest": _digest(files),
+            "config": config,
+            "sources": sources,
+        },
+    )
+
+    return config, sources
 
 
 def load_config(path: str = "pitool.yml") -> PiToolConfig:
     config_path = Path.cwd() / path
 
     try:
-        with config_path.open() as file:
-            config = yaml.safe_load(file)
-            return PiToolConfig.from_dict(config)
+        config, _sources = parse_config(config_path)
+        return config
     except FileNotFoundError:
         raise typer.BadParameter(f"Config file not found: {path}") from None
+    except ConfigError as e:
+        raise typer.BadParameter(f"Invalid config:\n{e}") from None
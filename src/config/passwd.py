@@ -1,9 +1,114 @@
-import subprocess
+import hashlib
+import json
+import secrets
+import sys
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any
 
 import typer
 
+# SHA-512-crypt ($6$) as specified in https://www.akkadia.org/drepper/SHA-crypt.txt
+DEFAULT_ROUNDS = 5000
+MIN_ROUNDS = 1000
+MAX_ROUNDS = 999_999_999
+SALT_LENGTH = 16
 
-def generate_hashed_password() -> str:
+CRYPT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Byte order in which the final digest is encoded, three bytes per group
+_ENCODE_ORDER = [
+    (0, 21, 42),
+    (22, 43, 1),
+    (44, 2, 23),
+    (3, 24, 45),
+    (25, 46, 4),
+    (47, 5, 26),
+    (6, 27, 48),
+    (28, 49, 7),
+    (50, 8, 29),
+    (9, 30, 51),
+    (31, 52, 10),
+    (53, 11, 32),
+    (12, 33, 54),
+    (34, 55, 13),
+    (56, 14, 35),
+    (15, 36, 57),
+    (37, 58, 16),
+    (59, 17, 38),
+    (18, 39, 60),
+    (40, 61, 19),
+    (62, 20, 41),
+]
+
+
+def _repeat(digest: bytes, length: int) -> bytes:
+    return (digest * (length // len(digest) + 1))[:length]
+
+
+def _encode(value: int, count: int) -> str:
+    chars = []
+    for _ in range(count):
+        chars.append(CRYPT_ALPHABET[value & 0x3F])
+        value >>= 6
+    return "".join(chars)
+
+
+def generate_salt(length: int = SALT_LENGTH) -> str:
+    return "".join(secrets.choice(CRYPT_ALPHABET) for _ in range(length))
+
+
+def sha512_crypt(
+    password: str, salt: str | None = None, rounds: int = DEFAULT_ROUNDS
+) -> str:
+    """Hash password in the crypt(3) "$6$" format used by /etc/shadow
+
+    Args:
+        password: Plain text password
+        salt: Up to 16 salt characters, random if not given
+        rounds: Number of rounds, clamped to 1000..999999999
+
+    Returns:
+        The crypt string, e.g. "$6$rounds=10000$salt$hash"
+    """
+    key = password.encode()
+    salt_bytes = (salt if salt is not None else generate_salt()).encode()[:SALT_LENGTH]
+    custom_rounds = rounds != DEFAULT_ROUNDS
+    rounds = min(max(rounds, MIN_ROUNDS), MAX_ROUNDS)
+
+    alternate = hashlib.sha512(key + salt_bytes + key).digest()
+
+    ctx = hashlib.sha512(key + salt_bytes + _repeat(alternate, len(key)))
+    length = len(key)
+    while length:
+        ctx.update(alternate if length & 1 else key)
+        length >>= 1
+    digest = ctx.digest()
+
+    p_bytes = _repeat(hashlib.sha512(key * len(key)).digest(), len(key))
+    s_bytes = _repeat(
+        hashlib.sha512(salt_bytes * (16 + digest[0])).digest(), len(salt_bytes)
+    )
+
+    for i in range(rounds):
+        ctx = hashlib.sha512(p_bytes if i & 1 else digest)
+        if i % 3:
+            ctx.update(s_bytes)
+        if i % 7:
+            ctx.update(p_bytes)
+        ctx.update(digest if i & 1 else p_bytes)
+        digest = ctx.digest()
+
+    encoded = "".join(
+        _encode(digest[a] << 16 | digest[b] << 8 | digest[c], 4)
+        for a, b, c in _ENCODE_ORDER
+    ) + _encode(digest[63], 2)
+
+    prefix = f"$6$rounds={rounds}$" if custom_rounds else "$6$"
+    return f"{prefix}{salt_bytes.decode()}${encoded}"
+
+
+def generate_hashed_password(rounds: int = DEFAULT_ROUNDS) -> str:
     """Generate hashed password for pitool.yml"""
 
     password = typer.prompt("Password", hide_input=True)
@@ -13,19 +118,174 @@ def generate_hashed_password() -> str:
         typer.secho("Passwords don't match", err=True)
         raise typer.Abort()
 
-    salt_result = subprocess.run(
-        ["openssl", "rand", "-base64", "6"], capture_output=True, text=True, check=True
-    )
+    hashed = sha512_crypt(password, rounds=rounds)
 
-    salt = salt_result.stdout.strip()
+    typer.echo(f"\nHashed password:\n{hashed}")
 
-    hash_result = subprocess.run(
-        ["openssl", "passwd", "-6", "-salt", salt, password],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
+    return hashed
 
-    hashed = hash_result.stdout.strip()
 
-    typer.echo(f"\nHashed password:\n{hashed}")
+def parse_password_lines(lines: Iterable[str]) -> dict[str, str]:
+    """Parse chpasswd(8) style "name:password" lines, skipping blanks and comments
+
+    Raises:
+        ValueError: On a line without a name or password
+    """
+    passwords = {}
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        name, separator, password = line.partition(":")
+        if not separator or not name.strip() or not password:
+            raise ValueError(f"Line {number}: expected name:password")
+        passwords[name.strip()] = password
+    return passwords
+
+
+def _mapping_value(node: Any, key: str) -> Any:
+    """The value node under key in a composed YAML mapping, None if absent"""
+    for key_node, value_node in node.value:
+        if key_node.value == key:
+            return value_node
+    return None
+
+
+def _add_entry(mapping: Any, entry: str) -> tuple[int, int, str]:
+    """An edit adding entry as the first one of a non-empty mapping"""
+    first = mapping.value[0][0].start_mark
+    if mapping.flow_style:
+        return first.index, first.index, f"{entry}, "
+    indent = " " * first.column
+    entry = entry.replace("\n", "\n" + indent)
+    return first.index, first.index, f"{entry}\n{indent}"
+
+
+def _splice_passwords(root: Any, text: str, updates: dict[int, str]) -> str:
+    """Set raspberry_pis[index].user.password in YAML text, edited in place
+
+    Only the password values change, so comments, ordering and quoting of
+    everything else survive. A missing password or user key is added in front
+    of the mapping's first key.
+
+    Args:
+        root: The text composed with yaml.compose
+        text: The YAML source
+        updates: Hashes by raspberry_pis index
+
+    Raises:
+        ValueError: When a Pi's user is an alias or not a mapping
+    """
+    pis = _mapping_value(root, "raspberry_pis")
+    edits = []
+    for index, hashed in updates.items():
+        pi = pis.value[index]
+        # Double quoted, the way JSON writes it, is valid YAML
+        quoted = json.dumps(hashed)
+        user = _mapping_value(pi, "user")
+        if user is None:
+            if pi.flow_style:
+                edits.append(_add_entry(pi, f"user: {{password: {quoted}}}"))
+            else:
+                edits.append(_add_entry(pi, f"user:\n  password: {quoted}"))
+            continue
+
+        where = f"raspberry_pis[{index}].user"
+        if not pi.start_mark.index <= user.start_mark.index < pi.end_mark.index:
+            raise ValueError(f"{where} is an alias, set its password by hand")
+        if user.id != "mapping":
+            raise ValueError(f"{where} isn't a mapping")
+        password = _mapping_value(user, "password")
+        if password is not None:
+            edits.append((password.start_mark.index, password.end_mark.index, quoted))
+        elif user.value:
+            edits.append(_add_entry(user, f"password: {quoted}"))
+        else:
+            edits.append(
+                (user.start_mark.index, user.end_mark.index, f"{{password: {quoted}}}")
+            )
+
+    # Back to front, so earlier offsets stay valid
+    for start, end, replacement in sorted(edits, reverse=True):
+        text = text[:start] + replacement + text[end:]
+    return text
+
+
+def hash_passwords_batch(
+    source: str, config_path: Path, rounds: int = DEFAULT_ROUNDS
+) -> list[str]:
+    """Hash passwords from a file (or "-" for stdin) into the fleet config
+
+    Each name is matched against the Pi names first, otherwise against user
+    names, setting the password of every Pi with that user. A password given
+    for a Pi by name wins over one given for its user. Hashes are written to
+    the file each Pi is defined in (which may be an included file), editing
+    only the password values so comments survive. The previous version is
+    kept with a .bak suffix.
+
+    Args:
+        source: File with name:password lines, "-" reads stdin
+        config_path: Fleet config to update in place
+        rounds: SHA-512-crypt rounds
+
+    Returns:
+        Names of the Pis whose password was set
+
+    Raises:
+        ValueError: On malformed input or names that match no Pi
+    """
+    # Only batch mode needs the YAML side, keep it out of `pitool passwd`
+    import yaml
+
+    from .loader import Loader, parse_config
+
+    if source == "-":
+        passwords = parse_password_lines(sys.stdin)
+    else:
+        with open(source) as file:
+            passwords = parse_password_lines(file)
+
+    config, sources = parse_config(config_path)
+    pis = config.raspberry_pis
+    pi_names = {pi.name for pi in pis}
+
+    hashes: dict[str, str] = {}
+    unknown = []
+    # User wide passwords first, so per-Pi ones override them
+    for name, password in sorted(passwords.items(), key=lambda i: i[0] in pi_names):
+        targets = [
+            pi.name
+            for pi in pis
+            if pi.name == name or (name not in pi_names and pi.user.name == name)
+        ]
+        if not targets:
+            unknown.append(name)
+            continue
+
+        # A fresh salt per Pi, so identical passwords don't share a hash
+        for target in targets:
+            hashes[target] = sha512_crypt(password, rounds=rounds)
+
+    if unknown:
+        raise ValueError(f"No Pi or user named: {', '.join(unknown)}")
+
+    by_file: dict[Path, dict[int, str]] = {}
+    for name, hashed in hashes.items():
+        path, index = sources[name]
+        by_file.setdefault(path, {})[index] = hashed
+
+    for path, updates in by_file.items():
+        text = path.read_text()
+        try:
+            updated = _splice_passwords(
+                yaml.compose(text, Loader=Loader), text, updates
+            )
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+
+        path.with_name(path.name + ".bak").write_text(text)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(updated)
+        tmp_path.replace(path)
+
+    return list(hashes)
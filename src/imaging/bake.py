@@ -0,0 +1,175 @@
+"""Pre-baked per-Pi image variants
+
+A variant is a copy-on-write clone of a cached base image with the Pi's
+cloud-init files already written into the boot partition, so flashing it is
+a single sequential write. Variants are cached under a hash of the base image
+digest and the rendered cloud-init files, so re-flashing an unchanged Pi
+reuses the variant that was baked before.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+from src.config.models import PiConfig
+from src.imaging import cache
+from src.imaging.cloudinit import render_cloudinit_files
+from src.imaging.fat import write_boot_files
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # 64MB
+
+# What a reflinked variant owns after baking: the cloud-init files and the
+# rewritten FAT and directory sectors, a few KB in practice
+CLONE_UNSHARED_SIZE = 1024 * 1024  # 1MB
+
+# Placeholder instance_id suffix used while hashing, see variant_files
+KEY_SUFFIX = "variant"
+
+
+def _reflink(source: Path, destination: Path) -> bool:
+    """Clone source to destination sharing extents, False if unsupported"""
+    if sys.platform == "darwin":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) == 0:
+            return True
+        if ctypes.get_errno() in (errno.ENOTSUP, errno.EXDEV):
+            return False
+        raise OSError(ctypes.get_errno(), "clonefile failed", str(destination))
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (
+                errno.EOPNOTSUPP,
+                errno.EXDEV,
+                errno.EINVAL,
+                errno.ENOTTY,
+            ):
+                raise
+    return False
+
+
+def _data_ranges(fd: int, size: int) -> list[tuple[int, int]]:
+    """(start, end) of the allocated regions of a sparse file"""
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+
+    ranges = []
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only holes left
+                break
+            if e.errno == errno.EINVAL:  # filesystem can't tell
+                return [(0, size)]
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        ranges.append((start, end))
+        position = end
+    return ranges
+
+
+def _sparse_copy(source: Path, destination: Path) -> None:
+    """Copy only the allocated regions, keeping holes as holes"""
+    size = source.stat().st_size
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        dst.truncate(size)
+        for start, end in _data_ranges(src.fileno(), size):
+            src.seek(start)
+            dst.seek(start)
+            remaining = end - start
+            while remaining:
+                chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+
+
+def clone_file(source: Path, destination: Path) -> bool:
+    """Copy source to destination, sharing storage where the filesystem can
+
+    Returns:
+        True if the copy is a reflink/clonefile clone, False if data was copied
+    """
+    destination.unlink(missing_ok=True)
+    if _reflink(source, destination):
+        return True
+
+    _sparse_copy(source, destination)
+    return False
+
+
+def variant_files(base_sha256: str, pi_config: PiConfig) -> tuple[str, dict[str, str]]:
+    """Return the variant key and the cloud-init files to bake into it
+
+    The key is computed with a fixed instance_id suffix and the baked files
+    then use a suffix derived from the key, so the same Pi config and base
+    image always map to the same variant.
+    """
+    digest = hashlib.sha256(base_sha256.encode())
+    for name, content in sorted(render_cloudinit_files(pi_config, KEY_SUFFIX).items()):
+        digest.update(f"\0{name}\0".encode())
+        digest.update(content.encode())
+    key = digest.hexdigest()
+
+    return key, render_cloudinit_files(pi_config, suffix=key[:8])
+
+
+def bake_variant(
+    base_image: Path,
+    base_sha256: str,
+    pi_config: PiConfig,
+    batch: set[str] | None = None,
+) -> Path:
+    """Return a cached image for pi_config, cloning and baking it if needed
+
+    Args:
+        base_image: Extracted base image, usually from download_image
+        base_sha256: Digest of the extracted base image
+        pi_config: Pi whose cloud-init files are written into the variant
+        batch: Keys of the variants baked in the same run. They are kept
+            from eviction and the new variant's key is added
+
+    Returns:
+        Path of the baked variant in the image cache
+    """
+    key, files = variant_files(base_sha256, pi_config)
+    keep = set(batch or ())
+    if batch is not None:
+        batch.add(key)
+
+    if cache.lookup(key) is not None:
+        return cache.image_path(key)
+
+    path = cache.image_path(key)
+    part_path = path.with_name(path.name + ".part")
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        cloned = clone_file(base_image, part_path)
+        write_boot_files(part_path, files)
+        part_path.replace(path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+    cache.register(
+        key,
+        f"{pi_config.hostname}.img",
+        base=base_sha256,
+        unshared=CLONE_UNSHARED_SIZE if cloned else None,
+        keep=keep,
+    )
+
+    return path
@@ -0,0 +1,417 @@
+"""Block maps for sparse flashing
+
+A block map lists the byte ranges of an image that actually carry data. Free
+space inside FAT and ext4 partitions is skipped based on the filesystem's own
+allocation tables; anywhere else (gaps between partitions, images without a
+partition table) all-zero blocks are skipped instead. Unknown partition types
+are always written in full.
+"""
+
+import argparse
+import json
+import os
+import stat
+import struct
+import sys
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+from src.imaging.verify import ChunkDigest, chunk_digest, verify_target
+from src.imaging.writer import report_line
+
+BLOCK_SIZE = 4096
+SCAN_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+COPY_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks
+
+SECTOR_SIZE = 512
+MBR_SIGNATURE = b"\x55\xaa"
+FAT_PARTITION_TYPES = {0x0B, 0x0C}
+LINUX_PARTITION_TYPE = 0x83
+
+EXT4_MAGIC = 0xEF53
+EXT4_INCOMPAT_64BIT = 0x80
+EXT4_BG_BLOCK_UNINIT = 0x2
+
+Range = tuple[int, int]
+
+
+@dataclass
+class BlockMap:
+    image_size: int
+    image_mtime_ns: int
+    block_size: int
+    mapped: list[Range]
+
+    @property
+    def mapped_bytes(self) -> int:
+        return sum(end - start for start, end in self.mapped)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BlockMap":
+        data = {**data, "mapped": [tuple(r) for r in data["mapped"]]}
+        return cls(**data)
+
+
+def bmap_path(image_path: Path) -> Path:
+    return image_path.with_name(image_path.name + ".bmap.json")
+
+
+def _coalesce(ranges: list[Range]) -> list[Range]:
+    result: list[Range] = []
+    for start, end in sorted(ranges):
+        if start >= end:
+            continue
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        else:
+            result.append((start, end))
+    return result
+
+
+def _align_inward(ranges: list[Range], alignment: int) -> list[Range]:
+    """Shrink skippable ranges so they never cover a partial block"""
+    aligned = []
+    for start, end in ranges:
+        start = -(-start // alignment) * alignment
+        end = end // alignment * alignment
+        if start < end:
+            aligned.append((start, end))
+    return aligned
+
+
+def _complement(ranges: list[Range], size: int) -> list[Range]:
+    result = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            result.append((position, start))
+        position = max(position, end)
+    if position < size:
+        result.append((position, size))
+    return result
+
+
+def read_partitions(f: BinaryIO) -> list[tuple[int, int, int]] | None:
+    """Return (type, start, end) byte ranges from the MBR, or None"""
+    f.seek(0)
+    mbr = f.read(SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != MBR_SIGNATURE:
+        return None
+
+    partitions = []
+    for i in range(4):
+        entry = mbr[446 + i * 16 : 446 + (i + 1) * 16]
+        part_type = entry[4]
+        lba, sectors = struct.unpack("<II", entry[8:16])
+        if part_type and sectors:
+            start = lba * SECTOR_SIZE
+            partitions.append((part_type, start, start + sectors * SECTOR_SIZE))
+
+    # A boot sector with a BPB also carries 0x55AA, require sane entries
+    if not partitions or any(start < SECTOR_SIZE for _, start, _ in partitions):
+        return None
+
+    return partitions
+
+
+def _fat_free_ranges(f: BinaryIO, offset: int) -> list[Range] | None:
+    """Free cluster ranges of a FAT16/FAT32 filesystem at offset"""
+    f.seek(offset)
+    bpb = f.read(SECTOR_SIZE)
+    if len(bpb) < SECTOR_SIZE or bpb[510:512] != MBR_SIGNATURE:
+        return None
+
+    bytes_per_sector, sectors_per_cluster, reserved, num_fats, root_entries = (
+        struct.unpack_from("<HBHBH", bpb, 11)
+    )
+    total_sectors = (
+        struct.unpack_from("<H", bpb, 19)[0] or struct.unpack_from("<I", bpb, 32)[0]
+    )
+    fat_sectors = (
+        struct.unpack_from("<H", bpb, 22)[0] or struct.unpack_from("<I", bpb, 36)[0]
+    )
+    if not bytes_per_sector or not sectors_per_cluster or not fat_sectors:
+        return None
+
+    root_sectors = -(-root_entries * 32 // bytes_per_sector)
+    data_start = reserved + num_fats * fat_sectors + root_sectors
+    cluster_count = (total_sectors - data_start) // sectors_per_cluster
+
+    if cluster_count < 4085:
+        return None  # FAT12, not worth supporting for boot partitions
+    entry_size = 2 if cluster_count < 65525 else 4
+
+    f.seek(offset + reserved * bytes_per_sector)
+    fat = f.read((cluster_count + 2) * entry_size)
+    entry_format = "<H" if entry_size == 2 else "<I"
+    mask = 0xFFFF if entry_size == 2 else 0x0FFFFFFF
+
+    cluster_bytes = sectors_per_cluster * bytes_per_sector
+    data_offset = offset + data_start * bytes_per_sector
+
+    free = []
+    for cluster, (entry,) in enumerate(struct.iter_unpack(entry_format, fat)):
+        if cluster < 2 or entry & mask:
+            continue
+        start = data_offset + (cluster - 2) * cluster_bytes
+        free.append((start, start + cluster_bytes))
+
+    return _coalesce(free)
+
+
+def _ext4_free_ranges(f: BinaryIO, offset: int) -> list[Range] | None:
+    """Free block ranges of an ext2/3/4 filesystem at offset"""
+    f.seek(offset + 1024)
+    sb = f.read(1024)
+    if len(sb) < 1024 or struct.unpack_from("<H", sb, 0x38)[0] != EXT4_MAGIC:
+        return None
+
+    blocks_count = struct.unpack_from("<I", sb, 0x4)[0]
+    first_data_block = struct.unpack_from("<I", sb, 0x14)[0]
+    block_size = 1024 << struct.unpack_from("<I", sb, 0x18)[0]
+    blocks_per_group = struct.unpack_from("<I", sb, 0x20)[0]
+    incompat = struct.unpack_from("<I", sb, 0x60)[0]
+
+    desc_size = 32
+    if incompat & EXT4_INCOMPAT_64BIT:
+        blocks_count |= struct.unpack_from("<I", sb, 0x150)[0] << 32
+        desc_size = struct.unpack_from("<H", sb, 0xFE)[0] or 64
+
+    group_count = -(-(blocks_count - first_data_block) // blocks_per_group)
+
+    f.seek(offset + (first_data_block + 1) * block_size)
+    descriptors = f.read(group_count * desc_size)
+
+    free = []
+    for group in range(group_count):
+        desc = descriptors[group * desc_size : (group + 1) * desc_size]
+        bitmap_block = struct.unpack_from("<I", desc, 0x0)[0]
+        flags = struct.unpack_from("<H", desc, 0x12)[0]
+        if desc_size >= 64:
+            bitmap_block |= struct.unpack_from("<I", desc, 0x20)[0] << 32
+
+        # Uninitialised groups still hold metadata we can't cheaply locate
+        if flags & EXT4_BG_BLOCK_UNINIT:
+            continue
+
+        f.seek(offset + bitmap_block * block_size)
+        bitmap = f.read(blocks_per_group // 8)
+
+        group_start = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks_count - group_start)
+
+        run_start = None
+        for byte_index, byte in enumerate(bitmap[: -(-group_blocks // 8)]):
+            base = byte_index * 8
+            if byte == 0x00:
+                if run_start is None:
+                    run_start = base
+                continue
+            if byte == 0xFF:
+                if run_start is not None:
+                    free.append((group_start + run_start, group_start + base))
+                    run_start = None
+                continue
+            for bit in range(8):
+                used = byte >> bit & 1
+                if not used and run_start is None:
+                    run_start = base + bit
+                elif used and run_start is not None:
+                    free.append((group_start + run_start, group_start + base + bit))
+                    run_start = None
+        if run_start is not None and run_start < group_blocks:
+            free.append((group_start + run_start, group_start + group_blocks))
+
+    return _coalesce(
+        [
+            (offset + start * block_size, offset + end * block_size)
+            for start, end in free
+        ]
+    )
+
+
+def _zero_ranges(f: BinaryIO, start: int, end: int) -> list[Range]:
+    """All-zero BLOCK_SIZE blocks between start and end"""
+    zero_chunk = bytes(SCAN_CHUNK_SIZE)
+    zero_block = bytes(BLOCK_SIZE)
+    zeros = []
+
+    f.seek(start)
+    position = start
+    while position < end:
+        chunk = f.read(min(SCAN_CHUNK_SIZE, end - position))
+        if not chunk:
+            break
+        if chunk == zero_chunk[: len(chunk)]:
+            zeros.append((position, position + len(chunk)))
+        else:
+            view = memoryview(chunk)
+            for i in range(0, len(chunk), BLOCK_SIZE):
+                if view[i : i + BLOCK_SIZE] == zero_block[: len(view[i:])]:
+                    zeros.append(
+                        (position + i, position + min(i + BLOCK_SIZE, len(chunk)))
+                    )
+        position += len(chunk)
+
+    return _coalesce(zeros)
+
+
+def compute_block_map(image_path: Path) -> BlockMap:
+    """Scan an image and return the byte ranges that must be written"""
+    info = image_path.stat()
+    size = info.st_size
+    skippable: list[Range] = []
+
+    with open(image_path, "rb") as f:
+        partitions = read_partitions(f)
+
+        if partitions is None:
+            skippable = _zero_ranges(f, 0, size)
+        else:
+            # The MBR and everything up to the first partition is always written
+            covered = [(0, min(start for _, start, _ in partitions))]
+
+            for part_type, start, end in partitions:
+                covered.append((start, end))
+                free = None
+                if part_type in FAT_PARTITION_TYPES:
+                    free = _fat_free_ranges(f, start)
+                elif part_type == LINUX_PARTITION_TYPE:
+                    free = _ext4_free_ranges(f, start)
+                if free:
+                    skippable.extend((max(s, start), min(e, end)) for s, e in free)
+
+            for gap_start, gap_end in _complement(_coalesce(covered), size):
+                skippable.extend(_zero_ranges(f, gap_start, gap_end))
+
+    skippable = _align_inward(_coalesce(skippable), BLOCK_SIZE)
+
+    return BlockMap(
+        image_size=size,
+        image_mtime_ns=info.st_mtime_ns,
+        block_size=BLOCK_SIZE,
+        mapped=_complement(skippable, size),
+    )
+
+
+def load_block_map(image_path: Path) -> BlockMap:
+    """Return the cached block map for image_path, computing it if stale"""
+    info = image_path.stat()
+    cache_path = bmap_path(image_path)
+
+    try:
+        block_map = BlockMap.from_dict(json.loads(cache_path.read_text()))
+        if (
+            block_map.image_size == info.st_size
+            and block_map.image_mtime_ns == info.st_mtime_ns
+        ):
+            return block_map
+    except (FileNotFoundError, ValueError, TypeError, KeyError):
+        pass
+
+    block_map = compute_block_map(image_path)
+    cache_path.write_text(json.dumps(asdict(block_map)))
+
+    return block_map
+
+
+def write_mapped(
+    image_path: Path,
+    target: str,
+    block_map: BlockMap,
+    on_progress: Callable[[int], None] | None = None,
+    digests: list[ChunkDigest] | None = None,
+) -> int:
+    """Copy only the mapped ranges of image_path to target
+
+    Args:
+        image_path: Source image
+        target: Block device or regular file to write to
+        block_map: Ranges to copy
+        on_progress: Called with the number of bytes written per chunk
+        digests: If given, filled with the digest of every chunk written
+
+    Returns:
+        Number of bytes written
+    """
+    written = 0
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    source_fd = os.open(image_path, os.O_RDONLY)
+    target_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        # Skipped tail blocks of a regular file target must still exist, and
+        # nothing may be left behind the image
+        target_stat = os.fstat(target_fd)
+        if (
+            stat.S_ISREG(target_stat.st_mode)
+            and target_stat.st_size != block_map.image_size
+        ):
+            os.ftruncate(target_fd, block_map.image_size)
+
+        for start, end in block_map.mapped:
+            position = start
+            while position < end:
+                length = os.preadv(
+                    source_fd, [view[: min(COPY_CHUNK_SIZE, end - position)]], position
+                )
+                if not length:
+                    raise RuntimeError(f"Unexpected end of image at {position}")
+                os.pwrite(target_fd, view[:length], position)
+                if digests is not None:
+                    digests.append(chunk_digest(position, view[:length]))
+                position += length
+                written += length
+                if on_progress:
+                    on_progress(length)
+
+        os.fsync(target_fd)
+    finally:
+        os.close(source_fd)
+        os.close(target_fd)
+
+    return written
+
+
+def main() -> None:
+    """Privileged helper: write mapped ranges, see src.imaging.writer.main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image")
+    parser.add_argument("target")
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+
+    # The map is computed by the unprivileged caller, so the cache file
+    # never ends up owned by root
+    image_path = Path(args.image)
+    block_map = BlockMap.from_dict(json.loads(bmap_path(image_path).read_text()))
+    digests: list[ChunkDigest] | None = [] if args.verify else None
+
+    def report(advance: int) -> None:
+        report_line(0, advance)
+
+    write_mapped(
+        image_path, args.target, block_map, on_progress=report, digests=digests
+    )
+
+    if digests is None:
+        return 0
+
+    def report_verify(advance: int) -> None:
+        report_line(0, "verify", advance)
+
+    offset = verify_target(
+        args.target, digests, source=image_path, on_progress=report_verify
+    )
+    if offset is not None:
+        report_line(0, "mismatch", offset)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""Content-addressed image cache
+
+Extracted images are stored as ``images/<extract_sha256>.img`` and tracked in
+``manifest.json`` with their size, last use and verification state. Baked
+per-Pi variants live alongside them, keyed by their variant hash and recording
+the base image they were cloned from. Images flashed straight from their
+download are kept compressed instead, as ``images/<extract_sha256>.img.xz``.
+When the cache grows past its size cap the least recently used unpinned images
+are evicted.
+
+Every read-modify-write of the manifest holds an exclusive lock on
+``manifest.lock``, so concurrent pitool runs (e.g. two bakes) don't lose each
+other's entries.
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from platformdirs import user_cache_dir
+
+CACHE_DIR = Path(user_cache_dir("pitool"))
+
+IMAGES_DIR = CACHE_DIR / "images"
+DOWNLOADS_DIR = CACHE_DIR / "downloads"
+MANIFEST_PATH = CACHE_DIR / "manifest.json"
+LOCK_PATH = CACHE_DIR / "manifest.lock"
+
+DEFAULT_MAX_SIZE = 16 * 1024**3  # 16GB
+MAX_SIZE_ENV = "PITOOL_CACHE_MAX_SIZE"
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# Left in CACHE_DIR itself by versions before the content-addressed layout:
+# extracted images, which are migrated, and downloads, which are deleted
+LEGACY_IMAGE_PATTERN = "*.img"
+LEGACY_DOWNLOAD_PATTERNS = ("*.xz", "*.part", "*.part.json")
+
+# flock is per open file, nested holders in this process share one
+_lock = threading.RLock()
+_lock_depth = 0
+_lock_fd: int | None = None
+
+
+@dataclass
+class CacheEntry:
+    sha256: str
+    filename: str
+    size: int
+    last_used: float
+    url: str = ""
+    verified: bool = False
+    pinned: bool = False
+    base: str = ""
+    suffix: str = ".img"
+    # For variants cloned with a reflink, the bytes not shared with the base
+    unshared: int | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CacheEntry":
+        return cls(**data)
+
+    @property
+    def path(self) -> Path:
+        return image_path(self.sha256, self.suffix)
+
+
+def parse_size(value: str) -> int:
+    """Parse sizes like "20G", "512M" or "1073741824" into bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", value.upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def max_cache_size() -> int:
+    value = os.environ.get(MAX_SIZE_ENV)
+    return parse_size(value) if value else DEFAULT_MAX_SIZE
+
+
+def image_path(sha256: str, suffix: str = ".img") -> Path:
+    return IMAGES_DIR / f"{sha256}{suffix}"
+
+
+def download_path(filename: str) -> Path:
+    DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    return DOWNLOADS_DIR / filename
+
+
+@contextmanager
+def locked() -> Iterator[None]:
+    """Hold the manifest lock against other processes and threads, reentrant"""
+    global _lock_depth, _lock_fd
+    with _lock:
+        if _lock_depth == 0:
+            LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+            _lock_fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(_lock_fd, fcntl.LOCK_EX)
+        _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+            if _lock_depth == 0:
+                os.close(_lock_fd)
+                _lock_fd = None
+
+
+def load_manifest() -> dict[str, CacheEntry]:
+    try:
+        data = json.loads(MANIFEST_PATH.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    return {sha: CacheEntry.from_dict(entry) for sha, entry in data.items()}
+
+
+def save_manifest(entries: dict[str, CacheEntry]) -> None:
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_name(MANIFEST_PATH.name + ".tmp")
+    tmp_path.write_text(
+        json.dumps({sha: asdict(entry) for sha, entry in entries.items()}, indent=2)
+    )
+    tmp_path.replace(MANIFEST_PATH)
+
+
+def contains(sha256: str) -> bool:
+    entry = load_manifest().get(sha256)
+    return entry is not None and entry.path.exists()
+
+
+def lookup(sha256: str) -> CacheEntry | None:
+    """Return the cache entry for sha256 and mark it used, if it exists"""
+    with locked():
+        entries = load_manifest()
+        entry = entries.get(sha256)
+
+        if entry is None or not entry.path.exists():
+            return None
+
+        entry.last_used = time.time()
+        save_manifest(entries)
+
+        return entry
+
+
+def register(
+    sha256: str,
+    filename: str,
+    url: str = "",
+    verified: bool = False,
+    base: str = "",
+    suffix: str = ".img",
+    unshared: int | None = None,
+    keep: set[str] | None = None,
+) -> CacheEntry:
+    """Record a freshly cached image and evict others past the size cap
+
+    Args:
+        sha256: Cache key, the extracted image digest or a variant hash
+        filename: Human readable name
+        url: Where the image was downloaded from
+        verified: Whether the image matched its expected digest
+        base: For baked variants, the key of the base image
+        suffix: File suffix, e.g. ".img.xz" for a compressed image
+        unshared: For reflinked variants, bytes not shared with the base
+        keep: Other entries that must survive eviction, e.g. the variants
+            baked earlier in the same run
+    """
+    with locked():
+        entries = load_manifest()
+        previous = entries.get(sha256)
+
+        entry = CacheEntry(
+            sha256=sha256,
+            filename=filename,
+            size=image_path(sha256, suffix).stat().st_size,
+            last_used=time.time(),
+            url=url,
+            verified=verified,
+            pinned=previous.pinned if previous else False,
+            base=base,
+            suffix=suffix,
+            unshared=unshared,
+        )
+        entries[sha256] = entry
+        save_manifest(entries)
+
+        evict(max_cache_size(), keep={sha256, base, *(keep or ())} - {""})
+
+        return entry
+
+
+def _remove_files(sha256: str) -> None:
+    # Also drops sidecars such as the cached block map
+    for path in IMAGES_DIR.glob(f"{sha256}.img*"):
+        path.unlink(missing_ok=True)
+
+
+def mark_verified(sha256: str) -> None:
+    """Record that an image matched its expected digest after all"""
+    with locked():
+        entries = load_manifest()
+        if sha256 in entries:
+            entries[sha256].verified = True
+            save_manifest(entries)
+
+
+def remove(sha256: str) -> None:
+    with locked():
+        entries = load_manifest()
+        entries.pop(sha256, None)
+        _remove_files(sha256)
+        save_manifest(entries)
+
+
+def _footprint(entry: CacheEntry, entries: dict[str, CacheEntry]) -> int:
+    """Bytes an entry takes on its own, a reflinked variant shares its base's"""
+    if entry.unshared is not None and entry.base in entries:
+        return entry.unshared
+    return entry.size
+
+
+def evict(max_size: int, keep: set[str] | None = None) -> list[CacheEntry]:
+    """Remove least recently used unpinned images until under max_size
+
+    Args:
+        max_size: Cache size cap in bytes
+        keep: Entries that must not be evicted (e.g. the image in use)
+
+    Returns:
+        The evicted entries
+    """
+    with locked():
+        keep = keep or set()
+        entries = load_manifest()
+
+        # Forget entries whose files were deleted behind our back
+        for sha in [sha for sha, entry in entries.items() if not entry.path.exists()]:
+            del entries[sha]
+
+        total = sum(_footprint(entry, entries) for entry in entries.values())
+        evicted = []
+
+        for entry in sorted(entries.values(), key=lambda e: e.last_used):
+            if total <= max_size:
+                break
+            if entry.pinned or entry.sha256 in keep:
+                continue
+
+            _remove_files(entry.sha256)
+            total -= _footprint(entry, entries)
+            del entries[entry.sha256]
+            evicted.append(entry)
+
+        save_manifest(entries)
+
+        return evicted
+
+
+def migrate_legacy_files() -> list[CacheEntry]:
+    """Move images cached by older versions into the content-addressed layout
+
+    Images are hashed once to find their key, so a later flash of the same
+    image is a cache hit. Leftover downloads are deleted.
+
+    Returns:
+        The migrated entries
+    """
+    from src.utils import calculate_hash, remember_hash
+
+    migrated = []
+    with locked():
+        for path in sorted(CACHE_DIR.glob(LEGACY_IMAGE_PATTERN)):
+            sha256 = calculate_hash(
+                str(path), text=f"[yellow]Migrating cached image[/yellow] {path.name}"
+            )
+            IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+            path.replace(image_path(sha256))
+            remember_hash(image_path(sha256), sha256)
+            # Keyed by its own digest, it matches any catalog entry it's found by
+            migrated.append(register(sha256, path.name, verified=True))
+
+        for pattern in LEGACY_DOWNLOAD_PATTERNS:
+            for path in CACHE_DIR.glob(pattern):
+                path.unlink(missing_ok=True)
+
+    return migrated
+
+
+def find(query: str) -> CacheEntry:
+    """Find an entry by sha256 prefix or filename
+
+    Raises:
+        ValueError: If nothing or more than one entry matches
+    """
+    matches = [
+        entry
+        for entry in load_manifest().values()
+        if entry.sha256.startswith(query.lower()) or entry.filename == query
+    ]
+
+    if not matches:
+        raise ValueError(f"No cached image matches: {query}")
+    if len(matches) > 1:
+        raise ValueError(f"Ambiguous cached image: {query}")
+
+    return matches[0]
+
+
+def set_pinned(query: str, pinned: bool) -> CacheEntry:
+    with locked():
+        entries = load_manifest()
+        entry = entries[find(query).sha256]
+        entry.pinned = pinned
+        save_manifest(entries)
+        return entry
@@ -1,16 +1,58 @@
+"""Cloud-init file rendering
+
+All rendering shares one Jinja environment whose compiled templates are kept
+in a bytecode cache on disk, so rendering a whole fleet compiles each template
+at most once (and not at all when the templates haven't changed).
+"""
+
+import hashlib
+import json
+import re
 import secrets
+import shutil
+from collections.abc import Callable
+from dataclasses import asdict
+from functools import cache
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from src.config.models import PiConfig
+from src.imaging.cache import CACHE_DIR
 from src.paths import TEMPLATES_DIR
 
+BYTECODE_DIR = CACHE_DIR / "jinja"
+RENDER_STATE_FILE = ".render-state.json"
 
-def generate_cloudinit_files(pi_config: PiConfig, output_dir: Path):
-    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+# random: fresh suffix per render, stable: derived from the inputs, none: hostname
+INSTANCE_ID_POLICIES = ("random", "stable", "none")
+
+# Characters a Pi name may keep in its output directory name
+UNSAFE_DIR_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+@cache
+def _environment() -> Environment:
+    BYTECODE_DIR.mkdir(parents=True, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(TEMPLATES_DIR),
+        bytecode_cache=FileSystemBytecodeCache(str(BYTECODE_DIR)),
+    )
+
+
+def render_cloudinit_files(
+    pi_config: PiConfig, suffix: str | None = None
+) -> dict[str, str]:
+    """Render the cloud-init files for a Pi, keyed by boot partition file name
+
+    Args:
+        pi_config: Pi to render for
+        suffix: instance_id suffix, random unless given, omitted if empty
+    """
+    env = _environment()
 
-    suffix = secrets.token_hex(4)
+    if suffix is None:
+        suffix = secrets.token_hex(4)
 
     user_data = env.get_template("user-data.j2").render(
         hostname=pi_config.hostname,
@@ -29,9 +71,128 @@ def generate_cloudinit_files(pi_config: PiConfig, output_dir: Path):
 
     meta_data = env.get_template("meta-data.j2").render(
         hostname=pi_config.hostname,
-        instance_id=f"{pi_config.hostname}-{suffix}",
+        instance_id=f"{pi_config.hostname}-{suffix}" if suffix else pi_config.hostname,
     )
 
-    (output_dir / "user-data").write_text(user_data)
-    (output_dir / "network-config").write_text(network_config)
-    (output_dir / "meta-data").write_text(meta_data)
+    return {
+        "user-data": user_data,
+        "network-config": network_config,
+        "meta-data": meta_data,
+    }
+
+
+def generate_cloudinit_files(pi_config: PiConfig, output_dir: Path):
+    for name, content in render_cloudinit_files(pi_config).items():
+        (output_dir / name).write_text(content)
+
+
+@cache
+def _templates_digest() -> str:
+    digest = hashlib.sha256()
+    for path in sorted(TEMPLATES_DIR.glob("*.j2")):
+        digest.update(path.name.encode() + b"\0" + path.read_bytes())
+    return digest.hexdigest()
+
+
+def input_hash(pi_config: PiConfig, policy: str = "random") -> str:
+    """Hash everything a render depends on except the random instance_id suffix"""
+    data = json.dumps(asdict(pi_config), sort_keys=True)
+    return hashlib.sha256(
+        f"{_templates_digest()}\0{policy}\0{data}".encode()
+    ).hexdigest()
+
+
+def _suffix(policy: str, inputs: str) -> str | None:
+    match policy:
+        case "random":
+            return None
+        case "stable":
+            return inputs[:8]
+        case "none":
+            return ""
+    raise ValueError(f"Unknown instance_id policy: {policy}")
+
+
+def _load_render_state(out_dir: Path) -> dict[str, str]:
+    try:
+        return json.loads((out_dir / RENDER_STATE_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def output_dir_name(name: str) -> str:
+    """Directory name for a Pi's bundle, safe to join to the output directory"""
+    return UNSAFE_DIR_CHARS.sub("-", name).strip(".-") or "pi"
+
+
+def render_fleet(
+    pis: list[PiConfig],
+    out_dir: Path,
+    policy: str = "random",
+    force: bool = False,
+    on_rendered: Callable[[PiConfig, bool], None] | None = None,
+) -> tuple[list[PiConfig], list[PiConfig]]:
+    """Render cloud-init bundles for every Pi into out_dir/<name>/
+
+    Pis whose inputs hash the same as in the previous run into out_dir are
+    skipped, unless force is set. Bundles a previous run rendered for Pis no
+    longer given are removed.
+
+    Args:
+        pis: Pis to render
+        out_dir: Output directory, one subdirectory per Pi
+        policy: instance_id suffix policy, one of INSTANCE_ID_POLICIES
+        force: Render every Pi even if unchanged
+        on_rendered: Called with (pi, skipped) as each Pi finishes
+
+    Returns:
+        (rendered, skipped) Pis
+
+    Raises:
+        ValueError: On an unknown policy or Pi names mapping to the same
+            directory
+    """
+    if policy not in INSTANCE_ID_POLICIES:
+        raise ValueError(f"Unknown instance_id policy: {policy}")
+
+    dir_names = [output_dir_name(pi.name) for pi in pis]
+    duplicates = sorted({name for name in dir_names if dir_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate Pi names: {', '.join(duplicates)}")
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    previous = _load_render_state(out_dir)
+    state: dict[str, str] = {}
+    rendered: list[PiConfig] = []
+    skipped: list[PiConfig] = []
+
+    # Templates are compiled once, so rendering is cheap CPU work that a pool
+    # wouldn't speed up
+    for pi, dir_name in zip(pis, dir_names, strict=True):
+        inputs = input_hash(pi, policy)
+        state[dir_name] = inputs
+        pi_dir = out_dir / dir_name
+
+        unchanged = not force and previous.get(dir_name) == inputs and pi_dir.is_dir()
+        if unchanged:
+            skipped.append(pi)
+        else:
+            pi_dir.mkdir(exist_ok=True)
+            for name, content in render_cloudinit_files(
+                pi, _suffix(policy, inputs)
+            ).items():
+                (pi_dir / name).write_text(content)
+            rendered.append(pi)
+
+        if on_rendered:
+            on_rendered(pi, unchanged)
+
+    # Only directories a previous run rendered, anything else in out_dir stays
+    for dir_name in previous.keys() - state.keys():
+        stale_dir = out_dir / output_dir_name(dir_name)
+        if stale_dir.is_dir():
+            shutil.rmtree(stale_dir)
+
+    (out_dir / RENDER_STATE_FILE).write_text(json.dumps(state, indent=2))
+
+    return rendered, skipped
@@ -0,0 +1,392 @@
+import gzip
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import zipfile
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+
+
+class Decoder(ABC):
+    """Interface for a decompression backend"""
+
+    name: str
+    suffixes: tuple[str, ...]
+
+    def available(self) -> bool:
+        """Whether the backend can run on this machine"""
+        return True
+
+    def accepts(self, path: Path) -> bool:
+        """Whether the backend should be used for this file"""
+        return path.name.endswith(self.suffixes)
+
+    @abstractmethod
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        """Yield the decompressed contents of path in order"""
+        pass
+
+
+class _PipeDecoder(Decoder):
+    """Decompress by piping through an external multi-threaded tool"""
+
+    command: tuple[str, ...]
+
+    def available(self) -> bool:
+        return shutil.which(self.command[0]) is not None
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        proc = subprocess.Popen(
+            [*self.command, str(path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        finished = False
+        try:
+            while chunk := proc.stdout.read(CHUNK_SIZE):
+                yield chunk
+            finished = True
+        finally:
+            proc.stdout.close()
+            if not finished:
+                proc.terminate()
+            stderr = proc.stderr.read().decode(errors="replace").strip()
+            proc.stderr.close()
+            proc.wait()
+
+        if proc.returncode != 0:
+            raise RuntimeError(f"{self.command[0]} failed on {path.name}: {stderr}")
+
+
+class XzPipeDecoder(_PipeDecoder):
+    name = "xz-pipe"
+    suffixes = (".xz",)
+    command = ("xz", "-T0", "-dc")
+
+
+class ZstdPipeDecoder(_PipeDecoder):
+    name = "zstd-pipe"
+    suffixes = (".zst",)
+    command = ("zstd", "-T0", "-dcq")
+
+
+@dataclass
+class XzBlock:
+    stream_flags: bytes
+    offset: int
+    unpadded_size: int
+    uncompressed_size: int
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = 0
+    for i in range(9):
+        byte = data[pos + i]
+        value |= (byte & 0x7F) << (i * 7)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise ValueError("Invalid xz variable-length integer")
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _padded(size: int) -> int:
+    return (size + 3) & ~3
+
+
+def read_xz_blocks(path: Path) -> list[XzBlock]:
+    """List the blocks of every stream in an .xz file by walking its indexes"""
+    blocks: list[XzBlock] = []
+
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+
+        while end > 0:
+            # Skip stream padding between concatenated streams
+            f.seek(end - 4)
+            if f.read(4) == b"\x00\x00\x00\x00":
+                end -= 4
+                continue
+
+            f.seek(end - XZ_FOOTER_SIZE)
+            footer = f.read(XZ_FOOTER_SIZE)
+            if footer[10:] != XZ_FOOTER_MAGIC:
+                raise ValueError(f"Not an xz file: {path.name}")
+
+            if struct.unpack("<I", footer[:4])[0] != zlib.crc32(footer[4:10]):
+                raise ValueError(f"Invalid xz stream footer in {path.name}")
+
+            backward_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+            stream_flags = footer[8:10]
+
+            index_start = end - XZ_FOOTER_SIZE - backward_size
+            f.seek(index_start)
+            index = f.read(backward_size)
+            if index[0] != 0x00 or struct.unpack("<I", index[-4:])[0] != zlib.crc32(
+                index[:-4]
+            ):
+                raise ValueError(f"Invalid xz index in {path.name}")
+
+            count, pos = _read_varint(index, 1)
+            records = []
+            for _ in range(count):
+                unpadded, pos = _read_varint(index, pos)
+                uncompressed, pos = _read_varint(index, pos)
+                records.append((unpadded, uncompressed))
+
+            stream_start = (
+                index_start
+                - sum(_padded(unpadded) for unpadded, _ in records)
+                - XZ_HEADER_SIZE
+            )
+            f.seek(stream_start)
+            if f.read(len(XZ_HEADER_MAGIC)) != XZ_HEADER_MAGIC:
+                raise ValueError(f"Invalid xz stream header in {path.name}")
+
+            offset = stream_start + XZ_HEADER_SIZE
+            stream_blocks = []
+            for unpadded, uncompressed in records:
+                stream_blocks.append(
+                    XzBlock(stream_flags, offset, unpadded, uncompressed)
+                )
+                offset += _padded(unpadded)
+
+            blocks[:0] = stream_blocks
+            end = stream_start
+
+    return blocks
+
+
+def _single_block_stream(block: XzBlock, data: bytes) -> bytes:
+    """Wrap one raw block in a minimal standalone xz stream"""
+    flags = block.stream_flags
+
+    records = _encode_varint(block.unpadded_size) + _encode_varint(
+        block.uncompressed_size
+    )
+    index = b"\x00" + _encode_varint(1) + records
+    index += b"\x00" * (_padded(len(index)) - len(index))
+    index += struct.pack("<I", zlib.crc32(index))
+
+    header = XZ_HEADER_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+    backward = struct.pack("<I", len(index) // 4 - 1)
+    footer = (
+        struct.pack("<I", zlib.crc32(backward + flags))
+        + backward
+        + flags
+        + XZ_FOOTER_MAGIC
+    )
+
+    return header + data + index + footer
+
+
+class XzBlockParallelDecoder(Decoder):
+    """Decode independent .xz blocks concurrently in-process
+
+    liblzma releases the GIL while decoding, so a thread pool scales across
+    cores. Only used when the file actually has more than one block.
+    """
+
+    name = "xz-blocks"
+    suffixes = (".xz",)
+
+    def __init__(self, workers: int | None = None):
+        self.workers = workers or os.cpu_count() or 1
+
+    def accepts(self, path: Path) -> bool:
+        if not super().accepts(path):
+            return False
+        try:
+            return len(read_xz_blocks(path)) > 1
+        except (OSError, ValueError, IndexError):
+            return False
+
+    def _decode_block(self, path: Path, block: XzBlock) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(block.offset)
+            data = f.read(_padded(block.unpadded_size))
+
+        return lzma.decompress(_single_block_stream(block, data))
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        blocks = read_xz_blocks(path)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            remaining = iter(blocks)
+
+            # Keep a bounded window in flight so memory stays proportional
+            # to the worker count rather than the image size
+            for block in remaining:
+                pending.append(executor.submit(self._decode_block, path, block))
+                if len(pending) >= self.workers * 2:
+                    break
+
+            while pending:
+                data = pending.popleft().result()
+                block = next(remaining, None)
+                if block is not None:
+                    pending.append(executor.submit(self._decode_block, path, block))
+                yield data
+
+
+class LzmaDecoder(Decoder):
+    """Single-threaded fallback using Python's lzma module
+
+    lzma.open stops at the null padding allowed between concatenated streams
+    and drops the streams after it, so the streams are decoded one by one.
+    """
+
+    name = "lzma"
+    suffixes = (".xz",)
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        with open(path, "rb") as f:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            while True:
+                if decompressor.eof:
+                    data = decompressor.unused_data.lstrip(b"\x00")
+                    while not data and (more := f.read(CHUNK_SIZE)):
+                        data = more.lstrip(b"\x00")
+                    if not data:
+                        return
+                    decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+                elif decompressor.needs_input:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        raise ValueError(f"Truncated xz file: {path.name}")
+                else:
+                    data = b""
+
+                if chunk := decompressor.decompress(data, CHUNK_SIZE):
+                    yield chunk
+
+
+class GzipDecoder(Decoder):
+    name = "gzip"
+    suffixes = (".gz",)
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        with gzip.open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+
+class ZipDecoder(Decoder):
+    """Extract the first disk image member of a .zip archive"""
+
+    name = "zip"
+    suffixes = (".zip",)
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        with zipfile.ZipFile(path) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir()]
+            if not members:
+                raise ValueError(f"Empty zip archive: {path.name}")
+            member = next((m for m in members if m.filename.endswith(".img")), None)
+            with archive.open(member or members[0]) as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+
+
+class ZstdDecoder(Decoder):
+    """In-process zstd decoding via the optional zstandard package"""
+
+    name = "zstd"
+    suffixes = (".zst",)
+
+    def available(self) -> bool:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def iter_chunks(self, path: Path) -> Iterator[bytes]:
+        import zstandard
+
+        with open(path, "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+            while chunk := reader.read(CHUNK_SIZE):
+                yield chunk
+
+
+# Ordered fastest first, the first available backend that accepts a file wins
+DECODERS: list[Decoder] = [
+    XzPipeDecoder(),
+    XzBlockParallelDecoder(),
+    LzmaDecoder(),
+    ZstdPipeDecoder(),
+    ZstdDecoder(),
+    GzipDecoder(),
+    ZipDecoder(),
+]
+
+COMPRESSED_SUFFIXES = tuple(
+    dict.fromkeys(suffix for decoder in DECODERS for suffix in decoder.suffixes)
+)
+
+
+def strip_compression_suffix(filename: str) -> str:
+    """Return the extracted image filename for a compressed download"""
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            stripped = filename.removesuffix(suffix)
+            # Zip archives are named foo.zip rather than foo.img.zip
+            return stripped if suffix != ".zip" else f"{stripped}.img"
+    return filename
+
+
+def select_decoder(path: Path, name: str | None = None) -> Decoder:
+    """Pick the fastest available decoder for path
+
+    Args:
+        path: Compressed image
+        name: Force a specific backend by name
+
+    Raises:
+        ValueError: If no backend can decode the file
+    """
+    for decoder in DECODERS:
+        if name is not None and decoder.name != name:
+            continue
+        if decoder.available() and decoder.accepts(path):
+            return decoder
+
+    raise ValueError(f"No decoder available for {path.name}")
+
+
+def is_compressed(path: Path) -> bool:
+    return path.name.endswith(COMPRESSED_SUFFIXES)
+
+
+def uncompressed_size(path: Path) -> int | None:
+    """Size of the decompressed contents, if the format records it up front"""
+    if not path.name.endswith(".xz"):
+        return None
+    try:
+        return sum(block.uncompressed_size for block in read_xz_blocks(path))
+    except (ValueError, IndexError):
+        return None
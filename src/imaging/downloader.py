@@ -1,23 +1,42 @@
+import hashlib
+import json
 import lzma
 import shutil
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict
 from pathlib import Path
+from queue import Empty, Full, Queue
 
 import requests
 from InquirerPy import inquirer
-from platformdirs import user_cache_dir
 from rich.panel import Panel
-from rich.progress import Progress
 
 from src.console import console
+from src.imaging import cache
+from src.imaging.cache import CACHE_DIR
+from src.imaging.decoders import select_decoder, strip_compression_suffix
 from src.imaging.models import RaspberryPiImage
-from src.utils import calculate_hash
+from src.imaging.ranged import DEFAULT_CONNECTIONS, STREAM_TIMEOUT, download_ranged
+from src.imaging.writer import ImageStream
+from src.progress import Tracker
+from src.utils import calculate_hash_memoized, remember_hash
 
 # Last checked: 2025-12-12
 # API Version: v4
 API_URL = "https://downloads.raspberrypi.org/os_list_imagingutility_v4.json"
 
-CACHE_DIR = Path(user_cache_dir("pitool"))
-CACHE_DIR.mkdir(parents=True, exist_ok=True)
+CATALOG_PATH = CACHE_DIR / "catalog.json"
+CATALOG_TTL = 60 * 60  # 1 hour
+CATALOG_TIMEOUT = 10
+
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+# Compressed chunks read ahead of the decompressor when flashing from the URL
+PREFETCH_CHUNKS = 16
+# Largest decompressed piece handed on at once, zero runs compress extremely well
+DECOMPRESS_LIMIT = 4 * 1024 * 1024
 
 
 def _should_include_image(img: dict) -> bool:
@@ -28,19 +47,7 @@ def _should_include_image(img: dict) -> bool:
     )
 
 
-def fetch_image_list() -> list[RaspberryPiImage]:
-    """Fetch Raspberry Pi OS images with cloud-init support
-
-    Returns:
-        List of dicts with: name, url, release_date, extract_size
-    """
-    try:
-        response = requests.get(API_URL)
-        response.raise_for_status()
-        data = response.json()
-    except Exception as e:
-        raise ConnectionError(f"Failed to fetch image list: {e}") from None
-
+def _parse_image_list(data: dict) -> list[RaspberryPiImage]:
     result = []
     for item in data.get("os_list", []):
         if "subitems" in item:
@@ -54,6 +61,87 @@ def fetch_image_list() -> list[RaspberryPiImage]:
     return result
 
 
+def _load_catalog() -> dict | None:
+    try:
+        return json.loads(CATALOG_PATH.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_catalog(catalog: dict) -> None:
+    CATALOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = CATALOG_PATH.with_name(CATALOG_PATH.name + ".tmp")
+    tmp_path.write_text(json.dumps(catalog))
+    tmp_path.replace(CATALOG_PATH)
+
+
+def _catalog_images(catalog: dict) -> list[RaspberryPiImage]:
+    return [RaspberryPiImage.from_dict(image) for image in catalog["images"]]
+
+
+def fetch_image_list(
+    offline: bool = False, ttl: int = CATALOG_TTL
+) -> list[RaspberryPiImage]:
+    """Fetch Raspberry Pi OS images with cloud-init support
+
+    The filtered list is cached on disk. Within the TTL the cache is used as
+    is, after that it is revalidated with a conditional GET, and if the
+    network is down a stale cache is used rather than failing.
+
+    Args:
+        offline: Only use the cached list, never touch the network
+        ttl: Seconds before the cached list is revalidated
+
+    Returns:
+        List of dicts with: name, url, release_date, extract_size
+    """
+    catalog = _load_catalog()
+
+    if offline:
+        if catalog is None:
+            raise ConnectionError("No cached image list available offline")
+        return _catalog_images(catalog)
+
+    if catalog is not None and time.time() - catalog["fetched_at"] < ttl:
+        return _catalog_images(catalog)
+
+    headers = {}
+    if catalog is not None:
+        if catalog.get("etag"):
+            headers["If-None-Match"] = catalog["etag"]
+        if catalog.get("last_modified"):
+            headers["If-Modified-Since"] = catalog["last_modified"]
+
+    try:
+        response = requests.get(API_URL, headers=headers, timeout=CATALOG_TIMEOUT)
+        response.raise_for_status()
+
+        if response.status_code == 304 and catalog is not None:
+            catalog["fetched_at"] = time.time()
+            _save_catalog(catalog)
+            return _catalog_images(catalog)
+
+        images = _parse_image_list(response.json())
+    except Exception as e:
+        if catalog is not None:
+            console.print(
+                "[yellow]Could not refresh image list, using cached copy[/yellow]"
+            )
+            return _catalog_images(catalog)
+        raise ConnectionError(f"Failed to fetch image list: {e}") from None
+
+    _save_catalog(
+        {
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "fetched_at": time.time(),
+            "images": [asdict(image) for image in images],
+        }
+    )
+
+    return images
+
+
 def prompt_for_image(images: list[RaspberryPiImage]) -> RaspberryPiImage:
     """Prompt user to select an image
 
@@ -72,125 +160,374 @@ def prompt_for_image(images: list[RaspberryPiImage]) -> RaspberryPiImage:
     return selected
 
 
-def _extract_image(compressed_path: Path, expected_size: int) -> Path:
-    """Extract .xz compressed image
+def _extract_image(
+    compressed_path: Path,
+    expected_size: int,
+    output_path: Path | None = None,
+    decoder: str | None = None,
+) -> Path:
+    """Extract a compressed image with the fastest available decoder
 
     Args:
-        compressed_path: Path to .img.xz file
+        compressed_path: Path to .img.xz, .img.gz, .zip or .img.zst file
         expected_size: Expected uncompressed size (for progress)
+        output_path: Where to extract to, defaults to next to the download
+        decoder: Force a specific decoder backend by name
     """
-    uncompressed_path = Path(str(compressed_path).removesuffix(".xz"))
+    uncompressed_path = output_path or compressed_path.with_name(
+        strip_compression_suffix(compressed_path.name)
+    )
 
     if uncompressed_path.exists():
         console.print("[green]✓[/green] Using cached extracted image")
         return uncompressed_path
 
-    with Progress() as progress:
+    backend = select_decoder(compressed_path, decoder)
+
+    with Tracker() as progress:
         task = progress.add_task(
-            f"[magenta]Extracting[/magenta] {compressed_path.name}...",
+            f"[magenta]Extracting[/magenta] {compressed_path.name} "
+            f"[dim]({backend.name})[/dim]...",
             total=expected_size,
+            stage="extract",
+            target=compressed_path.name,
         )
 
-        bytes_written = 0
-        with (
-            lzma.open(compressed_path, "rb") as compressed_file,
-            open(uncompressed_path, "wb") as output,
-        ):
-            while True:
-                chunk = compressed_file.read(8192)
-                if not chunk:
-                    break
-                output.write(chunk)
-                bytes_written += len(chunk)
-                progress.update(task, completed=bytes_written)
+        with open(uncompressed_path, "wb") as output:
+            try:
+                for chunk in backend.iter_chunks(compressed_path):
+                    output.write(chunk)
+                    task.advance(len(chunk))
+            except BaseException:
+                output.close()
+                uncompressed_path.unlink(missing_ok=True)
+                raise
 
     return uncompressed_path
 
 
-def _verify_hash(file_path: Path, stored_hash: str) -> bool:
-    size = file_path.stat().st_size
-
-    calculated_hash = calculate_hash(
-        str(file_path.resolve()),
-        size=size,
-        text=f"[yellow]Verifying image[/yellow] {file_path.name}...",
+def _verify_hash(file_path: Path, stored_hash: str, name: str | None = None) -> bool:
+    calculated_hash = calculate_hash_memoized(
+        file_path.resolve(),
+        text=f"[yellow]Verifying image[/yellow] {name or file_path.name}...",
     )
 
     return calculated_hash == stored_hash
 
 
-def download_image(image: RaspberryPiImage) -> Path:
+def _stream_extract(
+    response: requests.Response, output_path: Path, expected_size: int
+) -> str:
+    """Decompress and hash an .xz HTTP response in a single pass
+
+    Chunks are fed straight from the socket into the LZMA decompressor and the
+    SHA256 hasher, so only the extracted image is ever written to disk.
+
+    Args:
+        response: Streaming response for the .img.xz file
+        output_path: Where to write the extracted image
+        expected_size: Expected uncompressed size (for progress)
+
+    Returns:
+        SHA256 hash of the extracted image as hex string
+    """
+    decompressor = lzma.LZMADecompressor()
+    hasher = hashlib.sha256()
+
+    with Tracker() as progress:
+        task = progress.add_task(
+            f"[cyan]Downloading & extracting[/cyan] {response.url.split('/')[-1]}...",
+            total=expected_size,
+            stage="download",
+            target=response.url.split("/")[-1],
+        )
+
+        with open(output_path, "wb") as output:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                data = decompressor.decompress(chunk)
+                if data:
+                    output.write(data)
+                    hasher.update(data)
+                    task.advance(len(data))
+
+    if not decompressor.eof:
+        raise ValueError(f"Truncated download: {response.url.split('/')[-1]}")
+
+    return hasher.hexdigest()
+
+
+def _download_streaming(image: RaspberryPiImage, extracted_path: Path) -> Path:
+    """Download, extract and verify an image in one pass without a .xz copy"""
+    partial_path = extracted_path.with_name(extracted_path.name + ".part")
+
+    try:
+        with requests.get(image.url, stream=True, timeout=STREAM_TIMEOUT) as response:
+            response.raise_for_status()
+            calculated_hash = _stream_extract(
+                response, partial_path, image.extract_size
+            )
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+
+    if calculated_hash != image.extract_sha256:
+        partial_path.unlink()
+        filename = image.url.split("/")[-1]
+        raise ValueError(f"Failed to verify image integrity: {filename}")
+
+    partial_path.replace(extracted_path)
+    remember_hash(extracted_path, calculated_hash)
+
+    return extracted_path
+
+
+def _prefetch(chunks: Iterable[bytes], depth: int = PREFETCH_CHUNKS) -> Iterator[bytes]:
+    """Pull chunks on a separate thread, at most depth ahead of the consumer"""
+    queue: Queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except BaseException as e:
+            put(e)
+        else:
+            put(end)
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item = queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is end:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _download_chunks(url: str, tee_path: Path) -> Iterator[bytes]:
+    """Yield a download chunk by chunk, keeping a copy at tee_path"""
+    with requests.get(url, stream=True, timeout=STREAM_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(tee_path, "wb") as tee:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if chunk:
+                    tee.write(chunk)
+                    yield chunk
+
+
+def _tee_decompress(url: str, tee_path: Path) -> Iterator[bytes]:
+    """Download and decompress an .xz image, keeping the compressed bytes
+
+    The download runs on its own thread a few chunks ahead, so network and
+    decompression overlap with whatever consumes the decompressed chunks.
+
+    Raises:
+        ValueError: If the download ends before the end of the .xz stream
+    """
+    decompressor = lzma.LZMADecompressor()
+
+    for chunk in _prefetch(_download_chunks(url, tee_path)):
+        data = decompressor.decompress(chunk, DECOMPRESS_LIMIT)
+        while True:
+            if data:
+                yield data
+            if decompressor.eof or decompressor.needs_input:
+                break
+            data = decompressor.decompress(b"", DECOMPRESS_LIMIT)
+
+    if not decompressor.eof:
+        raise ValueError(f"Truncated download: {url.split('/')[-1]}")
+
+
+@contextmanager
+def open_image_stream(image: RaspberryPiImage) -> Iterator[ImageStream]:
+    """Stream an image for flashing while it downloads, teeing it into the cache
+
+    The compressed download is written to the cache as it arrives and only
+    registered once it was read to the end and the flash consuming the stream
+    finished without error, which includes its SHA256 check. Otherwise the
+    partial copy is deleted, so a bad image never ends up in the cache.
+
+    Raises:
+        ValueError: If the image isn't an .xz file
+    """
+    filename = image.url.split("/")[-1]
+    if not filename.endswith(".xz"):
+        raise ValueError(
+            f"Only .xz images can be flashed while downloading: {filename}"
+        )
+
+    suffix = ".img.xz"
+    cache_path = cache.image_path(image.extract_sha256, suffix)
+    partial_path = cache_path.with_name(cache_path.name + ".part")
+    partial_path.parent.mkdir(parents=True, exist_ok=True)
+    complete = False
+
+    def chunks() -> Iterator[bytes]:
+        nonlocal complete
+        yield from _tee_decompress(image.url, partial_path)
+        complete = True
+
+    try:
+        yield ImageStream(filename, chunks(), image.extract_size)
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+
+    if not complete:
+        # Cancelled before anything was flashed
+        partial_path.unlink(missing_ok=True)
+        return
+
+    partial_path.replace(cache_path)
+    cache.register(
+        image.extract_sha256, filename, url=image.url, verified=True, suffix=suffix
+    )
+
+
+def download_image(
+    image: RaspberryPiImage,
+    stream: bool = False,
+    connections: int = DEFAULT_CONNECTIONS,
+    compressed: bool = False,
+) -> Path:
     """Download a Raspberry Pi OS image with caching and verification
 
     Args:
         image: The image to download
+        stream: Decompress and hash while downloading instead of keeping
+            the .xz file and re-reading the extracted image
+        connections: Parallel connections for resumable ranged downloads
+        compressed: Cache the download as is instead of extracting it. The
+            image is then decompressed and verified while flashing
 
     Returns:
-        Path to the downloaded image file
+        Path to the downloaded image file, compressed if compressed is set
 
     Raises:
         ValueError: If hash verification fails
     """
     filename = image.url.split("/")[-1]
+    extracted_name = strip_compression_suffix(filename)
 
-    cache_download_path = CACHE_DIR / filename
-    cache_extracted_path = CACHE_DIR / filename.replace(".xz", "")
+    cache_download_path = cache.download_path(filename)
+    cache_extracted_path = cache.image_path(image.extract_sha256)
+
+    cache.migrate_legacy_files()
 
     # TODO: prompt for latest version if available or use --latest flag
-    if cache_extracted_path.exists():
+    entry = cache.lookup(image.extract_sha256)
+    if entry and entry.suffix != ".img":
+        if compressed:
+            console.print(
+                f"[green]✓[/green] Using cached image: [cyan]{entry.filename}[/cyan]"
+            )
+            return entry.path
+
+        # Extract the compressed copy instead of downloading it again
+        entry.path.replace(cache_download_path)
+        cache.remove(image.extract_sha256)
+    elif entry:
+        # Free unless the file changed on disk since it was last hashed
+        if _verify_hash(cache_extracted_path, image.extract_sha256, extracted_name):
+            console.print(
+                f"[green]✓[/green] Using cached image: [cyan]{extracted_name}[/cyan]"
+            )
+            return cache_extracted_path
+
         console.print(
-            f"[green]✓[/green] Using cached image: [cyan]{filename.replace('.xz', '')}[/cyan]"
+            f"[yellow]Cached image {extracted_name} is corrupt, downloading again"
+            "[/yellow]"
         )
-        return cache_extracted_path
+        cache.remove(image.extract_sha256)
+
+    cache_extracted_path.parent.mkdir(parents=True, exist_ok=True)
 
     if cache_download_path.exists():
         console.print("[yellow]Found cached download, extracting...[/yellow]")
-        extracted_path = _extract_image(cache_download_path, image.extract_size)
-        if not _verify_hash(extracted_path, image.extract_sha256):
-            extracted_path.unlink()
-            cache_download_path.unlink()
-            raise ValueError(f"Failed to verify image integrity: {filename}")
-        cache_download_path.unlink()
-        return extracted_path
-
-    console.print(
-        Panel(
-            f"[bold]{image.name}[/bold]\n"
-            f"Size: {image.image_download_size / (1024**2):.1f} MB\n"
-            f"Release: {image.release_date}",
-            title="Downloading",
-            border_style="cyan",
+    else:
+        console.print(
+            Panel(
+                f"[bold]{image.name}[/bold]\n"
+                f"Size: {image.image_download_size / (1024**2):.1f} MB\n"
+                f"Release: {image.release_date}",
+                title="Downloading",
+                border_style="cyan",
+            )
         )
-    )
 
-    with requests.get(image.url, stream=True) as response:
-        response.raise_for_status()
-        total = int(response.headers.get("content-length", 0))
+        if stream and filename.endswith(".xz"):
+            cache_path = _download_streaming(image, cache_extracted_path)
+            cache.register(
+                image.extract_sha256, extracted_name, url=image.url, verified=True
+            )
+            console.print(f"[green]✓ Download complete:[/green] {filename}")
+            return cache_path
 
-        with Progress() as progress:
+        with Tracker() as progress:
             task = progress.add_task(
-                f"[cyan]Downloading[/cyan] {filename}...", total=total
+                f"[cyan]Downloading[/cyan] {filename}...",
+                total=image.image_download_size,
+                stage="download",
+                target=filename,
             )
 
-            try:
-                with open(cache_download_path, "wb") as file:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            file.write(chunk)
-                            progress.update(task, advance=len(chunk))
-            except Exception:
-                if cache_download_path.exists():
-                    cache_download_path.unlink()
-                raise
+            def on_total(total: int, completed: int) -> None:
+                task.update(total=total, completed=completed)
 
-        cache_path = _extract_image(cache_download_path, image.extract_size)
+            def on_progress(advance: int) -> None:
+                task.advance(advance)
+
+            download_ranged(
+                image.url,
+                cache_download_path,
+                connections=connections,
+                on_total=on_total,
+                on_progress=on_progress,
+            )
 
-        if not _verify_hash(cache_path, image.extract_sha256):
-            cache_path.unlink()
-            cache_download_path.unlink()
-            raise ValueError(f"Failed to verify image integrity: {filename}")
+    if compressed and filename != extracted_name:
+        suffix = ".img" + Path(filename).suffix
+        cache_path = cache.image_path(image.extract_sha256, suffix)
+        cache_download_path.replace(cache_path)
+        # Verified once it has been decompressed while flashing
+        cache.register(image.extract_sha256, filename, url=image.url, suffix=suffix)
+        console.print(f"[green]✓ Download complete:[/green] {filename}")
+        return cache_path
+
+    cache_path = _extract_image(
+        cache_download_path, image.extract_size, output_path=cache_extracted_path
+    )
+
+    if not _verify_hash(cache_path, image.extract_sha256, name=extracted_name):
+        cache_path.unlink()
+        cache_download_path.unlink()
+        raise ValueError(f"Failed to verify image integrity: {filename}")
 
     cache_download_path.unlink()
+    cache.register(image.extract_sha256, extracted_name, url=image.url, verified=True)
 
     console.print(f"[green]✓ Download complete:[/green] {filename}")
 
@@ -0,0 +1,464 @@
+"""Minimal FAT16/FAT32 writer for the boot partition
+
+Writes files into the root directory of the ``bootfs`` partition of an image
+or block device by offset, so cloud-init files can be injected without the
+OS mounting anything. Existing files are replaced in place; new files get a
+long file name and a generated 8.3 alias.
+"""
+
+import argparse
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+from src.imaging.bmap import FAT_PARTITION_TYPES, read_partitions
+
+BOOT_LABEL = "BOOTFS"
+
+DIR_ENTRY_SIZE = 32
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+LFN_LAST = 0x40
+LFN_CHARS = 13
+DELETED = 0xE5
+
+FSINFO_LEAD_SIGNATURE = b"RRaA"
+FSINFO_SIGNATURE = b"rrAa"
+
+NT_LOWER_BASE = 0x08
+NT_LOWER_EXT = 0x10
+
+SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+
+
+def _lfn_checksum(short_name: bytes) -> int:
+    checksum = 0
+    for byte in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    return checksum
+
+
+def _dos_timestamp(timestamp: float) -> tuple[int, int]:
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def _short_name_text(raw: bytes, nt_flags: int) -> str:
+    base = raw[:8].decode("ascii", errors="replace").rstrip()
+    ext = raw[8:11].decode("ascii", errors="replace").rstrip()
+    if nt_flags & NT_LOWER_BASE:
+        base = base.lower()
+    if nt_flags & NT_LOWER_EXT:
+        ext = ext.lower()
+    return f"{base}.{ext}" if ext else base
+
+
+class DirEntry:
+    def __init__(self, slots: list[int], raw: bytearray, name: str):
+        self.slots = slots  # indexes of the LFN slots followed by the short slot
+        self.raw = raw
+        self.name = name
+
+    @property
+    def first_cluster(self) -> int:
+        (high,) = struct.unpack_from("<H", self.raw, 20)
+        (low,) = struct.unpack_from("<H", self.raw, 26)
+        return high << 16 | low
+
+
+def _find(entries: list[DirEntry], name: str) -> DirEntry | None:
+    return next((e for e in entries if e.name.lower() == name.lower()), None)
+
+
+class FatVolume:
+    """A FAT16 or FAT32 filesystem starting at offset within f"""
+
+    def __init__(self, f: BinaryIO, offset: int):
+        self.f = f
+        self.offset = offset
+
+        f.seek(offset)
+        bpb = f.read(512)
+        if len(bpb) < 512 or bpb[510:512] != b"\x55\xaa":
+            raise ValueError("No FAT boot sector found")
+
+        (
+            self.bytes_per_sector,
+            self.sectors_per_cluster,
+            reserved,
+            self.num_fats,
+            root_entries,
+        ) = struct.unpack_from("<HBHBH", bpb, 11)
+        total_sectors = (
+            struct.unpack_from("<H", bpb, 19)[0] or struct.unpack_from("<I", bpb, 32)[0]
+        )
+        fat_sectors16 = struct.unpack_from("<H", bpb, 22)[0]
+        fat_sectors = fat_sectors16 or struct.unpack_from("<I", bpb, 36)[0]
+
+        if not self.bytes_per_sector or not self.sectors_per_cluster:
+            raise ValueError("Invalid FAT boot sector")
+
+        root_sectors = -(-root_entries * DIR_ENTRY_SIZE // self.bytes_per_sector)
+        data_start = reserved + self.num_fats * fat_sectors + root_sectors
+        self.cluster_count = (total_sectors - data_start) // self.sectors_per_cluster
+
+        if self.cluster_count < 4085:
+            raise ValueError("FAT12 is not supported")
+
+        self.fat32 = self.cluster_count >= 65525
+        self.cluster_size = self.sectors_per_cluster * self.bytes_per_sector
+        self.fat_offset = offset + reserved * self.bytes_per_sector
+        self.fat_size = fat_sectors * self.bytes_per_sector
+        self.data_offset = offset + data_start * self.bytes_per_sector
+
+        if self.fat32:
+            self.entry_format, self.mask, self.eoc = "<I", 0x0FFFFFFF, 0x0FFFFFF8
+            self.root_cluster = struct.unpack_from("<I", bpb, 44)[0]
+            self.fsinfo_sector = struct.unpack_from("<H", bpb, 48)[0]
+            self.label = bpb[71:82].decode("ascii", errors="replace").strip()
+            self.root_offset = None
+        else:
+            self.entry_format, self.mask, self.eoc = "<H", 0xFFFF, 0xFFF8
+            self.root_cluster = None
+            self.fsinfo_sector = 0
+            self.label = bpb[43:54].decode("ascii", errors="replace").strip()
+            self.root_offset = self.fat_offset + self.num_fats * self.fat_size
+            self.root_size = root_sectors * self.bytes_per_sector
+
+        self.entry_size = struct.calcsize(self.entry_format)
+
+        f.seek(self.fat_offset)
+        self.fat = bytearray(f.read(self.fat_size))
+        self._next_free = 2
+
+    # FAT table
+
+    def _get(self, cluster: int) -> int:
+        position = cluster * self.entry_size
+        (value,) = struct.unpack_from(self.entry_format, self.fat, position)
+        return value & self.mask
+
+    def _set(self, cluster: int, value: int) -> None:
+        position = cluster * self.entry_size
+        if self.fat32:
+            # The top four bits are reserved and must be preserved
+            current = struct.unpack_from("<I", self.fat, position)[0]
+            value = (current & 0xF0000000) | (value & self.mask)
+        struct.pack_into(self.entry_format, self.fat, position, value)
+
+    def chain(self, start: int) -> list[int]:
+        clusters = []
+        cluster = start
+        while 2 <= cluster < self.eoc and len(clusters) <= self.cluster_count:
+            clusters.append(cluster)
+            cluster = self._get(cluster)
+        return clusters
+
+    def free_chain(self, start: int) -> None:
+        for cluster in self.chain(start):
+            self._set(cluster, 0)
+            self._next_free = min(self._next_free, cluster)
+
+    def allocate(self, count: int) -> list[int]:
+        clusters = []
+        cluster = self._next_free
+        last = self.cluster_count + 2
+
+        while len(clusters) < count and cluster < last:
+            if self._get(cluster) == 0:
+                clusters.append(cluster)
+            cluster += 1
+
+        if len(clusters) < count:
+            raise RuntimeError("Not enough free space in boot partition")
+
+        for current, following in zip(clusters, clusters[1:], strict=False):
+            self._set(current, following)
+        if clusters:
+            self._set(clusters[-1], self.mask)
+
+        self._next_free = cluster
+        return clusters
+
+    def _cluster_offset(self, cluster: int) -> int:
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    # Root directory
+
+    def _root_regions(self) -> list[tuple[int, int]]:
+        """(offset, size) of every region that makes up the root directory"""
+        if self.root_offset is not None:
+            return [(self.root_offset, self.root_size)]
+        return [
+            (self._cluster_offset(cluster), self.cluster_size)
+            for cluster in self.chain(self.root_cluster)
+        ]
+
+    def _read_root(self) -> bytearray:
+        data = bytearray()
+        for offset, size in self._root_regions():
+            self.f.seek(offset)
+            data += self.f.read(size)
+        return data
+
+    def _write_root(self, data: bytearray) -> None:
+        position = 0
+        for offset, size in self._root_regions():
+            self.f.seek(offset)
+            self.f.write(data[position : position + size])
+            position += size
+
+    def _entries(self, root: bytearray) -> list[DirEntry]:
+        entries = []
+        lfn_slots: list[int] = []
+        lfn_parts: dict[int, str] = {}
+
+        for slot in range(len(root) // DIR_ENTRY_SIZE):
+            raw = root[slot * DIR_ENTRY_SIZE : (slot + 1) * DIR_ENTRY_SIZE]
+            if raw[0] == 0x00:
+                break
+            if raw[0] == DELETED:
+                lfn_slots, lfn_parts = [], {}
+                continue
+
+            if raw[11] == ATTR_LONG_NAME:
+                chars = raw[1:11] + raw[14:26] + raw[28:32]
+                text = chars.decode("utf-16-le", errors="replace")
+                lfn_parts[raw[0] & 0x1F] = text.split("\x00")[0]
+                lfn_slots.append(slot)
+                continue
+
+            name = (
+                "".join(lfn_parts[i] for i in sorted(lfn_parts))
+                if lfn_parts
+                else _short_name_text(raw[:11], raw[12])
+            )
+            entries.append(DirEntry([*lfn_slots, slot], bytearray(raw), name))
+            lfn_slots, lfn_parts = [], {}
+
+        return entries
+
+    def volume_label(self) -> str:
+        for entry in self._entries(self._read_root()):
+            if entry.raw[11] & ATTR_VOLUME_ID and entry.raw[11] != ATTR_LONG_NAME:
+                return entry.raw[:11].decode("ascii", errors="replace").strip()
+        return self.label
+
+    def _short_name(self, name: str, existing: set[bytes]) -> bytes:
+        base, _, ext = name.upper().rpartition(".")
+        if not base:
+            base, ext = ext, ""
+        base = "".join(c for c in base if c in SHORT_NAME_CHARS)
+        ext = "".join(c for c in ext if c in SHORT_NAME_CHARS)[:3]
+
+        for n in range(1, 1000):
+            suffix = f"~{n}"
+            candidate = (base[: 8 - len(suffix)] + suffix).ljust(8) + ext.ljust(3)
+            encoded = candidate.encode("ascii")
+            if encoded not in existing:
+                return encoded
+
+        raise RuntimeError(f"Could not generate a short name for {name}")
+
+    def _new_entry_slots(self, name: str, short_name: bytes) -> list[bytes]:
+        encoded = name.encode("utf-16-le")
+        units = [encoded[i : i + 2] for i in range(0, len(encoded), 2)]
+        count = -(-len(units) // LFN_CHARS)
+        units += [b"\x00\x00"] + [b"\xff\xff"] * (count * LFN_CHARS)
+        checksum = _lfn_checksum(short_name)
+
+        slots = []
+        for index in range(count, 0, -1):
+            part = units[(index - 1) * LFN_CHARS : index * LFN_CHARS]
+            raw = bytearray(DIR_ENTRY_SIZE)
+            raw[0] = index | (LFN_LAST if index == count else 0)
+            raw[1:11] = b"".join(part[0:5])
+            raw[11] = ATTR_LONG_NAME
+            raw[13] = checksum
+            raw[14:26] = b"".join(part[5:11])
+            raw[28:32] = b"".join(part[11:13])
+            slots.append(bytes(raw))
+
+        return slots
+
+    def _find_free_slots(self, root: bytearray, count: int) -> int | None:
+        run_start, run = None, 0
+        for slot in range(len(root) // DIR_ENTRY_SIZE):
+            if root[slot * DIR_ENTRY_SIZE] in (0x00, DELETED):
+                run_start = slot if run == 0 else run_start
+                run += 1
+                if run == count:
+                    return run_start
+            else:
+                run = 0
+        return None
+
+    def _grow_root(self) -> None:
+        if self.root_cluster is None:
+            raise RuntimeError("Root directory of boot partition is full")
+
+        last = self.chain(self.root_cluster)[-1]
+        (cluster,) = self.allocate(1)
+        self._set(last, cluster)
+
+        self.f.seek(self._cluster_offset(cluster))
+        self.f.write(bytes(self.cluster_size))
+
+    def write_file(self, name: str, data: bytes) -> None:
+        """Create or replace a file in the root directory"""
+        root = self._read_root()
+        entries = self._entries(root)
+        existing = _find(entries, name)
+
+        if existing is not None and existing.raw[11] & ATTR_DIRECTORY:
+            raise ValueError(f"{name} is a directory in the boot partition")
+
+        if existing is not None and existing.first_cluster:
+            self.free_chain(existing.first_cluster)
+
+        clusters = self.allocate(-(-len(data) // self.cluster_size))
+        for index, cluster in enumerate(clusters):
+            chunk = data[index * self.cluster_size : (index + 1) * self.cluster_size]
+            self.f.seek(self._cluster_offset(cluster))
+            self.f.write(chunk.ljust(self.cluster_size, b"\x00"))
+
+        dos_time, dos_date = _dos_timestamp(time.time())
+        first_cluster = clusters[0] if clusters else 0
+
+        if existing is not None:
+            raw = existing.raw
+            slot = existing.slots[-1]
+        else:
+            short_names = {bytes(e.raw[:11]) for e in entries}
+            short_name = self._short_name(name, short_names)
+            lfn_slots = self._new_entry_slots(name, short_name)
+
+            start = self._find_free_slots(root, len(lfn_slots) + 1)
+            while start is None:
+                self._grow_root()
+                root = self._read_root()
+                start = self._find_free_slots(root, len(lfn_slots) + 1)
+
+            for index, lfn in enumerate(lfn_slots):
+                position = (start + index) * DIR_ENTRY_SIZE
+                root[position : position + DIR_ENTRY_SIZE] = lfn
+
+            raw = bytearray(DIR_ENTRY_SIZE)
+            raw[:11] = short_name
+            raw[11] = ATTR_ARCHIVE
+            struct.pack_into("<HH", raw, 14, dos_time, dos_date)
+            struct.pack_into("<H", raw, 16, dos_date)
+            slot = start + len(lfn_slots)
+
+        struct.pack_into("<H", raw, 18, dos_date)
+        struct.pack_into("<H", raw, 20, first_cluster >> 16)
+        struct.pack_into("<HH", raw, 22, dos_time, dos_date)
+        struct.pack_into("<H", raw, 26, first_cluster & 0xFFFF)
+        struct.pack_into("<I", raw, 28, len(data))
+
+        position = slot * DIR_ENTRY_SIZE
+        root[position : position + DIR_ENTRY_SIZE] = raw
+        self._write_root(root)
+
+    def read_file(self, name: str) -> bytes:
+        entry = _find(self._entries(self._read_root()), name)
+        if entry is None:
+            raise FileNotFoundError(name)
+
+        size = struct.unpack_from("<I", entry.raw, 28)[0]
+        data = bytearray()
+        for cluster in self.chain(entry.first_cluster):
+            self.f.seek(self._cluster_offset(cluster))
+            data += self.f.read(self.cluster_size)
+        return bytes(data[:size])
+
+    def flush(self) -> None:
+        """Write the FAT back to every copy and invalidate the FSInfo hints"""
+        for index in range(self.num_fats):
+            self.f.seek(self.fat_offset + index * self.fat_size)
+            self.f.write(self.fat)
+
+        if self.fat32 and self.fsinfo_sector not in (0, 0xFFFF):
+            self._invalidate_fsinfo()
+
+        self.f.flush()
+
+    def _invalidate_fsinfo(self) -> None:
+        # Raw devices (e.g. macOS /dev/rdisk*) only take whole sectors, so the
+        # two fields are updated by rewriting the sector they're in
+        sector_offset = self.offset + self.fsinfo_sector * self.bytes_per_sector
+        self.f.seek(sector_offset)
+        sector = bytearray(self.f.read(self.bytes_per_sector))
+        if sector[0:4] != FSINFO_LEAD_SIGNATURE or sector[484:488] != FSINFO_SIGNATURE:
+            return
+
+        # 0xFFFFFFFF means unknown, the OS recomputes free space on mount
+        struct.pack_into("<II", sector, 488, 0xFFFFFFFF, 0xFFFFFFFF)
+        self.f.seek(sector_offset)
+        self.f.write(sector)
+
+
+def open_boot_partition(f: BinaryIO) -> FatVolume:
+    """Find the bootfs FAT partition from the MBR, or the first FAT partition"""
+    partitions = read_partitions(f)
+    if partitions is None:
+        raise ValueError("No MBR partition table found")
+
+    volumes = []
+    for part_type, start, _end in partitions:
+        if part_type not in FAT_PARTITION_TYPES:
+            continue
+        try:
+            volume = FatVolume(f, start)
+        except ValueError:
+            continue
+        if volume.volume_label().upper() == BOOT_LABEL:
+            return volume
+        volumes.append(volume)
+
+    if not volumes:
+        raise RuntimeError("Boot partition not found")
+
+    return volumes[0]
+
+
+def write_boot_files(target: str | Path, files: dict[str, str | bytes]) -> None:
+    """Write files into the root of the boot partition of an image or device
+
+    Args:
+        target: Disk image or block device (not a raw character device)
+        files: File name to contents
+    """
+    with open(target, "r+b", buffering=0) as f:
+        volume = open_boot_partition(f)
+        for name, content in files.items():
+            data = content.encode() if isinstance(content, str) else content
+            volume.write_file(name, data)
+        volume.flush()
+        os.fsync(f.fileno())
+
+
+def main() -> None:
+    """Privileged helper: copy files from a directory into the boot partition"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("target")
+    parser.add_argument("source_dir")
+    args = parser.parse_args()
+
+    files = {
+        path.name: path.read_bytes()
+        for path in sorted(Path(args.source_dir).iterdir())
+        if path.is_file()
+    }
+    write_boot_files(args.target, files)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,10 @@
+from collections.abc import Callable
 from pathlib import Path
 
 from InquirerPy import inquirer
 
+from src.imaging import cache
+from src.imaging.writer import ImageHashError, ImageStream
 from src.platform import get_platform_handler
 from src.platform.models import ExternalDevice
 
@@ -27,6 +30,95 @@ def prompt_for_device(devices: list[ExternalDevice]) -> ExternalDevice:
     return selected
 
 
-def flash_device(image_path: Path, device: ExternalDevice):
+def prompt_for_devices(
+    devices: list[ExternalDevice], limit: int | None = None
+) -> list[ExternalDevice]:
+    if not devices:
+        raise ValueError("No devices found for selection")
+
+    choices = [
+        {"name": f"{dev.node} | {dev.name} | {dev.size}", "value": dev}
+        for dev in devices
+    ]
+
+    selected = inquirer.checkbox(
+        message="Select devices (space to toggle)",
+        choices=choices,
+        validate=lambda result: 0 < len(result) <= (limit or len(devices)),
+        invalid_message=f"Select between 1 and {limit or len(devices)} devices",
+    ).execute()
+
+    return selected
+
+
+def _flash_cached(sha256: str | None, flash: Callable[[], bool]) -> bool:
+    """Run flash, keeping the cache entry of a compressed image in step
+
+    An image whose decompressed contents didn't match sha256 is dropped from
+    the cache, one that did is marked verified.
+    """
+    try:
+        flashed = flash()
+    except ImageHashError:
+        if sha256:
+            cache.remove(sha256)
+        raise
+
+    if flashed and sha256:
+        cache.mark_verified(sha256)
+    return flashed
+
+
+def flash_device(
+    image_path: Path,
+    device: ExternalDevice,
+    bmap: bool = False,
+    verify: bool = False,
+    sha256: str | None = None,
+) -> bool:
+    platform = get_platform_handler()
+    return _flash_cached(
+        sha256,
+        lambda: platform.flash_image(
+            str(image_path.resolve()),
+            device.node,
+            verify=verify,
+            bmap=bmap,
+            sha256=sha256,
+        ),
+    )
+
+
+def flash_devices(
+    image_path: Path,
+    devices: list[ExternalDevice],
+    verify: bool = False,
+    sha256: str | None = None,
+) -> bool:
+    platform = get_platform_handler()
+    return _flash_cached(
+        sha256,
+        lambda: platform.flash_images(
+            str(image_path.resolve()),
+            [device.node for device in devices],
+            verify=verify,
+            sha256=sha256,
+        ),
+    )
+
+
+def flash_stream(
+    stream: ImageStream,
+    devices: list[ExternalDevice],
+    verify: bool = False,
+    sha256: str | None = None,
+) -> bool:
+    """Flash an image while it's being produced, see open_image_stream"""
     platform = get_platform_handler()
-    platform.flash_image(str(image_path.resolve()), device.node)
+    return platform.flash_images(
+        stream.name,
+        [device.node for device in devices],
+        verify=verify,
+        sha256=sha256,
+        stream=stream,
+    )
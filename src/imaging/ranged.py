@@ -0,0 +1,234 @@
+import contextlib
+import json
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import requests
+
+DEFAULT_CONNECTIONS = 4
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024  # 16MB segments
+READ_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+# (connect, read) seconds for image downloads, a stalled mirror fails instead of
+# hanging the download or the flash that streams from it
+STREAM_TIMEOUT = (10, 30)
+
+
+@dataclass
+class ResumeJournal:
+    """On-disk record of which segments of a .part file are complete"""
+
+    url: str
+    size: int
+    segment_size: int
+    etag: str | None = None
+    done: list[int] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: Path) -> "ResumeJournal | None":
+        try:
+            return cls(**json.loads(path.read_text()))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(asdict(self)))
+        tmp_path.replace(path)
+
+    def matches(self, url: str, size: int, etag: str | None) -> bool:
+        return self.url == url and self.size == size and self.etag == etag
+
+
+def _probe(session: requests.Session, url: str) -> tuple[str, int, str | None, bool]:
+    """Return (final url, size, etag, supports_ranges) for url
+
+    The final url is the one left after following redirects. Mirrors behind a
+    redirector hand out different ETags, so every segment must come from it.
+    """
+    response = session.head(url, allow_redirects=True, timeout=STREAM_TIMEOUT)
+    response.raise_for_status()
+
+    size = int(response.headers.get("content-length", 0))
+    etag = response.headers.get("etag")
+    ranged = response.headers.get("accept-ranges", "").lower() == "bytes"
+
+    return response.url, size, etag, ranged and size > 0
+
+
+def _preallocate(path: Path, size: int) -> None:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+            # Not supported by every filesystem, a sparse file is fine too
+            if hasattr(os, "posix_fallocate"):
+                with contextlib.suppress(OSError):
+                    os.posix_fallocate(fd, 0, size)
+    finally:
+        os.close(fd)
+
+
+def _download_single(
+    session: requests.Session,
+    url: str,
+    destination: Path,
+    on_progress: Callable[[int], None] | None,
+) -> None:
+    """Fallback for servers without Range support"""
+    partial_path = destination.with_name(destination.name + ".part")
+
+    with session.get(url, stream=True, timeout=STREAM_TIMEOUT) as response:
+        response.raise_for_status()
+        try:
+            with open(partial_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=READ_CHUNK_SIZE):
+                    if chunk:
+                        file.write(chunk)
+                        if on_progress:
+                            on_progress(len(chunk))
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+
+    partial_path.replace(destination)
+
+
+def download_ranged(
+    url: str,
+    destination: Path,
+    connections: int = DEFAULT_CONNECTIONS,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    on_total: Callable[[int, int], None] | None = None,
+    on_progress: Callable[[int], None] | None = None,
+) -> Path:
+    """Download url into destination using parallel HTTP Range requests
+
+    Segments are written into a preallocated ``.part`` file and recorded in a
+    ``.part.json`` journal as they complete, so an interrupted download picks
+    up where it stopped on the next call.
+
+    Args:
+        url: URL to download
+        destination: Final path of the downloaded file
+        connections: Number of concurrent connections
+        segment_size: Bytes requested per Range request
+        on_total: Called once with (total size, bytes already on disk)
+        on_progress: Called with the number of bytes written per chunk
+
+    Returns:
+        Path to the downloaded file
+    """
+    partial_path = destination.with_name(destination.name + ".part")
+    journal_path = destination.with_name(destination.name + ".part.json")
+
+    with requests.Session() as session:
+        source, size, etag, ranged = _probe(session, url)
+
+        if not ranged:
+            if on_total:
+                on_total(size, 0)
+            _download_single(session, source, destination, on_progress)
+            return destination
+
+    journal = ResumeJournal.load(journal_path)
+    if (
+        journal is None
+        or not journal.matches(source, size, etag)
+        or not partial_path.exists()
+    ):
+        partial_path.unlink(missing_ok=True)
+        journal = ResumeJournal(
+            url=source, size=size, segment_size=segment_size, etag=etag
+        )
+
+    segments = [
+        (index, offset, min(offset + journal.segment_size, size))
+        for index, offset in enumerate(range(0, size, journal.segment_size))
+    ]
+    done = set(journal.done)
+    pending = [segment for segment in segments if segment[0] not in done]
+
+    if on_total:
+        on_total(size, sum(end - start for i, start, end in segments if i in done))
+
+    _preallocate(partial_path, size)
+    journal.save(journal_path)
+
+    journal_lock = threading.Lock()
+    stop = threading.Event()
+    local = threading.local()
+    sessions: list[requests.Session] = []
+
+    def fetch_segment(fd: int, index: int, start: int, end: int) -> None:
+        if stop.is_set():
+            return
+
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            with journal_lock:
+                sessions.append(local.session)
+
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        # Weak ETags aren't allowed in If-Range (RFC 9110), the journal still
+        # restarts a download whose ETag changed between runs
+        if etag and not etag.startswith("W/"):
+            headers["If-Range"] = etag
+
+        with local.session.get(
+            source, headers=headers, stream=True, timeout=STREAM_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                if etag and response.headers.get("etag") != etag:
+                    raise RuntimeError(
+                        f"{source} changed on the server, download it again"
+                    )
+                raise RuntimeError(f"Server ignored Range request for {source}")
+
+            offset = start
+            for chunk in response.iter_content(chunk_size=READ_CHUNK_SIZE):
+                if stop.is_set():
+                    return
+                if not chunk:
+                    continue
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                if on_progress:
+                    on_progress(len(chunk))
+
+        if offset != end:
+            raise RuntimeError(f"Short read for bytes {start}-{end - 1} of {source}")
+
+        with journal_lock:
+            journal.done.append(index)
+            journal.save(journal_path)
+
+    fd = os.open(partial_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [
+                executor.submit(fetch_segment, fd, index, start, end)
+                for index, start, end in pending
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        for session in sessions:
+            session.close()
+
+    partial_path.replace(destination)
+    journal_path.unlink(missing_ok=True)
+
+    return destination
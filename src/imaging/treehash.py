@@ -0,0 +1,169 @@
+"""Parallel SHA-256 tree hashing of images
+
+A single reader fills a few large buffers with ``readinto``. Each buffer is
+fed to one thread computing the plain, linear SHA-256 that image catalogs
+publish, while its fixed-size chunks are hashed across a thread pool. hashlib
+releases the GIL on large inputs, so the chunk digests come almost for free
+next to the linear hash and nothing is read twice.
+
+The chunk digests are the same records the writers produce, so a file can
+later be checked against them in parallel with ``verify_target``, starting at
+any chunk and reporting the offset of the first one that differs. A Merkle
+root over them identifies the whole set.
+"""
+
+import hashlib
+import os
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from src.imaging.verify import ChunkDigest, chunk_digest
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024  # 16MB reads
+DEFAULT_BUFFER_COUNT = 4
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Domain separation so an interior node can never pass for a chunk digest
+NODE_PREFIX = b"\x01"
+
+
+@dataclass
+class TreeHash:
+    sha256: str
+    chunk_size: int
+    chunks: list[ChunkDigest]
+
+    @property
+    def size(self) -> int:
+        return sum(chunk.length for chunk in self.chunks)
+
+    @property
+    def root(self) -> str:
+        return merkle_root([chunk.digest for chunk in self.chunks]).hex()
+
+    def to_dict(self) -> dict:
+        return {
+            "sha256": self.sha256,
+            "chunk_size": self.chunk_size,
+            "chunks": [chunk.digest.hex() for chunk in self.chunks],
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TreeHash":
+        chunk_size, size = data["chunk_size"], data["size"]
+        chunks = [
+            ChunkDigest(
+                index * chunk_size,
+                min(chunk_size, size - index * chunk_size),
+                bytes.fromhex(digest),
+            )
+            for index, digest in enumerate(data["chunks"])
+        ]
+        return cls(data["sha256"], chunk_size, chunks)
+
+
+def merkle_root(digests: list[bytes]) -> bytes:
+    """Hash digests pairwise up to a single root, carrying odd ones up a level"""
+    if not digests:
+        return hashlib.sha256().digest()
+
+    level = digests
+    while len(level) > 1:
+        level = [
+            hashlib.sha256(NODE_PREFIX + b"".join(level[i : i + 2])).digest()
+            if i + 1 < len(level)
+            else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+def _read_full(f, view: memoryview) -> int:
+    """readinto until view is full or the file ends"""
+    filled = 0
+    while filled < len(view):
+        read = f.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def tree_hash(
+    path: str | Path,
+    size: int | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    on_progress: Callable[[int], None] | None = None,
+) -> TreeHash:
+    """Hash a file or device linearly and per chunk in one read
+
+    Args:
+        path: Path to file or device
+        size: Number of bytes to read (None = until the end)
+        chunk_size: Bytes per chunk digest
+        buffer_size: Bytes per read, rounded down to whole chunks
+        workers: Threads hashing chunks
+        on_progress: Called with the number of bytes read per buffer
+
+    Returns:
+        The linear SHA256 and the digest of every chunk
+    """
+    buffer_size = max(buffer_size // chunk_size, 1) * chunk_size
+    free = [bytearray(buffer_size) for _ in range(DEFAULT_BUFFER_COUNT)]
+    # Buffers being hashed, with the linear update first and then its chunks
+    pending: deque[tuple[bytearray, list[Future]]] = deque()
+
+    linear = hashlib.sha256()
+    chunks: list[ChunkDigest] = []
+    offset = 0
+
+    with (
+        open(path, "rb", buffering=0) as f,
+        ThreadPoolExecutor(max_workers=1) as sequential,
+        ThreadPoolExecutor(max_workers=max(workers, 1)) as pool,
+    ):
+
+        def finish_oldest() -> None:
+            buffer, futures = pending.popleft()
+            futures[0].result()
+            chunks.extend(future.result() for future in futures[1:])
+            free.append(buffer)
+
+        while size is None or offset < size:
+            if not free:
+                finish_oldest()
+
+            buffer = free.pop()
+            wanted = buffer_size if size is None else min(buffer_size, size - offset)
+            read = _read_full(f, memoryview(buffer)[:wanted])
+            if not read:
+                free.append(buffer)
+                break
+
+            data = memoryview(buffer)[:read]
+            futures = [sequential.submit(linear.update, data)]
+            futures += [
+                pool.submit(
+                    chunk_digest, offset + start, data[start : start + chunk_size]
+                )
+                for start in range(0, read, chunk_size)
+            ]
+            pending.append((buffer, futures))
+
+            offset += read
+            if on_progress:
+                on_progress(read)
+            if read < wanted:
+                break
+
+        while pending:
+            finish_oldest()
+
+    return TreeHash(linear.hexdigest(), chunk_size, chunks)
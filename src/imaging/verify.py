@@ -0,0 +1,142 @@
+"""Post-flash verification against chunk digests recorded while writing
+
+The writers hash every chunk as it goes out, so verifying a card only costs
+one read of the device: chunks are read back in parallel, hashed and compared
+against the recorded digests.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+ALIGNMENT = 4096
+DEFAULT_WORKERS = 4
+
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+
+
+@dataclass
+class ChunkDigest:
+    offset: int
+    length: int
+    digest: bytes
+
+
+def chunk_digest(offset: int, data: memoryview | bytes) -> ChunkDigest:
+    return ChunkDigest(offset, len(data), hashlib.sha256(data).digest())
+
+
+def _open_source(path: str) -> int:
+    """Open for reading, bypassing the page cache so we see what hit the card"""
+    if O_DIRECT:
+        try:
+            return os.open(path, os.O_RDONLY | O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, os.O_RDONLY)
+
+
+def _first_difference(source: Path, target: str, offset: int, length: int) -> int:
+    """Narrow a mismatching chunk down to the first differing byte"""
+    with open(source, "rb") as s, open(target, "rb") as t:
+        s.seek(offset)
+        t.seek(offset)
+        expected = s.read(length)
+        actual = t.read(length)
+
+    for index, (a, b) in enumerate(zip(expected, actual, strict=False)):
+        if a != b:
+            return offset + index
+
+    return offset + min(len(expected), len(actual))
+
+
+def verify_target(
+    target: str,
+    digests: list[ChunkDigest],
+    source: Path | None = None,
+    workers: int = DEFAULT_WORKERS,
+    on_progress: Callable[[int], None] | None = None,
+) -> int | None:
+    """Read target back in parallel and compare it against recorded digests
+
+    Args:
+        target: Block device or regular file that was written
+        digests: Chunk digests recorded while writing
+        source: Original image, used to pinpoint the exact mismatching byte
+        workers: Number of concurrent readers
+        on_progress: Called with the number of bytes verified per chunk
+
+    Returns:
+        Offset of the first mismatching byte, or None if everything matches
+    """
+    if not digests:
+        return None
+
+    max_length = max(d.length for d in digests)
+    buffer_size = -(-max_length // ALIGNMENT) * ALIGNMENT
+
+    def check(chunk: ChunkDigest) -> int | None:
+        fd = _open_source(target)
+        # Anonymous mmaps are page aligned, as O_DIRECT requires
+        buffer = mmap.mmap(-1, buffer_size)
+        try:
+            aligned = -(-chunk.length // ALIGNMENT) * ALIGNMENT
+            with memoryview(buffer) as view:
+                read = os.preadv(fd, [view[:aligned]], chunk.offset)
+                matches = (
+                    read >= chunk.length
+                    and hashlib.sha256(view[: chunk.length]).digest() == chunk.digest
+                )
+        finally:
+            buffer.close()
+            os.close(fd)
+
+        if on_progress:
+            on_progress(chunk.length)
+
+        return None if matches else chunk.offset
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        mismatches = [
+            offset for offset in executor.map(check, digests) if offset is not None
+        ]
+
+    if not mismatches:
+        return None
+
+    first = min(mismatches)
+    if source is None:
+        return first
+
+    chunk = next(d for d in digests if d.offset == first)
+    return _first_difference(source, target, chunk.offset, chunk.length)
+
+
+def verify_targets(
+    targets: list[str],
+    digests: list[ChunkDigest],
+    source: Path | None = None,
+    on_progress: Callable[[str, int], None] | None = None,
+) -> dict[str, int | None]:
+    """Verify several targets concurrently, see verify_target
+
+    Returns:
+        First mismatching offset (or None) per target
+    """
+
+    def verify(target: str) -> int | None:
+        def report(advance: int) -> None:
+            if on_progress:
+                on_progress(target, advance)
+
+        return verify_target(target, digests, source=source, on_progress=report)
+
+    with ThreadPoolExecutor(max_workers=len(targets) or 1) as executor:
+        return dict(zip(targets, executor.map(verify, targets), strict=True))
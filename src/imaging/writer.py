@@ -0,0 +1,556 @@
+"""In-process image writer
+
+Copies an image to one or more block devices (or plain files). A reader thread
+fills a small ring of page-aligned buffers and a writer thread per target
+drains it, so reading the next chunk overlaps with writing the previous one
+and the image is read once no matter how many cards are written. Targets are
+opened with O_DIRECT where supported to bypass the page cache.
+
+The source can also be an iterator of decompressed chunks, in which case the
+reader thread does the decompression and the bounded ring keeps it from
+running ahead of the slowest card. A SHA256 of everything read can be
+computed on the way. That is how an image is flashed while it's still
+downloading, see ImageStream.
+"""
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import stat
+import sys
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+from src.imaging.decoders import is_compressed, select_decoder
+from src.imaging.verify import ChunkDigest, chunk_digest, verify_targets
+
+ALIGNMENT = 4096
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024  # 4MB buffers
+DEFAULT_BUFFER_COUNT = 2
+DEFAULT_RING_SIZE = 8
+DEFAULT_FSYNC_INTERVAL = 256 * 1024 * 1024  # 256MB
+
+FSYNC_POLICIES = ("end", "interval", "never")
+
+# Image argument of the privileged helper reading the image from stdin
+STDIN = "-"
+
+_report_lock = threading.Lock()
+
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+
+
+class ImageHashError(ValueError):
+    """The image written doesn't match its expected SHA256"""
+
+
+class TargetsFailedError(RuntimeError):
+    """Some targets failed while the others were written completely
+
+    Attributes:
+        failures: Reason per failed target
+        sha256: SHA256 of the decompressed image, if one was computed
+    """
+
+    def __init__(self, failures: dict[str, str], sha256: str | None = None):
+        self.failures = failures
+        self.sha256 = sha256
+        details = ", ".join(f"{t} ({reason})" for t, reason in failures.items())
+        super().__init__(f"Failed to flash {details}")
+
+
+@dataclass
+class ImageStream:
+    """Contents of an image that isn't on disk, e.g. while it downloads"""
+
+    name: str
+    chunks: Iterable[bytes]
+    size: int | None = None
+
+
+def image_source(image_path: Path) -> Path | Iterator[bytes]:
+    """The image itself, or its decompressed contents if it's compressed
+
+    An image_path of "-" reads the image from stdin.
+    """
+    if str(image_path) == STDIN:
+        return iter(lambda: sys.stdin.buffer.read(DEFAULT_BUFFER_SIZE), b"")
+    if is_compressed(image_path):
+        return select_decoder(image_path).iter_chunks(image_path)
+    return image_path
+
+
+def _open_target(target: str, direct: bool) -> tuple[int, bool]:
+    """Open target for writing, returning (fd, whether O_DIRECT is active)"""
+    flags = os.O_WRONLY | os.O_CREAT
+    if direct and O_DIRECT:
+        try:
+            return os.open(target, flags | O_DIRECT, 0o644), True
+        except OSError as e:
+            # tmpfs and some filesystems reject O_DIRECT
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(target, flags, 0o644), False
+
+
+def _disable_direct(fd: int) -> None:
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~O_DIRECT)
+
+
+def _write_all(fd: int, view: memoryview) -> None:
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class RingBuffer:
+    """Fixed set of aligned slots filled by one producer, read by N consumers
+
+    A slot is only reused once every consumer has released it, so a single
+    read of the source can be fanned out to several targets.
+    """
+
+    def __init__(self, slot_count: int, slot_size: int, consumers: int):
+        # Anonymous mmaps are page aligned, as O_DIRECT requires
+        self.slots = [mmap.mmap(-1, slot_size) for _ in range(slot_count)]
+        self.lengths = [0] * slot_count
+        self.produced = 0
+        self.consumed = [0] * consumers
+        self.aborted = False
+        self._condition = threading.Condition()
+
+    def _free(self) -> bool:
+        return self.produced - min(self.consumed) < len(self.slots)
+
+    def acquire_write(self) -> mmap.mmap | None:
+        with self._condition:
+            self._condition.wait_for(lambda: self.aborted or self._free())
+            if self.aborted:
+                return None
+            return self.slots[self.produced % len(self.slots)]
+
+    def commit(self, length: int) -> None:
+        with self._condition:
+            self.lengths[self.produced % len(self.slots)] = length
+            self.produced += 1
+            self._condition.notify_all()
+
+    def acquire_read(self, consumer: int) -> tuple[mmap.mmap, int] | None:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.aborted or self.consumed[consumer] < self.produced
+            )
+            if self.aborted:
+                return None
+            index = self.consumed[consumer] % len(self.slots)
+            return self.slots[index], self.lengths[index]
+
+    def release(self, consumer: int) -> None:
+        with self._condition:
+            self.consumed[consumer] += 1
+            self._condition.notify_all()
+
+    def detach(self, consumer: int) -> None:
+        """Stop waiting on a consumer that failed"""
+        with self._condition:
+            self.consumed[consumer] = sys.maxsize
+            self._condition.notify_all()
+
+    def abort(self) -> None:
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        for slot in self.slots:
+            slot.close()
+
+
+def _commit(
+    ring: RingBuffer,
+    slot: mmap.mmap,
+    length: int,
+    offset: int,
+    digests: list[ChunkDigest] | None,
+    on_data: Callable[[memoryview], None] | None,
+) -> None:
+    if length:
+        with memoryview(slot) as view:
+            if digests is not None:
+                digests.append(chunk_digest(offset, view[:length]))
+            if on_data is not None:
+                on_data(view[:length])
+    ring.commit(length)
+
+
+def _reader(
+    source_fd: int,
+    ring: RingBuffer,
+    errors: list[BaseException],
+    digests: list[ChunkDigest] | None,
+    on_data: Callable[[memoryview], None] | None = None,
+) -> None:
+    offset = 0
+    try:
+        while True:
+            slot = ring.acquire_write()
+            if slot is None:
+                return
+            length = os.readv(source_fd, [slot])
+            _commit(ring, slot, length, offset, digests, on_data)
+            offset += length
+            if length == 0:
+                return
+    except BaseException as e:
+        errors.append(e)
+        ring.abort()
+
+
+def _chunk_reader(
+    chunks: Iterable[bytes],
+    ring: RingBuffer,
+    errors: list[BaseException],
+    digests: list[ChunkDigest] | None,
+    on_data: Callable[[memoryview], None] | None = None,
+) -> None:
+    """Pack chunks of any size into full slots, only the last may be short"""
+    offset = 0
+    slot = None
+    filled = 0
+    try:
+        for chunk in chunks:
+            data = memoryview(chunk)
+            while data:
+                if slot is None:
+                    slot = ring.acquire_write()
+                    if slot is None:
+                        return
+                    filled = 0
+                length = min(len(data), len(slot) - filled)
+                slot[filled : filled + length] = data[:length]
+                filled += length
+                data = data[length:]
+                if filled == len(slot):
+                    _commit(ring, slot, filled, offset, digests, on_data)
+                    offset += filled
+                    slot = None
+
+        if slot is not None:
+            _commit(ring, slot, filled, offset, digests, on_data)
+        # An empty slot marks the end, as a zero length read does
+        end = ring.acquire_write()
+        if end is not None:
+            ring.commit(0)
+    except BaseException as e:
+        errors.append(e)
+        ring.abort()
+    finally:
+        # Stops a decompressor that is cut short
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def _writer(
+    ring: RingBuffer,
+    consumer: int,
+    target_fd: int,
+    direct: bool,
+    fsync: str,
+    fsync_interval: int,
+    on_progress: Callable[[int], None] | None,
+) -> int:
+    written = 0
+    since_sync = 0
+
+    while True:
+        acquired = ring.acquire_read(consumer)
+        if acquired is None:
+            raise RuntimeError("Image read failed")
+
+        slot, length = acquired
+        if length == 0:
+            break
+
+        if direct and length % ALIGNMENT:
+            # Only the final short read can be unaligned
+            _disable_direct(target_fd)
+            direct = False
+
+        with memoryview(slot) as view:
+            _write_all(target_fd, view[:length])
+        ring.release(consumer)
+
+        written += length
+        since_sync += length
+        if on_progress:
+            on_progress(length)
+
+        if fsync == "interval" and since_sync >= fsync_interval:
+            os.fsync(target_fd)
+            since_sync = 0
+
+    # A regular file that held something longer keeps no stale tail
+    if stat.S_ISREG(os.fstat(target_fd).st_mode):
+        os.ftruncate(target_fd, written)
+
+    if fsync != "never":
+        os.fsync(target_fd)
+
+    return written
+
+
+def write_images(
+    source: Path | Iterable[bytes],
+    targets: list[str],
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+    buffer_count: int = DEFAULT_RING_SIZE,
+    fsync: str = "end",
+    fsync_interval: int = DEFAULT_FSYNC_INTERVAL,
+    direct: bool = True,
+    on_progress: Callable[[str, int], None] | None = None,
+    digests: list[ChunkDigest] | None = None,
+    on_data: Callable[[memoryview], None] | None = None,
+) -> dict[str, int]:
+    """Read source once and write it to every target concurrently
+
+    One reader thread fills a ring of aligned buffers and one writer thread
+    per target drains it, so the slowest card sets the pace and the image is
+    never read more than once. A failing target is detached and reported at
+    the end without stopping the others.
+
+    Args:
+        source: Image file to read, or its contents as chunks of any size
+            (e.g. from a decompressor, see image_source)
+        targets: Block devices or regular files to write
+        buffer_size: Bytes per buffer, rounded up to the alignment
+        buffer_count: Number of buffers in the ring (at least 2)
+        fsync: "end" syncs once after the last write, "interval" also syncs
+            every fsync_interval bytes, "never" leaves it to the caller
+        fsync_interval: Bytes between syncs for the "interval" policy
+        direct: Open targets with O_DIRECT when the platform supports it
+        on_progress: Called with (target, bytes written) per write
+        digests: If given, filled with the digest of every chunk read, for
+            verification with src.imaging.verify
+        on_data: Called on the reader thread with every buffer read, in
+            order, e.g. to hash the image on the way
+
+    Returns:
+        Number of bytes written per target
+
+    Raises:
+        TargetsFailedError: If writing any target failed, the others were
+            still written completely
+        RuntimeError: If reading the image failed
+    """
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f"Unknown fsync policy: {fsync}")
+
+    buffer_size = -(-buffer_size // ALIGNMENT) * ALIGNMENT
+    ring = RingBuffer(max(buffer_count, 2), buffer_size, len(targets))
+
+    read_errors: list[BaseException] = []
+    write_errors: dict[str, BaseException] = {}
+    written: dict[str, int] = {}
+
+    if isinstance(source, Path):
+        source_fd = os.open(source, os.O_RDONLY)
+        reader, reader_args = _reader, (source_fd, ring, read_errors, digests, on_data)
+    else:
+        source_fd = None
+        reader, reader_args = (
+            _chunk_reader,
+            (source, ring, read_errors, digests, on_data),
+        )
+    target_fds: list[int] = []
+
+    def write_target(consumer: int, target: str, target_fd: int, direct: bool):
+        def report(advance: int) -> None:
+            if on_progress:
+                on_progress(target, advance)
+
+        try:
+            written[target] = _writer(
+                ring, consumer, target_fd, direct, fsync, fsync_interval, report
+            )
+        except BaseException as e:
+            # The traceback's frames still view a ring slot, which would keep
+            # the slot from being closed
+            write_errors[target] = e.with_traceback(None)
+            ring.detach(consumer)
+
+    threads = [
+        threading.Thread(
+            target=reader,
+            args=reader_args,
+            name="image-reader",
+            daemon=True,
+        )
+    ]
+    try:
+        for consumer, target in enumerate(targets):
+            target_fd, target_direct = _open_target(target, direct)
+            target_fds.append(target_fd)
+            threads.append(
+                threading.Thread(
+                    target=write_target,
+                    args=(consumer, target, target_fd, target_direct),
+                    name=f"image-writer-{consumer}",
+                    daemon=True,
+                )
+            )
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        ring.abort()
+        # The threads still use the fds and slots closed below, e.g. after
+        # Ctrl+C, and only stop once they notice the abort
+        for thread in threads:
+            if thread.ident is not None:
+                thread.join()
+        raise
+    finally:
+        if source_fd is not None:
+            os.close(source_fd)
+        for target_fd in target_fds:
+            os.close(target_fd)
+        ring.close()
+
+    if read_errors:
+        raise read_errors[0]
+    if write_errors:
+        raise TargetsFailedError({t: str(e) for t, e in write_errors.items()})
+
+    return written
+
+
+def write_image(
+    source: Path | Iterable[bytes],
+    target: str,
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+    buffer_count: int = DEFAULT_BUFFER_COUNT,
+    fsync: str = "end",
+    fsync_interval: int = DEFAULT_FSYNC_INTERVAL,
+    direct: bool = True,
+    on_progress: Callable[[int], None] | None = None,
+    digests: list[ChunkDigest] | None = None,
+    on_data: Callable[[memoryview], None] | None = None,
+) -> int:
+    """Write source to target using double-buffered, direct I/O
+
+    See write_images for the arguments.
+
+    Returns:
+        Number of bytes written
+    """
+
+    def report(_target: str, advance: int) -> None:
+        if on_progress:
+            on_progress(advance)
+
+    written = write_images(
+        source,
+        [target],
+        buffer_size=buffer_size,
+        buffer_count=buffer_count,
+        fsync=fsync,
+        fsync_interval=fsync_interval,
+        direct=direct,
+        on_progress=report,
+        digests=digests,
+        on_data=on_data,
+    )
+
+    return written[target]
+
+
+def report_line(*fields: object) -> None:
+    """Print one line of the helper protocol
+
+    Writer and verify threads report concurrently, and print() writes the
+    fields, separators and newline separately, so lines could interleave.
+    """
+    line = " ".join(str(field) for field in fields) + "\n"
+    with _report_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def main() -> None:
+    """Privileged helper for flashing as root
+
+    Prints "<target index> <bytes>" per write and "<target index> failed
+    <reason>" for every target that couldn't be written. With --verify the
+    others are read back, printing "<target index> verify <bytes>" per
+    verified chunk followed by "<target index> mismatch <offset>" for every
+    target that didn't match.
+    A compressed image is decompressed on the way. For those, and for an
+    image read from stdin ("-"), "sha256 <hex>" of the contents is printed
+    once everything is written.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image")
+    parser.add_argument("targets", nargs="+")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="end")
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+
+    image_path = Path(args.image)
+    indexes = {target: index for index, target in enumerate(args.targets)}
+    digests: list[ChunkDigest] | None = [] if args.verify else None
+
+    source = image_source(image_path)
+    hasher = None if isinstance(source, Path) else hashlib.sha256()
+
+    def report(target: str, advance: int) -> None:
+        report_line(indexes[target], advance)
+
+    failed: dict[str, str] = {}
+    try:
+        write_images(
+            source,
+            args.targets,
+            fsync=args.fsync,
+            on_progress=report,
+            digests=digests,
+            on_data=hasher.update if hasher else None,
+        )
+    except TargetsFailedError as e:
+        failed = e.failures
+
+    if hasher:
+        report_line("sha256", hasher.hexdigest())
+    for target, reason in failed.items():
+        report_line(indexes[target], "failed", " ".join(reason.split()))
+
+    written = [target for target in args.targets if target not in failed]
+    if digests is None or not written:
+        return 1 if failed else 0
+
+    def report_verify(target: str, advance: int) -> None:
+        report_line(indexes[target], "verify", advance)
+
+    results = verify_targets(
+        written,
+        digests,
+        source=None if hasher else image_path,
+        on_progress=report_verify,
+    )
+    for target, offset in results.items():
+        if offset is not None:
+            report_line(indexes[target], "mismatch", offset)
+
+    mismatched = any(offset is not None for offset in results.values())
+    return 1 if failed or mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
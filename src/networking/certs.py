@@ -0,0 +1,41 @@
+"""mkcert root CAs of the fleet and which of them are already trusted"""
+
+import json
+from pathlib import Path
+
+from src.imaging.cache import CACHE_DIR
+
+ROOT_CA_PATH = "~/.local/share/mkcert/rootCA.pem"
+TRUSTED_PATH = CACHE_DIR / "trusted.json"
+
+
+def load_trusted() -> set[str]:
+    """SHA256 digests of certificates trusted by earlier runs"""
+    try:
+        return set(json.loads(TRUSTED_PATH.read_text()))
+    except (FileNotFoundError, ValueError):
+        return set()
+
+
+def mark_trusted(digest: str) -> None:
+    trusted = load_trusted() | {digest}
+    TRUSTED_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = TRUSTED_PATH.with_name(TRUSTED_PATH.name + ".tmp")
+    tmp_path.write_text(json.dumps(sorted(trusted), indent=2))
+    tmp_path.replace(TRUSTED_PATH)
+
+
+def group_by_content(files: dict[str, Path]) -> dict[str, tuple[Path, list[str]]]:
+    """Group blobs pulled from several Pis by digest
+
+    Args:
+        files: Pi name to the blob pulled from it
+
+    Returns:
+        Digest to (blob, names of the Pis it came from)
+    """
+    groups: dict[str, tuple[Path, list[str]]] = {}
+    for name, blob in files.items():
+        # Blobs are stored under their SHA256
+        groups.setdefault(blob.name, (blob, []))[1].append(name)
+    return groups
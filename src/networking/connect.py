@@ -1,86 +1,70 @@
+import asyncio
 import os
-import shutil
 import subprocess
-import tempfile
-import time
-from contextlib import contextmanager
-from pathlib import Path
 
 from src.console import console
+from src.networking.readiness import DEFAULT_TIMEOUT, HostStatus, watch_hosts
+from src.networking.resolver import get_resolver, local_name, resolve
+from src.networking.ssh import ssh_options
 
 
-def wait_for_pi(hostname: str):
-    """Ping hostname until it responds or timeout"""
+def wait_for_pis(
+    hostnames: list[str], timeout: float = DEFAULT_TIMEOUT
+) -> list[HostStatus]:
+    """Wait until every host accepts SSH connections or its timeout runs out
 
-    with console.status(
-        f"[green]Waiting for {hostname} to come online...[/green]",
-        spinner="bouncingBall",
-    ):
-        while True:
-            result = subprocess.run(
-                ["ping", "-c", "1", "-W", "1", f"{hostname}.local"],
-                capture_output=True,
-                text=True,
-            )
-            if result.returncode == 0:
-                break
-            time.sleep(0.5)  # Small delay to avoid rapid-fire on instant failures
+    Returns:
+        Status per host in the order they were decided
+    """
+
+    async def watch() -> list[HostStatus]:
+        results = []
+        pending = len(set(hostnames))
+        with console.status(
+            f"[green]Waiting for {pending} Pi(s) to come online...[/green]",
+            spinner="bouncingBall",
+        ) as status:
+            async for result in watch_hosts(
+                hostnames, timeout=timeout, resolver=get_resolver()
+            ):
+                results.append(result)
+                pending -= 1
+                if result.online:
+                    console.print(
+                        f"[green]✓[/green] {local_name(result.host)} online "
+                        f"[dim]({result.address}, {result.elapsed:.1f}s)[/dim]"
+                    )
+                else:
+                    console.print(f"[red]✗[/red] {local_name(result.host)} timed out")
+                status.update(
+                    f"[green]Waiting for {pending} Pi(s) to come online...[/green]"
+                )
+        return results
+
+    return asyncio.run(watch())
+
+
+def wait_for_pi(hostname: str, timeout: float = DEFAULT_TIMEOUT):
+    """Wait until hostname accepts SSH connections
+
+    Raises:
+        RuntimeError: If it doesn't come online within timeout seconds
+    """
+
+    (result,) = wait_for_pis([hostname], timeout=timeout)
+    if not result.online:
+        raise RuntimeError(f"{hostname} did not come online within {timeout:.0f}s")
 
 
 def connect_to_pi(user: str, hostname: str):
     """SSH to user@hostname"""
 
+    address = resolve(hostname)
+
     # Remove old host key if it exists
     subprocess.run(
         ["ssh-keygen", "-R", f"{hostname}"], capture_output=True, check=False
     )
 
-    # Connect with auto-accept new key
-    os.execvp(
-        "ssh",
-        ["ssh", "-o", "StrictHostKeyChecking=accept-new", f"{user}@{hostname}.local"],
-    )
-
-
-@contextmanager
-def download_from_pi(user: str, hostname: str, remote_path: str):
-    """Download file from Pi via SCP, auto-cleanup after use
-
-    Args:
-        user: SSH username
-        hostname: Pi hostname or IP
-        remote_path: Remote file path on Pi
-
-    Yields:
-        Path: Local path to downloaded file
-
-    Example:
-        with download_from_pi("john", "pi", "~/.ssh/id_rsa.pub") as cert_path:
-            process_file(cert_path)
-    """
-    temp_dir = tempfile.mkdtemp(prefix="pitool_")
-    filename = Path(remote_path).name
-    local_path = Path(temp_dir) / filename
-
-    try:
-        console.print(f"[cyan]Downloading {remote_path} from {hostname}...[/cyan]")
-
-        subprocess.run(
-            ["scp", f"{user}@{hostname}:{remote_path}", str(local_path)],
-            check=True,
-            capture_output=True,
-        )
-
-        console.print(f"[green]✓[/green] Downloaded to {local_path}")
-
-        yield local_path
-
-    except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.strip() if e.stderr else "Unknown error"
-        raise RuntimeError(
-            f"Failed to download from {hostname}.local:{remote_path}\n{error_msg}"
-        ) from None
-
-    finally:
-        # Cleanup temp dir
-        shutil.rmtree(temp_dir, ignore_errors=True)
+    # Connect with auto-accept new key, known by hostname whatever the address
+    os.execvp("ssh", ["ssh", *ssh_options(hostname), f"{user}@{address}"])
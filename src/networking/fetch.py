@@ -0,0 +1,160 @@
+"""Batched file pulls from the fleet
+
+All requested files are read from a host with a single remote command over
+its multiplexed SSH connection, and stored locally by content hash so the
+same file pulled from many Pis is kept (and processed) once.
+"""
+
+import asyncio
+import hashlib
+import shlex
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from src.config.models import PiConfig
+from src.imaging.cache import CACHE_DIR
+from src.networking.resolver import Resolver
+from src.networking.ssh import (
+    DEFAULT_CONCURRENCY,
+    open_master,
+    resolve_address,
+    ssh_options,
+)
+
+BLOBS_DIR = CACHE_DIR / "blobs"
+
+# Printed instead of a size for files that can't be read
+MISSING = b"-1"
+
+
+@dataclass
+class FetchResult:
+    pi: PiConfig
+    files: dict[str, Path] = field(default_factory=dict)  # remote path -> blob
+    error: str = ""
+
+
+def store_blob(data: bytes) -> Path:
+    """Store data under its SHA256 and return the path"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = BLOBS_DIR / digest
+
+    if not path.exists():
+        BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{digest}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    return path
+
+
+def _shell_path(path: str) -> str:
+    """Quote a remote path for sh, keeping a leading ~/ working"""
+    if path == "~":
+        return '"$HOME"'
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def _batch_command(remote_paths: list[str]) -> str:
+    """Print "<size>\\n<content>" per path, or "-1\\n" if it can't be read"""
+    parts = []
+    for path in remote_paths:
+        quoted = _shell_path(path)
+        parts.append(
+            f"if [ -f {quoted} ] && [ -r {quoted} ]; "
+            f"then wc -c < {quoted} | tr -d ' '; cat {quoted}; "
+            f"else echo {MISSING.decode()}; fi"
+        )
+    return "; ".join(parts)
+
+
+def _parse_batch(output: bytes, remote_paths: list[str]) -> dict[str, bytes]:
+    files = {}
+    position = 0
+
+    for path in remote_paths:
+        end = output.index(b"\n", position)
+        size = output[position:end].strip()
+        position = end + 1
+        if size == MISSING:
+            continue
+        length = int(size)
+        files[path] = output[position : position + length]
+        position += length
+
+    return files
+
+
+async def fetch_from_host(
+    user: str,
+    hostname: str,
+    remote_paths: list[str],
+    resolver: Resolver | None = None,
+) -> dict[str, Path]:
+    """Pull several files from a host in one round trip
+
+    Returns:
+        Local blob path per remote path, files that don't exist are left out
+
+    Raises:
+        RuntimeError: If the host can't be reached
+    """
+    address = await resolve_address(hostname, resolver)
+
+    returncode, error = await open_master(user, hostname, address)
+    if returncode != 0:
+        raise RuntimeError(error or f"Failed to connect to {hostname}")
+
+    proc = await asyncio.create_subprocess_exec(
+        "ssh",
+        *ssh_options(hostname),
+        "-o",
+        "BatchMode=yes",
+        f"{user}@{address}",
+        _batch_command(remote_paths),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    output, error = await proc.communicate()
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            error.decode(errors="replace").strip()
+            or f"Failed to read files from {hostname}"
+        )
+
+    try:
+        files = _parse_batch(output, remote_paths)
+    except ValueError:
+        raise RuntimeError(f"Unexpected output from {hostname}") from None
+
+    return {path: store_blob(data) for path, data in files.items()}
+
+
+async def fetch_fleet(
+    pis: list[PiConfig],
+    remote_paths: list[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    resolver: Resolver | None = None,
+) -> list[FetchResult]:
+    """Pull the same files from every Pi concurrently
+
+    Returns:
+        Result per Pi, in the order of pis
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def fetch(pi: PiConfig) -> FetchResult:
+        async with semaphore:
+            try:
+                files = await fetch_from_host(
+                    pi.user.name, pi.hostname, remote_paths, resolver
+                )
+            except (RuntimeError, OSError) as e:
+                return FetchResult(pi, error=str(e))
+            return FetchResult(pi, files)
+
+    return list(await asyncio.gather(*(fetch(pi) for pi in pis)))
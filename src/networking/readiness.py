@@ -0,0 +1,143 @@
+"""Concurrent readiness checks for freshly booted Pis
+
+Every host is probed in-process by opening a TCP connection to its SSH port,
+retrying with exponential backoff until it accepts or its timeout runs out.
+All hosts are probed concurrently and reported as soon as they come up. Host
+names are resolved through a Resolver on every attempt until one answers, as
+a Pi that is still booting doesn't respond to mDNS either.
+"""
+
+import asyncio
+import contextlib
+import random
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+
+from src.networking.resolver import Resolver
+
+SSH_PORT = 22
+DEFAULT_TIMEOUT = 600.0  # 10 minutes, first boot with cloud-init can be slow
+DEFAULT_CONNECT_TIMEOUT = 2.0
+DEFAULT_INITIAL_DELAY = 0.25
+DEFAULT_MAX_DELAY = 5.0
+
+
+@dataclass
+class HostStatus:
+    host: str
+    online: bool
+    elapsed: float
+    attempts: int
+    address: str | None = None
+
+
+async def probe(
+    host: str, port: int = SSH_PORT, timeout: float = DEFAULT_CONNECT_TIMEOUT
+) -> bool:
+    """Return True if a TCP connection to host:port succeeds within timeout"""
+    try:
+        _reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+    except (OSError, TimeoutError):
+        return False
+
+    writer.close()
+    with contextlib.suppress(OSError):
+        await writer.wait_closed()
+    return True
+
+
+async def _resolve(resolver: Resolver | None, host: str, timeout: float) -> str | None:
+    if resolver is None:
+        return host
+    try:
+        result = await asyncio.wait_for(resolver.resolve(host), timeout)
+    except TimeoutError:
+        return None
+    return result.address if result else None
+
+
+async def _wait_for_host(
+    host: str,
+    port: int,
+    timeout: float,
+    connect_timeout: float,
+    initial_delay: float,
+    max_delay: float,
+    resolver: Resolver | None,
+) -> HostStatus:
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    attempts = 0
+
+    while True:
+        attempts += 1
+        address = await _resolve(resolver, host, max(deadline - time.monotonic(), 0.01))
+        remaining = deadline - time.monotonic()
+        if address is not None and await probe(
+            address, port, min(connect_timeout, max(remaining, 0.01))
+        ):
+            return HostStatus(host, True, time.monotonic() - start, attempts, address)
+
+        if address is not None and resolver is not None:
+            # The Pi may come back with a new lease after a re-flash
+            resolver.forget(host)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return HostStatus(host, False, time.monotonic() - start, attempts)
+
+        # Jitter keeps a rack of Pis from being probed in lockstep
+        await asyncio.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+        delay = min(delay * 2, max_delay)
+
+
+async def watch_hosts(
+    hosts: list[str],
+    port: int = SSH_PORT,
+    timeout: float = DEFAULT_TIMEOUT,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    initial_delay: float = DEFAULT_INITIAL_DELAY,
+    max_delay: float = DEFAULT_MAX_DELAY,
+    resolver: Resolver | None = None,
+) -> AsyncIterator[HostStatus]:
+    """Probe every host concurrently, yielding each one as soon as it's decided
+
+    Args:
+        hosts: Host names or addresses
+        port: TCP port that signals readiness
+        timeout: Per-host time budget in seconds
+        connect_timeout: Timeout of a single connection attempt
+        initial_delay: First backoff delay between attempts
+        max_delay: Backoff cap
+        resolver: Resolves host names before probing, if not given they are
+            passed to the OS as they are
+
+    Yields:
+        HostStatus per host, online ones in the order they came up and hosts
+        that timed out once their budget ran out
+    """
+    tasks = [
+        asyncio.create_task(
+            _wait_for_host(
+                host,
+                port,
+                timeout,
+                connect_timeout,
+                initial_delay,
+                max_delay,
+                resolver,
+            )
+        )
+        for host in dict.fromkeys(hosts)
+    ]
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,356 @@
+"""Host name resolution for Pis on the local network
+
+Pi host names are resolved in-process and remembered, instead of letting
+every ping, ssh and scp call go through the OS mDNS stack again. Lookups go
+through, in order:
+
+1. A static override file (``hosts`` in the pitool config directory, or the
+   file named by ``PITOOL_HOSTS_FILE``) in ``/etc/hosts`` format
+2. A cache of earlier answers that respects their TTL, shared between
+   commands through the cache directory
+3. A one-shot mDNS query for ``<hostname>.local``
+4. The system resolver
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import struct
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from functools import cache
+from pathlib import Path
+
+from platformdirs import user_config_dir
+
+from src.imaging.cache import CACHE_DIR
+
+MDNS_ADDRESS = ("224.0.0.251", 5353)
+MDNS_TIMEOUT = 1.5
+MDNS_RETRY_INTERVAL = 0.5
+
+HOSTS_FILE_ENV = "PITOOL_HOSTS_FILE"
+HOSTS_CACHE_PATH = CACHE_DIR / "hosts.json"
+SYSTEM_TTL = 60  # getaddrinfo doesn't tell us the record TTL
+
+TYPE_A = 1
+CLASS_IN = 1
+UNICAST_RESPONSE = 0x8000  # QU bit, ask responders to reply to our port
+CACHE_FLUSH = 0x8000
+
+
+@dataclass
+class Resolution:
+    address: str
+    expires: float
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Resolution":
+        return cls(**data)
+
+
+def local_name(hostname: str) -> str:
+    """Fully qualified mDNS name, pi -> pi.local"""
+    hostname = hostname.rstrip(".").lower()
+    return hostname if hostname.endswith(".local") else f"{hostname}.local"
+
+
+def _is_address(hostname: str) -> bool:
+    try:
+        ipaddress.ip_address(hostname)
+    except ValueError:
+        return False
+    return True
+
+
+def _encode_name(name: str) -> bytes:
+    return (
+        b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+        + b"\0"
+    )
+
+
+def _read_name(packet: bytes, offset: int) -> tuple[str, int]:
+    """Read a possibly compressed name, returning it and the offset after it"""
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        length = packet[offset]
+        if length & 0xC0 == 0xC0:
+            if jumps > 32:
+                raise ValueError("Name compression loop")
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | packet[offset + 1]
+            jumps += 1
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(packet[offset : offset + length].decode(errors="replace"))
+        offset += length
+
+    return ".".join(labels), end if end is not None else offset
+
+
+def build_query(name: str) -> bytes:
+    header = struct.pack("!HHHHHH", 0, 0, 1, 0, 0, 0)
+    return (
+        header
+        + _encode_name(name)
+        + struct.pack("!HH", TYPE_A, CLASS_IN | UNICAST_RESPONSE)
+    )
+
+
+def parse_response(packet: bytes, name: str) -> Resolution | None:
+    """Return the first A record for name in a DNS response packet"""
+    try:
+        _id, flags, questions, answers, authority, additional = struct.unpack_from(
+            "!HHHHHH", packet
+        )
+        if not flags & 0x8000:  # a query, not a response
+            return None
+
+        offset = 12
+        for _ in range(questions):
+            _qname, offset = _read_name(packet, offset)
+            offset += 4
+
+        for _ in range(answers + authority + additional):
+            rname, offset = _read_name(packet, offset)
+            rtype, rclass, ttl, length = struct.unpack_from("!HHIH", packet, offset)
+            offset += 10
+            data = packet[offset : offset + length]
+            offset += length
+
+            if (
+                rtype == TYPE_A
+                and rclass & ~CACHE_FLUSH == CLASS_IN
+                and rname.lower() == name
+                and length == 4
+            ):
+                return Resolution(socket.inet_ntoa(data), time.time() + ttl)
+    except (struct.error, IndexError, ValueError):
+        return None
+
+    return None
+
+
+class _MdnsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, name: str, answer: asyncio.Future):
+        self.name = name
+        self.answer = answer
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        result = parse_response(data, self.name)
+        if result is not None and not self.answer.done():
+            self.answer.set_result(result)
+
+
+class Resolver(ABC):
+    """A way to turn a Pi host name into an address"""
+
+    @abstractmethod
+    async def resolve(self, hostname: str) -> Resolution | None:
+        """Return the address and its expiry, or None if unknown"""
+        pass
+
+    def forget(self, hostname: str) -> None:  # noqa: B027
+        """Drop anything remembered about hostname"""
+
+
+class StaticResolver(Resolver):
+    """Fixed addresses from a hosts(5) style file"""
+
+    def __init__(self, path: Path):
+        self.entries: dict[str, str] = {}
+        try:
+            lines = path.read_text().splitlines()
+        except FileNotFoundError:
+            return
+
+        for line in lines:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) < 2:
+                continue
+            address, *names = fields
+            for name in names:
+                self.entries.setdefault(name.lower(), address)
+                self.entries.setdefault(local_name(name), address)
+
+    async def resolve(self, hostname: str) -> Resolution | None:
+        address = self.entries.get(hostname.lower()) or self.entries.get(
+            local_name(hostname)
+        )
+        return Resolution(address, float("inf")) if address else None
+
+
+class MdnsResolver(Resolver):
+    """One-shot multicast DNS query for <hostname>.local (RFC 6762 5.1)"""
+
+    def __init__(
+        self,
+        server: tuple[str, int] = MDNS_ADDRESS,
+        timeout: float = MDNS_TIMEOUT,
+        retry_interval: float = MDNS_RETRY_INTERVAL,
+    ):
+        self.server = server
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+    async def resolve(self, hostname: str) -> Resolution | None:
+        name = local_name(hostname)
+        loop = asyncio.get_running_loop()
+        answer = loop.create_future()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        sock.bind(("", 0))
+
+        try:
+            transport, _protocol = await loop.create_datagram_endpoint(
+                lambda: _MdnsProtocol(name, answer), sock=sock
+            )
+        except OSError:
+            sock.close()
+            return None
+
+        query = build_query(name)
+        deadline = loop.time() + self.timeout
+
+        try:
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    transport.sendto(query, self.server)
+                except OSError:
+                    return None  # no multicast route
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(answer), min(self.retry_interval, remaining)
+                    )
+                except TimeoutError:
+                    continue
+            return None
+        finally:
+            transport.close()
+
+
+class SystemResolver(Resolver):
+    """The OS resolver, used when mDNS doesn't answer"""
+
+    async def resolve(self, hostname: str) -> Resolution | None:
+        loop = asyncio.get_running_loop()
+        for name in dict.fromkeys([hostname, local_name(hostname)]):
+            try:
+                infos = await loop.getaddrinfo(
+                    name, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+                )
+            except OSError:
+                continue
+            if infos:
+                return Resolution(infos[0][4][0], time.time() + SYSTEM_TTL)
+        return None
+
+
+class CachingResolver(Resolver):
+    """Try overrides, then cached answers, then each resolver in turn
+
+    Answers are cached until their TTL runs out and persisted so the next
+    pitool command can reuse them. Failed lookups are never cached, a Pi that
+    is still booting should be found as soon as it answers.
+    """
+
+    def __init__(
+        self,
+        resolvers: list[Resolver],
+        overrides: Resolver | None = None,
+        cache_path: Path | None = HOSTS_CACHE_PATH,
+    ):
+        self.resolvers = resolvers
+        self.overrides = overrides
+        self.cache_path = cache_path
+        self.entries = self._load()
+
+    def _load(self) -> dict[str, Resolution]:
+        if self.cache_path is None:
+            return {}
+        try:
+            data = json.loads(self.cache_path.read_text())
+            return {name: Resolution.from_dict(e) for name, e in data.items()}
+        except (FileNotFoundError, ValueError, TypeError):
+            return {}
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        now = time.time()
+        data = {n: asdict(e) for n, e in self.entries.items() if e.expires > now}
+        tmp_path = self.cache_path.with_name(
+            f"{self.cache_path.name}.{os.getpid()}.tmp"
+        )
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps(data, indent=2))
+            tmp_path.replace(self.cache_path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+
+    def forget(self, hostname: str) -> None:
+        """Drop a cached answer, e.g. after the address stopped working"""
+        if self.entries.pop(local_name(hostname), None) is not None:
+            self._save()
+
+    async def resolve(self, hostname: str) -> Resolution | None:
+        if _is_address(hostname):
+            return Resolution(hostname, float("inf"))
+
+        if self.overrides is not None:
+            override = await self.overrides.resolve(hostname)
+            if override is not None:
+                return override
+
+        name = local_name(hostname)
+        cached = self.entries.get(name)
+        if cached is not None and cached.expires > time.time():
+            return cached
+
+        for resolver in self.resolvers:
+            result = await resolver.resolve(hostname)
+            if result is not None:
+                self.entries[name] = result
+                self._save()
+                return result
+
+        return None
+
+
+def hosts_file_path() -> Path:
+    return Path(
+        os.environ.get(HOSTS_FILE_ENV) or Path(user_config_dir("pitool")) / "hosts"
+    )
+
+
+@cache
+def get_resolver() -> CachingResolver:
+    """The resolver shared by every command in this process"""
+    return CachingResolver(
+        [MdnsResolver(), SystemResolver()],
+        overrides=StaticResolver(hosts_file_path()),
+    )
+
+
+def resolve(hostname: str) -> str:
+    """Resolve hostname to an address, blocking
+
+    Raises:
+        RuntimeError: If the host can't be resolved
+    """
+    result = asyncio.run(get_resolver().resolve(hostname))
+    if result is None:
+        raise RuntimeError(f"Could not resolve {local_name(hostname)}")
+    return result.address
@@ -0,0 +1,202 @@
+"""SSH sessions to the fleet over multiplexed connections
+
+Every host gets one ControlMaster connection that later ssh and scp calls
+share, so running several commands (or fetching several files) only pays for
+the TCP and key exchange handshake once per host.
+"""
+
+import asyncio
+import time
+from collections.abc import AsyncIterator, Callable
+from dataclasses import dataclass
+
+from src.config.models import PiConfig
+from src.imaging.cache import CACHE_DIR
+from src.networking.resolver import Resolver, get_resolver, local_name
+
+CONTROL_DIR = CACHE_DIR / "ssh"
+CONTROL_PERSIST = 60  # seconds an idle master connection stays open
+DEFAULT_CONCURRENCY = 16
+
+# Exit status ssh itself uses for connection errors
+SSH_ERROR = 255
+
+READ_SIZE = 64 * 1024
+# Longer lines are passed on in pieces, so output without newlines can't
+# grow the buffer without bound
+LINE_LIMIT = 1024 * 1024
+
+
+@dataclass
+class RemoteResult:
+    pi: PiConfig
+    returncode: int
+    elapsed: float
+
+
+def ssh_options(hostname: str) -> list[str]:
+    """Options sharing one master connection per host and pinning its host key
+
+    The host key is stored under the host name, whatever address it was
+    reached at.
+    """
+    CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return [
+        "-o",
+        "StrictHostKeyChecking=accept-new",
+        "-o",
+        f"HostKeyAlias={hostname}",
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={CONTROL_DIR}/%C",
+        "-o",
+        f"ControlPersist={CONTROL_PERSIST}",
+    ]
+
+
+async def resolve_address(hostname: str, resolver: Resolver | None = None) -> str:
+    """Address to connect to, leaving it to ssh if resolution fails"""
+    result = await (resolver or get_resolver()).resolve(hostname)
+    return result.address if result else local_name(hostname)
+
+
+async def open_master(user: str, hostname: str, address: str) -> tuple[int, str]:
+    """Start (or reuse) the master connection to a host
+
+    The master is started on its own with -fN so it detaches before any
+    command runs, otherwise it would inherit the command's output pipes and
+    keep them open until it exits.
+
+    Returns:
+        (exit status, ssh error output)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "ssh",
+        *ssh_options(hostname),
+        "-o",
+        "BatchMode=yes",
+        "-fN",
+        f"{user}@{address}",
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    returncode = await proc.wait()
+    if returncode == 0:
+        return 0, ""
+
+    error = await proc.stderr.read()
+    return returncode, error.decode(errors="replace").strip()
+
+
+async def read_lines(stream: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Lines of stream without their newline, split at LINE_LIMIT
+
+    Unlike iterating the stream itself, this doesn't fail on lines over the
+    StreamReader's 64 KiB limit.
+    """
+    buffer = b""
+    while chunk := await stream.read(READ_SIZE):
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            yield line
+        while len(buffer) >= LINE_LIMIT:
+            yield buffer[:LINE_LIMIT]
+            buffer = buffer[LINE_LIMIT:]
+    if buffer:
+        yield buffer
+
+
+async def run_remote(
+    user: str,
+    hostname: str,
+    command: str,
+    on_output: Callable[[str, str], None],
+    resolver: Resolver | None = None,
+) -> int:
+    """Run command on a host, streaming its output line by line
+
+    Args:
+        user: SSH username
+        hostname: Pi hostname
+        command: Shell command to run remotely
+        on_output: Called with ("stdout" or "stderr", line) as lines arrive
+        resolver: Resolver for the host name, the shared one by default
+
+    Returns:
+        The remote exit status, 255 if the connection failed
+    """
+    address = await resolve_address(hostname, resolver)
+
+    returncode, error = await open_master(user, hostname, address)
+    if returncode != 0:
+        for line in error.splitlines():
+            on_output("stderr", line)
+        return returncode
+
+    proc = await asyncio.create_subprocess_exec(
+        "ssh",
+        *ssh_options(hostname),
+        "-o",
+        "BatchMode=yes",
+        f"{user}@{address}",
+        command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def pump(stream: asyncio.StreamReader, name: str) -> None:
+        async for line in read_lines(stream):
+            on_output(name, line.decode(errors="replace").rstrip("\r"))
+
+    try:
+        await asyncio.gather(pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"))
+    except BaseException:
+        # Don't leave the command running when its output can't be handled
+        proc.kill()
+        await proc.wait()
+        raise
+    return await proc.wait()
+
+
+async def run_fleet(
+    pis: list[PiConfig],
+    command: str,
+    on_output: Callable[[PiConfig, str, str], None],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    resolver: Resolver | None = None,
+) -> list[RemoteResult]:
+    """Run command on every Pi, at most concurrency at a time
+
+    Args:
+        pis: Pis to run on
+        command: Shell command to run remotely
+        on_output: Called with (pi, stream name, line) as lines arrive
+        concurrency: Maximum number of hosts running at once
+        resolver: Resolver for the host names, the shared one by default
+
+    Returns:
+        Result per Pi, in the order of pis
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run(pi: PiConfig) -> RemoteResult:
+        async with semaphore:
+            start = time.monotonic()
+
+            def report(stream: str, line: str) -> None:
+                on_output(pi, stream, line)
+
+            try:
+                returncode = await run_remote(
+                    pi.user.name, pi.hostname, command, report, resolver
+                )
+            except (OSError, ValueError) as e:
+                # Reported as a connection error, without failing the others
+                report("stderr", str(e))
+                returncode = SSH_ERROR
+            return RemoteResult(pi, returncode, time.monotonic() - start)
+
+    return list(await asyncio.gather(*(run(pi) for pi in pis)))
@@ -1,8 +1,28 @@
 import platform
 
+from src.imaging.writer import FSYNC_POLICIES
 from src.platform.base import PlatformHandler
+from src.platform.linux import LinuxPlatform
 from src.platform.macos import MacOSPlatform
 
+FSYNC_ENV = "PITOOL_FSYNC"
+
+_fsync = "end"
+
+
+def set_fsync_policy(policy: str) -> None:
+    """Select how cards are synced while flashing on Linux, see write_images
+
+    Raises:
+        ValueError: If policy isn't one of FSYNC_POLICIES
+    """
+    global _fsync
+    if policy not in FSYNC_POLICIES:
+        raise ValueError(
+            f"Unknown fsync policy {policy!r}, use {', '.join(FSYNC_POLICIES)}"
+        )
+    _fsync = policy
+
 
 def get_platform_handler() -> PlatformHandler:
     system = platform.system()
@@ -10,7 +30,7 @@ def get_platform_handler() -> PlatformHandler:
     if system == "Darwin":
         return MacOSPlatform()
     elif system == "Linux":
-        raise NotImplementedError("Linux support coming soon")
+        return LinuxPlatform(fsync=_fsync)
     elif system == "Windows":
         raise NotImplementedError("Windows support coming soon")
     else:
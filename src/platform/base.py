@@ -1,6 +1,228 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 from abc import ABC, abstractmethod
+from collections.abc import Iterable
+from contextlib import suppress
+from pathlib import Path
+from typing import BinaryIO
 
+from src.console import console
+from src.imaging.decoders import is_compressed, uncompressed_size
+from src.imaging.fat import write_boot_files
+from src.imaging.writer import ImageHashError, ImageStream, TargetsFailedError
+from src.paths import ROOT_DIR
 from src.platform.models import ExternalDevice
+from src.progress import Tracker
+
+
+def image_size(image_path: Path) -> int | None:
+    """Bytes that flashing image_path writes, None if unknown up front"""
+    if is_compressed(image_path):
+        return uncompressed_size(image_path)
+    return image_path.stat().st_size
+
+
+def check_image_hash(
+    image_path: Path, device_ids: list[str], actual: str | None, expected: str | None
+):
+    """Check the SHA256 of an image decompressed while flashing
+
+    Args:
+        image_path: Image that was flashed
+        device_ids: Devices it was written to, named in the error
+        actual: SHA256 of the data written
+        expected: SHA256 it should have, nothing is checked if None
+
+    Raises:
+        ImageHashError: If it doesn't match, the cards then hold a bad image
+    """
+    if expected and actual != expected:
+        raise ImageHashError(
+            f"Image doesn't match its expected SHA256: {image_path.name}, "
+            f"a corrupt copy was written to {', '.join(device_ids)}"
+        )
+
+
+def _feed(chunks: Iterable[bytes], pipe: BinaryIO, errors: list[BaseException]):
+    """Write chunks to a helper's stdin, closing it once they run out"""
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except BrokenPipeError:
+        # The helper exited early, its return code says why
+        pass
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+        with suppress(BrokenPipeError):
+            pipe.close()
+
+
+def run_privileged_writer(
+    module: str,
+    args: list[str],
+    total: int | None,
+    text: str,
+    labels: list[str] | None = None,
+    verify: bool = False,
+    stdin: Iterable[bytes] | None = None,
+) -> str | None:
+    """Run a writer module as root, following the byte counts it prints
+
+    See src.imaging.writer.main for the line protocol.
+
+    Args:
+        module: Module with a helper entry point, e.g. "src.imaging.writer"
+        args: Arguments for the helper
+        total: Expected number of bytes written per target (for progress)
+        text: Progress bar description
+        labels: One progress bar label per target when writing several
+        verify: Ask the helper to verify and show verification progress
+        stdin: Image contents to pipe to the helper, which is then passed
+            "-" as its image
+
+    Returns:
+        SHA256 of the decompressed image, if the helper decompressed one
+
+    Raises:
+        TargetsFailedError: If some targets failed to write or verify, the
+            others were still written completely
+        RuntimeError: If writing failed
+    """
+    labels = labels or [""]
+    failures: dict[str, str] = {}
+    feed_errors: list[BaseException] = []
+    sha256 = None
+
+    with Tracker() as progress:
+        tasks = [
+            progress.add_task(
+                f"{text} {label}".strip(),
+                total=total,
+                stage="flash",
+                target=label or None,
+            )
+            for label in labels
+        ]
+        verify_tasks = (
+            [
+                progress.add_task(
+                    f"[yellow]Verifying {label}".strip(),
+                    total=total,
+                    start=False,
+                    stage="verify",
+                    target=label or None,
+                )
+                for label in labels
+            ]
+            if verify
+            else []
+        )
+
+        proc = subprocess.Popen(
+            [
+                "sudo",
+                sys.executable,
+                "-m",
+                module,
+                *args,
+                *(["--verify"] if verify else []),
+            ],
+            stdin=subprocess.PIPE if stdin is not None else None,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            cwd=ROOT_DIR,
+        )
+
+        feeder = None
+        if stdin is not None:
+            # The pipe is opened in text mode for stdout, write the raw bytes
+            feeder = threading.Thread(
+                target=_feed,
+                args=(stdin, proc.stdin.buffer, feed_errors),
+                name="image-feeder",
+                daemon=True,
+            )
+            feeder.start()
+
+        for line in proc.stdout:
+            match line.split():
+                # A garbled line must not crash the parent mid-write
+                case [index, advance] if (
+                    index.isdigit() and int(index) < len(tasks) and advance.isdigit()
+                ):
+                    tasks[int(index)].advance(int(advance))
+                case [index, "verify", advance] if (
+                    index.isdigit()
+                    and int(index) < len(verify_tasks)
+                    and advance.isdigit()
+                ):
+                    verify_tasks[int(index)].start()
+                    verify_tasks[int(index)].advance(int(advance))
+                case [index, "failed", *reason] if index.isdigit() and int(index) < len(
+                    labels
+                ):
+                    failures[labels[int(index)] or "device"] = " ".join(reason)
+                case [index, "mismatch", offset] if (
+                    index.isdigit() and int(index) < len(labels) and offset.isdigit()
+                ):
+                    failures[labels[int(index)] or "device"] = (
+                        f"verification failed at offset {offset}"
+                    )
+                case ["sha256", digest]:
+                    sha256 = digest
+
+        proc.wait()
+        if feeder:
+            feeder.join()
+
+    if feed_errors:
+        raise feed_errors[0]
+
+    if failures:
+        raise TargetsFailedError(failures, sha256)
+
+    if proc.returncode != 0:
+        raise RuntimeError("Failed to flash image")
+
+    return sha256
+
+
+def run_privileged_flash(
+    image_path: Path,
+    device_ids: list[str],
+    args: list[str],
+    sha256: str | None = None,
+    **kwargs,
+) -> None:
+    """Run the image writer as root and check the SHA256 it reports
+
+    The image hash is checked even when some targets failed, so the ones that
+    were written aren't taken for good copies of a bad image.
+
+    Args:
+        image_path: Image being flashed, named in errors
+        device_ids: Devices being flashed, in the order of the helper's targets
+        args: Arguments for src.imaging.writer
+        sha256: Expected SHA256 of a decompressed image
+        **kwargs: Passed on to run_privileged_writer
+    """
+    try:
+        written_sha256 = run_privileged_writer(
+            "src.imaging.writer", args, labels=device_ids, **kwargs
+        )
+    except TargetsFailedError as e:
+        written = [d for d in device_ids if d not in e.failures]
+        check_image_hash(image_path, written, e.sha256, sha256)
+        raise
+    check_image_hash(image_path, device_ids, written_sha256, sha256)
 
 
 class PlatformHandler(ABC):
@@ -22,8 +244,38 @@ class PlatformHandler(ABC):
         pass
 
     @abstractmethod
-    def flash_image(self, image_path: str, device_id: str) -> None:
-        """Flash an image to device using dd"""
+    def flash_image(
+        self,
+        image_path: str,
+        device_id: str,
+        verify: bool = False,
+        bmap: bool = False,
+        sha256: str | None = None,
+    ) -> bool:
+        """Flash an image to device, only writing mapped blocks if bmap is set
+
+        With verify set the device is read back and compared against the
+        image, raising RuntimeError on a mismatch. Returns False if the user
+        cancelled. A compressed image is decompressed on the fly and checked
+        against sha256, raising ImageHashError if it doesn't match.
+        """
+        pass
+
+    @abstractmethod
+    def flash_images(
+        self,
+        image_path: str,
+        device_ids: list[str],
+        verify: bool = False,
+        sha256: str | None = None,
+        stream: ImageStream | None = None,
+    ) -> bool:
+        """Flash an image to several devices at once, False if cancelled
+
+        With stream given its chunks are written instead of reading
+        image_path, which only names the image. Raises TargetsFailedError
+        naming the devices that failed once the others are written.
+        """
         pass
 
     @abstractmethod
@@ -31,6 +283,49 @@ class PlatformHandler(ABC):
         """Mount boot partition and return mount point path"""
         pass
 
+    def write_boot_files(self, device_id: str, files: dict[str, str]) -> None:
+        """Write files into the boot partition without mounting it
+
+        The FAT filesystem is edited in place through the whole-disk device,
+        so nothing has to be mounted and no mount point has to be found.
+
+        Args:
+            device_id: Whole-disk device node, e.g. /dev/sdb or /dev/disk4
+            files: File name to contents
+        """
+        # The OS may have auto-mounted the fresh partitions, don't write under it
+        self.unmount_device(device_id)
+
+        console.print("[cyan]Writing cloud-init files to boot partition...[/cyan]")
+
+        if os.access(device_id, os.W_OK):
+            write_boot_files(device_id, files)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                for name, content in files.items():
+                    (Path(tmp) / name).write_text(content)
+                try:
+                    subprocess.run(
+                        [
+                            "sudo",
+                            sys.executable,
+                            "-m",
+                            "src.imaging.fat",
+                            device_id,
+                            tmp,
+                        ],
+                        check=True,
+                        capture_output=True,
+                        text=True,
+                        cwd=ROOT_DIR,
+                    )
+                except subprocess.CalledProcessError as e:
+                    raise RuntimeError(
+                        f"Failed to write boot partition: {device_id}: {e.stderr}"
+                    ) from None
+
+        console.print("[green]✓[/green] Cloud-init files written")
+
     @abstractmethod
     def unmount_and_eject(self, device_id: str) -> None:
         """Unmount and eject device"""
@@ -40,3 +335,8 @@ class PlatformHandler(ABC):
     def trust_certificate(self, cert_path: str) -> None:
         """Trust certificate"""
         pass
+
+    @abstractmethod
+    def is_certificate_trusted(self, cert_path: str) -> bool:
+        """Whether the system already trusts the certificate as a root"""
+        pass
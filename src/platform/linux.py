@@ -0,0 +1,570 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from pathlib import Path
+
+from InquirerPy import inquirer
+from rich.panel import Panel
+
+from src.console import console
+from src.imaging.bmap import MBR_SIGNATURE, BlockMap, load_block_map, write_mapped
+from src.imaging.decoders import is_compressed
+from src.imaging.verify import ChunkDigest, verify_targets
+from src.imaging.writer import (
+    FSYNC_POLICIES,
+    STDIN,
+    ImageStream,
+    TargetsFailedError,
+    image_source,
+    write_images,
+)
+from src.platform.base import (
+    PlatformHandler,
+    check_image_hash,
+    image_size,
+    run_privileged_flash,
+    run_privileged_writer,
+)
+from src.platform.models import ExternalDevice
+from src.progress import Tracker
+
+CA_CERTIFICATE_DIRS = [
+    # Debian / Ubuntu
+    (Path("/usr/local/share/ca-certificates"), ["update-ca-certificates"]),
+    # Fedora / RHEL / Arch
+    (Path("/etc/pki/ca-trust/source/anchors"), ["update-ca-trust", "extract"]),
+]
+
+
+def _lsblk(*args: str) -> list[dict]:
+    result = subprocess.run(
+        ["lsblk", "--json", "--bytes", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout).get("blockdevices", [])
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1000 or unit == "TB":
+            return f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size} B"
+
+
+def _is_disk_image(image_path: Path) -> bool:
+    with open(image_path, "rb") as f:
+        return f.read(512)[510:512] == MBR_SIGNATURE
+
+
+def _verify_source(image_path: Path) -> Path | None:
+    """Image to pinpoint mismatches in, None if it can't be reread at an offset"""
+    return None if is_compressed(image_path) else image_path
+
+
+def _check_image(image_path: Path, bmap: bool) -> None:
+    """Reject files that can't be flashed, compressed images are checked later"""
+    if is_compressed(image_path):
+        if bmap:
+            raise ValueError(f"Block maps need an extracted image: {image_path}")
+        return
+    if not _is_disk_image(image_path):
+        raise ValueError(f"File doesn't appear to be a disk image: {image_path}")
+
+
+class LinuxPlatform(PlatformHandler):
+    def __init__(self, fsync: str = "end"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.fsync = fsync
+
+    def list_external_devices(self) -> list[ExternalDevice]:
+        disks = []
+
+        for device in _lsblk(
+            "--nodeps", "-o", "NAME,PATH,MODEL,SIZE,TRAN,RM,HOTPLUG,TYPE"
+        ):
+            if device.get("type") != "disk":
+                continue
+            if not (device.get("rm") or device.get("hotplug")):
+                continue
+
+            disks.append(
+                ExternalDevice(
+                    id=device["name"],
+                    node=device["path"],
+                    name=(device.get("model") or "").strip() or device["name"],
+                    size=_format_size(int(device.get("size") or 0)),
+                    protocol=(device.get("tran") or "").upper(),
+                    location="External",
+                )
+            )
+
+        return disks
+
+    def _require_external_device(self, device_id: str):
+        """Guard against non-external devices"""
+
+        valid_nodes = [d.node for d in self.list_external_devices()]
+
+        if device_id not in valid_nodes:
+            raise ValueError(f"Device {device_id} is not a external device")
+
+    def _partitions(self, device_id: str) -> list[dict]:
+        devices = _lsblk("-o", "PATH,LABEL,MOUNTPOINTS,TYPE", device_id)
+        return [
+            child
+            for device in devices
+            for child in device.get("children", [])
+            if child.get("type") == "part"
+        ]
+
+    def unmount_device(self, device_id: str) -> None:
+        self._require_external_device(device_id)
+
+        console.print(f"[cyan]Unmounting {device_id}...[/cyan]")
+
+        for partition in self._partitions(device_id):
+            if not any(partition.get("mountpoints") or []):
+                continue
+            try:
+                subprocess.run(
+                    ["sudo", "umount", partition["path"]],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(
+                    f"Failed to unmount device: {partition['path']}: {e.stderr}"
+                ) from None
+
+        console.print("[green]✓[/green] Device unmounted")
+
+    def flash_image(
+        self,
+        image_path: str,
+        device_id: str,
+        verify: bool = False,
+        bmap: bool = False,
+        sha256: str | None = None,
+    ) -> bool:
+        """Flash image to device with an in-process double-buffered writer
+
+        With bmap enabled only the ranges listed in the image's block map are
+        written. With verify enabled the device is read back once and compared
+        against chunk digests recorded while writing. A compressed image is
+        decompressed while writing and checked against sha256.
+        """
+
+        self._require_external_device(device_id)
+
+        image_resolved_path = Path(image_path)
+
+        if not image_resolved_path.exists():
+            raise FileNotFoundError(f"Image does not exist: {image_path}")
+
+        _check_image(image_resolved_path, bmap)
+
+        devices = self.list_external_devices()
+        device_info = next((d for d in devices if d.node == device_id), None)
+
+        block_map = None
+        mapped_info = ""
+        if bmap:
+            with console.status("[cyan]Computing block map...[/cyan]"):
+                block_map = load_block_map(image_resolved_path)
+            mapped_info = (
+                f"  Mapped: {block_map.mapped_bytes / (1024**2):.1f} MB of "
+                f"{block_map.image_size / (1024**2):.1f} MB\n"
+            )
+
+        console.print(
+            Panel(
+                f"[bold]This will erase all data on:[/bold]\n"
+                f"  Device: [red]{device_id}[/red]\n"
+                f"  Name: {device_info.name if device_info else 'Unknown'}\n"
+                f"  Size: {device_info.size if device_info else 'Unknown'}\n"
+                f"  Image: {image_resolved_path.name}\n"
+                f"{mapped_info}",
+                title="WARNING",
+                border_style="yellow",
+            )
+        )
+
+        confirmed = inquirer.confirm(
+            message="Are you sure you want to continue?", default=False
+        ).execute()
+
+        if not confirmed:
+            console.print("[yellow]Cancelled by user[/yellow]")
+            return False
+
+        self.unmount_device(device_id)
+
+        console.print(
+            f"[yellow]Flashing {image_resolved_path.name} to {device_id}...[/yellow]"
+        )
+
+        if block_map is not None:
+            digests = self._flash_mapped(
+                image_resolved_path, device_id, block_map, verify
+            )
+        else:
+            digests, failures = self._flash_direct(
+                image_resolved_path, [device_id], verify, sha256
+            )
+            if failures:
+                raise TargetsFailedError(failures)
+
+        console.print("[green]✓ Image flashed successfully[/green]")
+
+        if digests is not None:
+            self._verify(_verify_source(image_resolved_path), [device_id], digests)
+
+        return True
+
+    def flash_images(
+        self,
+        image_path: str,
+        device_ids: list[str],
+        verify: bool = False,
+        sha256: str | None = None,
+        stream: ImageStream | None = None,
+    ) -> bool:
+        """Flash one image to several devices at once, reading it only once
+
+        With stream given its chunks are written instead, e.g. while the
+        image is still downloading.
+
+        Returns:
+            False if the user cancelled
+
+        Raises:
+            TargetsFailedError: If some devices failed to write or verify, the
+                others were still written completely
+        """
+
+        for device_id in device_ids:
+            self._require_external_device(device_id)
+
+        image_resolved_path = Path(image_path)
+        if stream is None:
+            if not image_resolved_path.exists():
+                raise FileNotFoundError(f"Image does not exist: {image_path}")
+
+            _check_image(image_resolved_path, bmap=False)
+
+        devices = {d.node: d for d in self.list_external_devices()}
+        device_lines = "".join(
+            f"  [red]{device_id}[/red] {devices[device_id].name} "
+            f"({devices[device_id].size})\n"
+            for device_id in device_ids
+        )
+
+        console.print(
+            Panel(
+                f"[bold]This will erase all data on {len(device_ids)} devices:"
+                f"[/bold]\n{device_lines}"
+                f"  Image: {image_resolved_path.name}\n",
+                title="WARNING",
+                border_style="yellow",
+            )
+        )
+
+        confirmed = inquirer.confirm(
+            message="Are you sure you want to continue?", default=False
+        ).execute()
+
+        if not confirmed:
+            console.print("[yellow]Cancelled by user[/yellow]")
+            return False
+
+        for device_id in device_ids:
+            self.unmount_device(device_id)
+
+        digests, failures = self._flash_direct(
+            image_resolved_path, device_ids, verify, sha256, stream
+        )
+        written = [device_id for device_id in device_ids if device_id not in failures]
+
+        console.print(f"[green]✓ Image flashed to {len(written)} devices[/green]")
+
+        if digests is not None and written:
+            source = None if stream else _verify_source(image_resolved_path)
+            try:
+                self._verify(source, written, digests)
+            except TargetsFailedError as e:
+                failures |= e.failures
+
+        if failures:
+            raise TargetsFailedError(failures)
+
+        return True
+
+    def _flash_direct(
+        self,
+        image_path: Path,
+        device_ids: list[str],
+        verify: bool,
+        sha256: str | None = None,
+        stream: ImageStream | None = None,
+    ) -> tuple[list[ChunkDigest] | None, dict[str, str]]:
+        """Write image to devices
+
+        A compressed image or a stream is decompressed while writing and its
+        contents are checked against sha256.
+
+        Returns:
+            Digests still to be verified, and the reason per device that
+            failed while the others were written
+        """
+        total_size = stream.size if stream else image_size(image_path)
+
+        if not all(os.access(device_id, os.W_OK) for device_id in device_ids):
+            run_privileged_flash(
+                image_path,
+                device_ids,
+                [
+                    STDIN if stream else str(image_path.resolve()),
+                    *device_ids,
+                    "--fsync",
+                    self.fsync,
+                ],
+                sha256,
+                total=total_size,
+                text="[cyan]Flashing",
+                verify=verify,
+                stdin=stream.chunks if stream else None,
+            )
+            return None, {}
+
+        digests: list[ChunkDigest] | None = [] if verify else None
+        failures: dict[str, str] = {}
+        source = stream.chunks if stream else image_source(image_path)
+        hasher = None if isinstance(source, Path) else hashlib.sha256()
+
+        with Tracker() as progress:
+            tasks = {
+                device_id: progress.add_task(
+                    f"[cyan]Flashing {device_id}",
+                    total=total_size,
+                    stage="flash",
+                    target=device_id,
+                )
+                for device_id in device_ids
+            }
+
+            def on_progress(device_id: str, advance: int) -> None:
+                tasks[device_id].advance(advance)
+
+            try:
+                write_images(
+                    source,
+                    device_ids,
+                    fsync=self.fsync,
+                    on_progress=on_progress,
+                    digests=digests,
+                    on_data=hasher.update if hasher else None,
+                )
+            except TargetsFailedError as e:
+                failures = e.failures
+
+        if hasher:
+            written = [d for d in device_ids if d not in failures]
+            check_image_hash(image_path, written, hasher.hexdigest(), sha256)
+
+        return digests, failures
+
+    def _flash_mapped(
+        self, image_path: Path, device_id: str, block_map: BlockMap, verify: bool
+    ) -> list[ChunkDigest] | None:
+        """Write mapped ranges, returning digests still to be verified"""
+        if not os.access(device_id, os.W_OK):
+            run_privileged_writer(
+                "src.imaging.bmap",
+                [str(image_path.resolve()), device_id],
+                total=block_map.mapped_bytes,
+                text="[cyan]Flashing mapped blocks...",
+                verify=verify,
+            )
+            return None
+
+        digests: list[ChunkDigest] | None = [] if verify else None
+
+        with Tracker() as progress:
+            task = progress.add_task(
+                "[cyan]Flashing mapped blocks...",
+                total=block_map.mapped_bytes,
+                stage="flash",
+                target=device_id,
+            )
+
+            write_mapped(
+                image_path,
+                device_id,
+                block_map,
+                on_progress=task.advance,
+                digests=digests,
+            )
+
+        return digests
+
+    def _verify(
+        self,
+        source: Path | None,
+        device_ids: list[str],
+        digests: list[ChunkDigest],
+    ) -> None:
+        total = sum(digest.length for digest in digests)
+
+        with Tracker() as progress:
+            tasks = {
+                device_id: progress.add_task(
+                    f"[yellow]Verifying {device_id}",
+                    total=total,
+                    stage="verify",
+                    target=device_id,
+                )
+                for device_id in device_ids
+            }
+
+            def on_progress(device_id: str, advance: int) -> None:
+                tasks[device_id].advance(advance)
+
+            results = verify_targets(
+                device_ids, digests, source=source, on_progress=on_progress
+            )
+
+        mismatches = {
+            device_id: f"verification failed at offset {offset}"
+            for device_id, offset in results.items()
+            if offset is not None
+        }
+        if mismatches:
+            raise TargetsFailedError(mismatches)
+
+        console.print("[green]✓ Image verified successfully[/green]")
+
+    def mount_boot_partition(self, device_id: str) -> str:
+        console.print(f"[cyan]Looking for boot partition on {device_id}...[/cyan]")
+
+        # Make the kernel pick up the freshly written partition table
+        subprocess.run(
+            ["sudo", "blockdev", "--rereadpt", device_id], capture_output=True
+        )
+        subprocess.run(["udevadm", "settle"], capture_output=True)
+
+        try:
+            partitions = self._partitions(device_id)
+        except subprocess.CalledProcessError:
+            raise RuntimeError(
+                f"Failed to list disk partitions for {device_id}"
+            ) from None
+
+        boot_partition = next(
+            (p for p in partitions if p.get("label") == "bootfs"), None
+        )
+        if boot_partition is None:
+            raise RuntimeError("Boot partition not found")
+
+        mountpoints = [m for m in boot_partition.get("mountpoints") or [] if m]
+        if mountpoints:
+            return mountpoints[0]
+
+        try:
+            result = subprocess.run(
+                ["udisksctl", "mount", "-b", boot_partition["path"]],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            raise RuntimeError("Failed to mount boot partition") from None
+
+        match = re.search(r"Mounted \S+ at (.+?)\.?$", result.stdout.strip())
+        if not match:
+            raise RuntimeError("Mount point not found")
+
+        return match.group(1)
+
+    def unmount_and_eject(self, device_id: str) -> None:
+        self.unmount_device(device_id)
+
+        try:
+            subprocess.run(["sync"], check=True)
+            subprocess.run(
+                ["sudo", "eject", device_id], check=True, capture_output=True
+            )
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(
+                f"Failed to eject device: {device_id}: {e.stderr}"
+            ) from None
+
+        console.print("[green]✓[/green] Device ejected")
+
+    def is_certificate_trusted(self, cert_path: str) -> bool:
+        """Whether a CA store directory holds a copy of the certificate
+
+        Args:
+            cert_path: Path to .pem certificate file
+        """
+        content = Path(cert_path).read_bytes()
+        for directory, _ in CA_CERTIFICATE_DIRS:
+            try:
+                installed = [path for path in directory.iterdir() if path.is_file()]
+            except OSError:
+                continue
+            for path in installed:
+                try:
+                    if path.read_bytes() == content:
+                        return True
+                except OSError:
+                    continue
+        return False
+
+    def trust_certificate(self, cert_path: str) -> None:
+        """Trust certificate by adding it to the system CA store
+
+        Args:
+            cert_path: Path to .pem certificate file
+        """
+        if not Path(cert_path).exists():
+            raise FileNotFoundError(f"Certificate not found: {cert_path}")
+
+        target = next(
+            (
+                (directory, command)
+                for directory, command in CA_CERTIFICATE_DIRS
+                if directory.exists() and shutil.which(command[0])
+            ),
+            None,
+        )
+        if target is None:
+            raise RuntimeError("No supported system CA store found")
+
+        directory, command = target
+        destination = directory / f"pitool-{Path(cert_path).stem}.crt"
+
+        console.print("[cyan]Installing certificate to system CA store...[/cyan]")
+
+        try:
+            subprocess.run(
+                ["sudo", "cp", cert_path, str(destination)],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            subprocess.run(
+                ["sudo", *command], check=True, capture_output=True, text=True
+            )
+        except subprocess.CalledProcessError as e:
+            error_msg = e.stderr.strip() if e.stderr else "Unknown error"
+            raise RuntimeError(f"Failed to trust certificate: {error_msg}") from None
+
+        console.print("[green]✓[/green] Certificate trusted (system CA store)")
@@ -1,16 +1,22 @@
-import hashlib
 import re
 import subprocess
 from pathlib import Path
 
 from InquirerPy import inquirer
 from rich.panel import Panel
-from rich.progress import Progress
 
 from src.console import console
-from src.platform.base import PlatformHandler
+from src.imaging.bmap import BlockMap, load_block_map
+from src.imaging.decoders import is_compressed
+from src.imaging.writer import STDIN, ImageStream
+from src.platform.base import (
+    PlatformHandler,
+    image_size,
+    run_privileged_flash,
+    run_privileged_writer,
+)
 from src.platform.models import ExternalDevice
-from src.utils import calculate_hash
+from src.progress import Tracker
 
 
 def _get_device_info(device: str) -> ExternalDevice:
@@ -42,53 +48,6 @@ def _get_device_info(device: str) -> ExternalDevice:
     )
 
 
-def _hash_device(device_path: str, size: int) -> str:
-    with Progress() as progress:
-        task = progress.add_task("[yellow]Hashing device...[/yellow]", total=size)
-
-        hasher = hashlib.sha256()
-        bytes_read = 0
-        chunk_size = 1024 * 1024  # 1MB chunks
-
-        # Use sudo dd to read device, NO count parameter
-        proc = subprocess.Popen(
-            ["sudo", "dd", f"if={device_path}", "bs=1m", "status=none"],
-            stdout=subprocess.PIPE,
-        )
-
-        # Read EXACTLY size bytes from stdout
-        while bytes_read < size:
-            to_read = min(chunk_size, size - bytes_read)
-            chunk = proc.stdout.read(to_read)
-            if not chunk:
-                break
-            hasher.update(chunk)
-            bytes_read += len(chunk)
-            progress.update(task, advance=len(chunk))
-
-        # Terminate dd (we got what we needed)
-        proc.terminate()
-        proc.wait()
-
-        return hasher.hexdigest()
-
-
-def _verify_flashed_device(image_path: str, device_id: str):
-    """Verify flashed image matches source by comparing hashes"""
-
-    console.print("[cyan]Verifying flashed image on device...[/cyan]")
-
-    image_size = Path(image_path).stat().st_size
-    raw_device = device_id.replace("/dev/disk", "/dev/rdisk")
-
-    source_hash = calculate_hash(
-        image_path, text="[yellow]Calculating image hash...[/yellow]"
-    )
-    device_hash = _hash_device(raw_device, image_size)
-
-    return source_hash == device_hash
-
-
 class MacOSPlatform(PlatformHandler):
     def list_external_devices(self) -> list[ExternalDevice]:
         result = subprocess.run(
@@ -149,9 +108,22 @@ class MacOSPlatform(PlatformHandler):
         console.print("[green]✓[/green] Device unmounted")
 
     def flash_image(
-        self, image_path: str, device_id: str, verify: bool = False
-    ) -> None:
-        """Flash image to device with safety checks"""
+        self,
+        image_path: str,
+        device_id: str,
+        verify: bool = False,
+        bmap: bool = False,
+        sha256: str | None = None,
+    ) -> bool:
+        """Flash image to device with safety checks
+
+        With bmap enabled only the ranges listed in the image's block map are
+        written, skipping free filesystem space and zero-filled gaps. With
+        verify enabled the image is written by pitool's own writer, which
+        records chunk digests and reads the device back once afterwards. A
+        compressed image is always written by pitool's writer, decompressing
+        it on the fly and checking it against sha256.
+        """
 
         self._require_external_device(device_id)
 
@@ -159,11 +131,17 @@ class MacOSPlatform(PlatformHandler):
         if not Path(image_path).exists():
             raise FileNotFoundError(f"Image does not exist: {image_path}")
 
-        # Verify it's a disk image
+        image_resolved_path = Path(image_path)
+        compressed = is_compressed(image_resolved_path)
+
+        if compressed and bmap:
+            raise ValueError(f"Block maps need an extracted image: {image_path}")
+
+        # Verify it's a disk image, compressed ones are checked while writing
         file_check = subprocess.run(
             ["file", image_path], capture_output=True, text=True
         )
-        if (
+        if not compressed and (
             "DOS/MBR boot sector" not in file_check.stdout
             and "block special" not in file_check.stdout
         ):
@@ -171,17 +149,27 @@ class MacOSPlatform(PlatformHandler):
                 "File doesn't appear to be a disk image: {file_check.stdout}"
             )
 
-        image_resolved_path = Path(image_path)
         devices = self.list_external_devices()
         device_info = next((d for d in devices if d.node == device_id), None)
 
+        block_map = None
+        mapped_info = ""
+        if bmap:
+            with console.status("[cyan]Computing block map...[/cyan]"):
+                block_map = load_block_map(image_resolved_path)
+            mapped_info = (
+                f"  Mapped: {block_map.mapped_bytes / (1024**2):.1f} MB of "
+                f"{block_map.image_size / (1024**2):.1f} MB\n"
+            )
+
         console.print(
             Panel(
                 f"[bold]This will erase all data on:[/bold]\n"
                 f"  Device: [red]{device_id}[/red]\n"
                 f"  Name: {device_info.name if device_info else 'Unknown'}\n"
                 f"  Size: {device_info.size if device_info else 'Unknown'}\n"
-                f"  Image: {image_resolved_path.name}\n",
+                f"  Image: {image_resolved_path.name}\n"
+                f"{mapped_info}",
                 title="WARNING",
                 border_style="yellow",
             )
@@ -193,7 +181,7 @@ class MacOSPlatform(PlatformHandler):
 
         if not confirmed:
             console.print("[yellow]Cancelled by user[/yellow]")
-            return
+            return False
 
         self.unmount_device(device_id)
 
@@ -204,15 +192,119 @@ class MacOSPlatform(PlatformHandler):
             f"[yellow]Flashing {image_resolved_path.name} to {device_id}...[/yellow]"
         )
 
-        total_size = image_resolved_path.stat().st_size
+        if block_map is not None:
+            self._flash_mapped(image_resolved_path, raw_device, block_map, verify)
+        elif verify or compressed:
+            run_privileged_flash(
+                image_resolved_path,
+                [device_id],
+                [str(image_resolved_path.resolve()), raw_device],
+                sha256,
+                total=image_size(image_resolved_path),
+                text="[cyan]Flashing image...",
+                verify=verify,
+            )
+        else:
+            self._flash_dd(image_resolved_path, raw_device)
+
+        console.print("[green]✓ Image flashed successfully[/green]")
+
+        if verify:
+            console.print("[green]✓ Image verified successfully[/green]")
+
+        return True
+
+    def flash_images(
+        self,
+        image_path: str,
+        device_ids: list[str],
+        verify: bool = False,
+        sha256: str | None = None,
+        stream: ImageStream | None = None,
+    ) -> bool:
+        """Flash one image to several devices at once, reading it only once
+
+        With stream given its chunks are written instead, e.g. while the
+        image is still downloading.
+
+        Returns:
+            False if the user cancelled
+
+        Raises:
+            TargetsFailedError: If some devices failed to write or verify, the
+                others were still written completely
+        """
+
+        for device_id in device_ids:
+            self._require_external_device(device_id)
+
+        image_resolved_path = Path(image_path)
+        if stream is None and not image_resolved_path.exists():
+            raise FileNotFoundError(f"Image does not exist: {image_path}")
+
+        devices = {d.node: d for d in self.list_external_devices()}
+        device_lines = "".join(
+            f"  [red]{device_id}[/red] {devices[device_id].name} "
+            f"({devices[device_id].size})\n"
+            for device_id in device_ids
+        )
+
+        console.print(
+            Panel(
+                f"[bold]This will erase all data on {len(device_ids)} devices:"
+                f"[/bold]\n{device_lines}"
+                f"  Image: {image_resolved_path.name}\n",
+                title="WARNING",
+                border_style="yellow",
+            )
+        )
 
-        with Progress() as progress:
-            task = progress.add_task("[cyan]Flashing image...", total=total_size)
+        confirmed = inquirer.confirm(
+            message="Are you sure you want to continue?", default=False
+        ).execute()
+
+        if not confirmed:
+            console.print("[yellow]Cancelled by user[/yellow]")
+            return False
+
+        for device_id in device_ids:
+            self.unmount_device(device_id)
+
+        raw_devices = [d.replace("/dev/disk", "/dev/rdisk") for d in device_ids]
+
+        run_privileged_flash(
+            image_resolved_path,
+            device_ids,
+            [STDIN if stream else str(image_resolved_path.resolve()), *raw_devices],
+            sha256,
+            total=stream.size if stream else image_size(image_resolved_path),
+            text="[cyan]Flashing",
+            verify=verify,
+            stdin=stream.chunks if stream else None,
+        )
+
+        console.print(f"[green]✓ Image flashed to {len(device_ids)} devices[/green]")
+
+        if verify:
+            console.print("[green]✓ Image verified successfully[/green]")
+
+        return True
+
+    def _flash_dd(self, image_path: Path, raw_device: str) -> None:
+        total_size = image_path.stat().st_size
+
+        with Tracker() as progress:
+            task = progress.add_task(
+                "[cyan]Flashing image...",
+                total=total_size,
+                stage="flash",
+                target=raw_device,
+            )
             proc = subprocess.Popen(
                 [
                     "sudo",
                     "/bin/dd",
-                    f"if={str(image_resolved_path.resolve())}",
+                    f"if={str(image_path.resolve())}",
                     f"of={raw_device}",
                     "bs=1m",
                     "status=progress",
@@ -226,22 +318,25 @@ class MacOSPlatform(PlatformHandler):
                 match = re.search(r"(\d+) bytes", line)
                 if match:
                     bytes_written = int(match.group(1))
-                    progress.update(task, completed=bytes_written)
+                    task.update(completed=bytes_written)
 
             proc.wait()
 
             if proc.returncode != 0:
                 raise RuntimeError("Failed to flash image")
 
-        console.print("[green]✓ Image flashed successfully[/green]")
-
-        # TODO: not working
-        # if verify and not _verify_flashed_device(image_path, device_id):
-        #     raise RuntimeError(
-        #         "Verification failed! Flashed image doesn't match source"
-        #     )
-        #
-        # console.print("[green]✓ Image verified successfully[/green]")
+    def _flash_mapped(
+        self, image_path: Path, raw_device: str, block_map: BlockMap, verify: bool
+    ) -> None:
+        """Write only mapped ranges through a privileged helper process"""
+
+        run_privileged_writer(
+            "src.imaging.bmap",
+            [str(image_path.resolve()), raw_device],
+            total=block_map.mapped_bytes,
+            text="[cyan]Flashing mapped blocks...",
+            verify=verify,
+        )
 
     def mount_boot_partition(self, device_id: str) -> str:
         console.print(f"[cyan]Looking for boot partition on {device_id}...[/cyan]")
@@ -304,6 +399,24 @@ class MacOSPlatform(PlatformHandler):
 
         console.print("[green]✓[/green] Device ejected")
 
+    def is_certificate_trusted(self, cert_path: str) -> bool:
+        """Whether the certificate verifies as a trusted root
+
+        A keychain can hold a certificate without trusting it, so this checks
+        the trust settings of the admin and user domains trust_certificate
+        writes to, not just its presence.
+
+        Args:
+            cert_path: Path to .pem certificate file
+        """
+        # -l accepts a CA as the leaf, -L keeps it to local certificates
+        result = subprocess.run(
+            ["security", "verify-cert", "-c", cert_path, "-l", "-L"],
+            capture_output=True,
+            text=True,
+        )
+        return result.returncode == 0
+
     def trust_certificate(self, cert_path: str) -> None:
         """Trust certificate using macOS security command
 
@@ -0,0 +1,222 @@
+"""Progress reporting kept out of the I/O loops
+
+Loops only add to a task's counter. A renderer thread samples the counters a
+few times a second and either draws Rich progress bars or, for scripts, emits
+one JSON object per line with bytes, rate and ETA per stage
+(``pitool --progress json``). Stages are named by a fixed id such as
+``"flash"`` plus the device or file they work on, never by their display text.
+"""
+
+import json
+import sys
+import threading
+import time
+from typing import TextIO
+
+MODES = ("rich", "json", "none")
+
+RICH_INTERVAL = 0.1
+JSON_INTERVAL = 1.0
+
+# Weight of the newest sample in the smoothed rate
+RATE_SMOOTHING = 0.3
+
+_mode = "rich"
+
+
+def set_mode(mode: str) -> None:
+    """Select how progress is shown for the rest of the process
+
+    Raises:
+        ValueError: If mode isn't one of MODES
+    """
+    global _mode
+    if mode not in MODES:
+        raise ValueError(f"Unknown progress mode {mode!r}, use {', '.join(MODES)}")
+    _mode = mode
+
+
+def get_mode() -> str:
+    return _mode
+
+
+class Task:
+    """Counter for one stage, cheap enough to advance per chunk from any thread"""
+
+    def __init__(
+        self,
+        description: str,
+        total: int | None,
+        start: bool = True,
+        stage: str | None = None,
+        target: str | None = None,
+    ):
+        self.description = description
+        self.stage = stage
+        self.target = target
+        self.total = total
+        self.completed = 0
+        self.started_at = time.monotonic() if start else None
+        self._lock = threading.Lock()
+
+    def advance(self, amount: int) -> None:
+        with self._lock:
+            self.completed += amount
+
+    def update(self, total: int | None = None, completed: int | None = None) -> None:
+        with self._lock:
+            if total is not None:
+                self.total = total
+            if completed is not None:
+                self.completed = completed
+
+    def start(self) -> None:
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+
+class _RichRenderer:
+    def __init__(self):
+        from rich.progress import Progress
+
+        # Refreshed by the sampling thread, no need for Rich's own
+        self.progress = Progress(auto_refresh=False)
+        self.progress.start()
+        self.ids = {}
+
+    def sample(self, tasks: list[Task]) -> None:
+        for task in tasks:
+            if task not in self.ids:
+                self.ids[task] = self.progress.add_task(
+                    task.description, total=task.total, start=False
+                )
+            task_id = self.ids[task]
+            if task.started_at is not None:
+                self.progress.start_task(task_id)
+            self.progress.update(task_id, total=task.total, completed=task.completed)
+        self.progress.refresh()
+
+    def close(self, tasks: list[Task]) -> None:
+        self.sample(tasks)
+        self.progress.stop()
+
+
+class _JsonRenderer:
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        # Per task: (time, completed) of the last sample and the smoothed rate
+        self.last: dict[Task, tuple[float, int, float]] = {}
+
+    @staticmethod
+    def _description(description: str) -> str:
+        from rich.errors import MarkupError
+        from rich.text import Text
+
+        try:
+            return Text.from_markup(description).plain.strip(" .")
+        except MarkupError:
+            return description
+
+    def _emit(self, event: str, task: Task, now: float) -> None:
+        completed, total = task.completed, task.total
+        last_time, last_completed, rate = self.last.get(task, (task.started_at, 0, 0.0))
+
+        if now > last_time:
+            current = (completed - last_completed) / (now - last_time)
+            rate = (
+                current
+                if task not in self.last
+                else RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * rate
+            )
+        self.last[task] = (now, completed, rate)
+
+        remaining = total - completed if total else None
+        eta = remaining / rate if remaining is not None and rate > 0 else None
+
+        record = {
+            "event": event,
+            "stage": task.stage,
+            "target": task.target,
+            "description": self._description(task.description),
+            "bytes": completed,
+            "total": total,
+            "rate": round(rate),
+            "eta": None if eta is None else round(eta, 1),
+            "elapsed": round(now - task.started_at, 3),
+        }
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def sample(self, tasks: list[Task]) -> None:
+        now = time.monotonic()
+        for task in tasks:
+            if task.started_at is not None:
+                self._emit("progress", task, now)
+
+    def close(self, tasks: list[Task]) -> None:
+        now = time.monotonic()
+        for task in tasks:
+            if task.started_at is not None:
+                self._emit("done", task, now)
+
+
+class Tracker:
+    """Tasks of one operation, rendered while the context is active
+
+    Used like rich.progress.Progress, except that tasks are advanced directly
+    and rendering happens on a separate thread at a fixed rate.
+    """
+
+    def __init__(self, mode: str | None = None, stream: TextIO | None = None):
+        self.mode = mode or _mode
+        self.stream = stream or sys.stdout
+        self.tasks: list[Task] = []
+        self._renderer = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add_task(
+        self,
+        description: str,
+        total: int | None = None,
+        start: bool = True,
+        stage: str | None = None,
+        target: str | None = None,
+    ) -> Task:
+        """Add a task, identified in JSON output by stage and target
+
+        Args:
+            description: Text shown next to the bar, may contain Rich markup
+            total: Expected number of bytes, None if unknown
+            start: Whether the task's clock starts now
+            stage: Fixed id of what the task does, e.g. "download" or "flash"
+            target: Device or file the task works on, if any
+        """
+        task = Task(description, total, start, stage, target)
+        self.tasks.append(task)
+        return task
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self._renderer.sample(list(self.tasks))
+
+    def __enter__(self) -> "Tracker":
+        if self.mode == "rich":
+            self._renderer, interval = _RichRenderer(), RICH_INTERVAL
+        elif self.mode == "json":
+            self._renderer, interval = _JsonRenderer(self.stream), JSON_INTERVAL
+        else:
+            return self
+
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="progress", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._renderer.close(list(self.tasks))
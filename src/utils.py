@@ -1,13 +1,48 @@
-import hashlib
+import json
+import os
 from pathlib import Path
 
-from rich.progress import Progress
+from src.imaging.treehash import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WORKERS,
+    TreeHash,
+    tree_hash,
+)
+from src.imaging.verify import verify_target
+from src.progress import Tracker
+
+
+def calculate_tree_hash(
+    path: str,
+    size: int | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    text: str = "[yellow]Calculating hash...[/yellow]",
+) -> TreeHash:
+    """Calculate SHA256 hash of file or device along with per chunk digests
+
+    Args:
+        path: Path to file or device
+        size: Number of bytes to read (None = entire file)
+        chunk_size: Bytes per chunk digest
+        text: Progress bar description
+
+    Returns:
+        The SHA256 hash and chunk digests, see src.imaging.treehash
+    """
+
+    if size is None:
+        size = Path(path).stat().st_size
+
+    with Tracker() as progress:
+        task = progress.add_task(text, total=size, stage="hash", target=str(path))
+
+        return tree_hash(path, size, chunk_size=chunk_size, on_progress=task.advance)
 
 
 def calculate_hash(
     path: str,
     size: int | None = None,
-    chunk_size: int = 4096,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
     text: str = "[yellow]Calculating hash...[/yellow]",
 ) -> str:
     """Calculate SHA256 hash of file or device
@@ -15,29 +50,74 @@ def calculate_hash(
     Args:
         path: Path to file or device
         size: Number of bytes to read (None = entire file)
-        chunk_size: Bytes to read per chunk
+        chunk_size: Bytes per chunk hashed in parallel alongside
         text: Progress bar description
 
     Returns:
         SHA256 hash as hex string
     """
+    return calculate_tree_hash(path, size, chunk_size, text).sha256
 
-    if size is None:
-        size = Path(path).stat().st_size
 
-    with Progress() as progress:
-        task = progress.add_task(text, total=size)
+def _stat_key(path: Path) -> list[int]:
+    info = os.stat(path)
+    return [info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns]
+
+
+def hash_memo_path(path: Path) -> Path:
+    return path.with_name(path.name + ".sha256.json")
+
+
+def remember_hash(path: Path, sha256: str, tree: TreeHash | None = None) -> None:
+    """Record sha256 as the hash of path in its current on-disk state"""
+    memo = {"stat": _stat_key(path), "sha256": sha256}
+    if tree is not None:
+        memo["tree"] = tree.to_dict()
+    hash_memo_path(path).write_text(json.dumps(memo))
+
+
+def _unchanged_since(path: Path, tree: TreeHash, text: str) -> bool:
+    """Check the chunks of path against tree in parallel"""
+    if path.stat().st_size != tree.size:
+        return False
+
+    with Tracker() as progress:
+        task = progress.add_task(text, total=tree.size, stage="hash", target=str(path))
+
+        return (
+            verify_target(
+                str(path),
+                tree.chunks,
+                workers=DEFAULT_WORKERS,
+                on_progress=task.advance,
+            )
+            is None
+        )
+
+
+def calculate_hash_memoized(
+    path: Path, text: str = "[yellow]Calculating hash...[/yellow]"
+) -> str:
+    """Calculate SHA256 of a file, reusing the last result if it is unchanged
+
+    The hash is stored in a sidecar file keyed by (device, inode, size,
+    mtime_ns), so an untouched file is never read again. A file that was
+    touched is checked against the chunk digests recorded with the hash,
+    which are read and hashed in parallel instead of in one linear pass.
+    """
+    try:
+        memo = json.loads(hash_memo_path(path).read_text())
+        if memo["stat"] == _stat_key(path):
+            return memo["sha256"]
+        tree = TreeHash.from_dict(memo["tree"]) if "tree" in memo else None
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        tree = None
 
-        hasher = hashlib.sha256()
-        bytes_read = 0
+    if tree is not None and _unchanged_since(path, tree, text):
+        remember_hash(path, tree.sha256, tree)
+        return tree.sha256
 
-        with open(path, "rb") as f:
-            while bytes_read < size:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                hasher.update(chunk)
-                bytes_read += len(chunk)
-                progress.update(task, advance=len(chunk))
+    tree = calculate_tree_hash(str(path), text=text)
+    remember_hash(path, tree.sha256, tree)
 
-        return hasher.hexdigest()
+    return tree.sha256
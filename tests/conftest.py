@@ -0,0 +1,107 @@
+import hashlib
+import lzma
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.servers import range_handler, serve
+
+# Keep the cache and every other per-user file out of the real home. Set before
+# anything from src is imported, CACHE_DIR is resolved at import time.
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="pitool_test_cache_")
+os.environ.setdefault("PITOOL_PROGRESS", "none")
+
+MB = 1024 * 1024
+
+# Not a multiple of any buffer size, so the last write is always a short one
+IMAGE_SIZE = 9 * MB + 12345
+
+
+def make_image(size: int = IMAGE_SIZE) -> bytes:
+    """Partly compressible image data: random runs between zeros"""
+    blocks = []
+    for i in range(-(-size // MB)):
+        blocks.append(os.urandom(MB // 4) + bytes(MB - MB // 4) if i % 2 else bytes(MB))
+    return b"".join(blocks)[:size]
+
+
+@pytest.fixture(autouse=True)
+def _progress_off():
+    from src.progress import set_mode
+
+    set_mode("none")
+
+
+@pytest.fixture
+def image(tmp_path: Path) -> Path:
+    path = tmp_path / "pi.img"
+    path.write_bytes(make_image())
+    return path
+
+
+@pytest.fixture
+def compressed_image(image: Path) -> Path:
+    path = image.with_name(image.name + ".xz")
+    path.write_bytes(lzma.compress(image.read_bytes()))
+    return path
+
+
+@pytest.fixture
+def cache_dir(tmp_path: Path, monkeypatch) -> Path:
+    """An empty image cache for one test"""
+    from src.imaging import cache
+
+    root = tmp_path / "cache"
+    monkeypatch.setattr(cache, "CACHE_DIR", root)
+    monkeypatch.setattr(cache, "IMAGES_DIR", root / "images")
+    monkeypatch.setattr(cache, "DOWNLOADS_DIR", root / "downloads")
+    monkeypatch.setattr(cache, "MANIFEST_PATH", root / "manifest.json")
+    monkeypatch.setattr(cache, "LOCK_PATH", root / "manifest.lock")
+    return root
+
+
+@pytest.fixture
+def fake_sudo(tmp_path: Path, monkeypatch) -> None:
+    """A sudo on PATH that just runs its command, for the privileged helpers"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    sudo = bin_dir / "sudo"
+    sudo.write_text('#!/bin/sh\nexec "$@"\n')
+    sudo.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+@pytest.fixture
+def http_server(tmp_path: Path):
+    """Serve a directory over HTTP with Range support, yields (directory, url)"""
+    root = tmp_path / "www"
+    root.mkdir()
+    with serve(range_handler(root)) as base_url:
+        yield root, base_url
+
+
+@pytest.fixture
+def remote_image(http_server, image: Path):
+    """The test image served as .img.xz from the local HTTP server"""
+    from src.imaging.models import RaspberryPiImage
+
+    root, base_url = http_server
+    data = image.read_bytes()
+    compressed = lzma.compress(data, preset=1)
+    (root / "pi.img.xz").write_bytes(compressed)
+
+    return RaspberryPiImage(
+        name="Test OS",
+        description="",
+        icon="",
+        url=f"{base_url}/pi.img.xz",
+        extract_size=len(data),
+        extract_sha256=hashlib.sha256(data).hexdigest(),
+        image_download_size=len(compressed),
+        release_date="2025-12-12",
+        init_format="cloudinit",
+        devices=[],
+        capabilities=[],
+    )
@@ -0,0 +1,98 @@
+import struct
+
+from src.config.models import PiConfig
+from src.platform.models import ExternalDevice
+
+SECTOR = 512
+PARTITION_LBA = 2048
+FAT32_TYPE = 0x0C
+
+
+def make_pi(name: str) -> PiConfig:
+    return PiConfig.from_dict(
+        {
+            "name": name,
+            "hostname": name,
+            "wifi": {"ssid": "test", "password": "test", "country_code": "DE"},
+            "user": {
+                "name": "pi",
+                "password": "$6$test$hash",
+                "ssh_public_key": "ssh-ed25519 AAAA test",
+            },
+            "timezone": "Europe/Berlin",
+            "locale": "en_US.UTF-8",
+        }
+    )
+
+
+def make_device(node: str) -> ExternalDevice:
+    return ExternalDevice(
+        id=node, node=node, name="card", size="32 GB", protocol="USB", location=""
+    )
+
+
+def _fat_sectors(total: int, reserved: int, root: int, spc: int, width: int) -> int:
+    fat_sectors = 1
+    while True:
+        clusters = (total - reserved - 2 * fat_sectors - root) // spc
+        needed = -(-(clusters + 2) * width // SECTOR)
+        if needed <= fat_sectors:
+            return fat_sectors
+        fat_sectors = needed
+
+
+def make_fat_volume(fat32: bool) -> bytes:
+    """A freshly formatted FAT16 or FAT32 boot partition labelled BOOTFS"""
+    if fat32:
+        total, spc, reserved, root_entries, width = 72000, 1, 32, 0, 4
+    else:
+        total, spc, reserved, root_entries, width = 40000, 4, 4, 512, 2
+    root_sectors = root_entries * 32 // SECTOR
+    fat_sectors = _fat_sectors(total, reserved, root_sectors, spc, width)
+    label = b"BOOTFS     "
+
+    volume = bytearray(total * SECTOR)
+    bpb = memoryview(volume)[:SECTOR]
+    bpb[0:11] = b"\xeb\x58\x90MSWIN4.1"
+    struct.pack_into("<HBHBH", bpb, 11, SECTOR, spc, reserved, 2, root_entries)
+    bpb[21] = 0xF8
+    struct.pack_into("<HHI", bpb, 24, 32, 64, PARTITION_LBA)
+    if fat32:
+        struct.pack_into("<IIHHIHH", bpb, 32, total, fat_sectors, 0, 0, 2, 1, 6)
+        struct.pack_into("<BxBI11s8s", bpb, 64, 0x80, 0x29, 1, label, b"FAT32   ")
+    else:
+        struct.pack_into("<H", bpb, 19, total)
+        struct.pack_into("<H", bpb, 22, fat_sectors)
+        struct.pack_into("<BxBI11s8s", bpb, 36, 0x80, 0x29, 1, label, b"FAT16   ")
+    bpb[510:512] = b"\x55\xaa"
+
+    if fat32:
+        fsinfo = memoryview(volume)[SECTOR : 2 * SECTOR]
+        fsinfo[0:4] = b"RRaA"
+        struct.pack_into("<4sII", fsinfo, 484, b"rrAa", 1000, 3)
+        fsinfo[508:512] = b"\x00\x00\x55\xaa"
+
+    fats = reserved * SECTOR
+    for copy in range(2):
+        position = fats + copy * fat_sectors * SECTOR
+        if fat32:
+            # Media, reserved and the end of the root directory's chain
+            struct.pack_into(
+                "<III", volume, position, 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF
+            )
+        else:
+            struct.pack_into("<HH", volume, position, 0xFFF8, 0xFFFF)
+
+    root = (reserved + 2 * fat_sectors) * SECTOR
+    volume[root : root + 11] = label
+    volume[root + 11] = 0x08
+    return bytes(volume)
+
+
+def make_disk(volume: bytes, partition_type: int = FAT32_TYPE) -> bytes:
+    mbr = bytearray(SECTOR)
+    entry = struct.pack("<B3sB3sII", 0, b"", partition_type, b"", PARTITION_LBA, 0)
+    mbr[446:462] = entry
+    struct.pack_into("<I", mbr, 458, len(volume) // SECTOR)
+    mbr[510:512] = b"\x55\xaa"
+    return bytes(mbr).ljust(PARTITION_LBA * SECTOR, b"\x00") + volume
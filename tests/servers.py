@@ -0,0 +1,85 @@
+"""HTTP servers shared by the tests and the benchmarks"""
+
+import re
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def range_handler(
+    directory: Path, weak_etag: bool = False
+) -> type[BaseHTTPRequestHandler]:
+    """Static file handler supporting HEAD, single Range requests and If-Range
+
+    The ETag changes whenever a file is rewritten. An If-Range that doesn't
+    match it gets the whole file, as does any If-Range with weak ETags.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_headers(self) -> tuple[Path, int, int] | None:
+            path = directory / self.path.lstrip("/")
+            if not path.is_file():
+                self.send_error(404)
+                return None
+
+            info = path.stat()
+            size = info.st_size
+            etag = f'"{size}-{info.st_mtime_ns}"'
+            if weak_etag:
+                etag = "W/" + etag
+
+            start, end = 0, size
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if_range = self.headers.get("If-Range")
+            if match and (if_range is None or (if_range == etag and not weak_etag)):
+                start = int(match[1])
+                end = int(match[2]) + 1 if match[2] else size
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            else:
+                self.send_response(200)
+
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return path, start, end
+
+        def send_body(self, path: Path, start: int, end: int) -> None:
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining and (chunk := f.read(min(remaining, CHUNK_SIZE))):
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+        def do_HEAD(self) -> None:  # noqa: N802
+            self._send_headers()
+
+        def do_GET(self) -> None:  # noqa: N802
+            sent = self._send_headers()
+            if sent is not None:
+                self.send_body(*sent)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return Handler
+
+
+@contextmanager
+def serve(handler: type[BaseHTTPRequestHandler]) -> Iterator[str]:
+    """Run handler on a loopback port, yields the base URL"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,229 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from src.imaging import bmap
+from src.imaging.bmap import (
+    BLOCK_SIZE,
+    LINUX_PARTITION_TYPE,
+    BlockMap,
+    bmap_path,
+    compute_block_map,
+    load_block_map,
+    write_mapped,
+)
+from src.imaging.fat import open_boot_partition, write_boot_files
+from src.imaging.verify import verify_target
+from tests.factories import PARTITION_LBA, SECTOR, make_disk, make_fat_volume
+
+MB = 1024 * 1024
+GARBAGE = b"\xaa"
+
+FILES = {
+    "user-data": "#cloud-config\n" + "packages:\n" + "  - vim\n" * 400,
+    "meta-data": "instance-id: pi-0\n",
+}
+
+
+def _mapped(block_map: BlockMap, start: int, end: int) -> bool:
+    return any(s <= start and end <= e for s, e in block_map.mapped)
+
+
+def _skipped(block_map: BlockMap) -> list[tuple[int, int]]:
+    return bmap._complement(block_map.mapped, block_map.image_size)
+
+
+@pytest.fixture
+def fat_disk(tmp_path: Path) -> Path:
+    """A FAT16 card image with files, garbage in its free clusters and a gap
+
+    The free clusters aren't zero, so skipping them relies on the FAT.
+    Behind the partition is an unpartitioned gap with one block of data.
+    """
+    path = tmp_path / "disk.img"
+    gap = bytearray(16 * BLOCK_SIZE)
+    gap[5 * BLOCK_SIZE + 100] = 1
+    path.write_bytes(make_disk(make_fat_volume(fat32=False)) + gap)
+    write_boot_files(path, FILES)
+
+    with open(path, "r+b") as f:
+        volume = open_boot_partition(f)
+        for cluster in range(2, volume.cluster_count + 2):
+            if not volume._get(cluster):
+                f.seek(volume._cluster_offset(cluster))
+                f.write(GARBAGE * volume.cluster_size)
+    return path
+
+
+def test_fat_free_clusters_and_zero_gaps_are_skipped(fat_disk: Path):
+    block_map = compute_block_map(fat_disk)
+    size = fat_disk.stat().st_size
+    gap_start = size - 16 * BLOCK_SIZE
+
+    with open(fat_disk, "rb") as f:
+        volume = open_boot_partition(f)
+
+    # Everything before the data region and every used cluster is written
+    assert _mapped(block_map, 0, volume.data_offset)
+    for cluster in range(2, volume.cluster_count + 2):
+        if volume._get(cluster):
+            offset = volume._cluster_offset(cluster)
+            assert _mapped(block_map, offset, offset + volume.cluster_size)
+
+    # Only free clusters and zeros of the gap are skipped, in whole blocks
+    for start, end in _skipped(block_map):
+        assert start % BLOCK_SIZE == 0 and end % BLOCK_SIZE == 0
+        if start >= gap_start:
+            continue
+        first = (start - volume.data_offset) // volume.cluster_size + 2
+        last = (end - 1 - volume.data_offset) // volume.cluster_size + 2
+        assert not any(volume._get(c) for c in range(first, last + 1))
+
+    # The gap's zeros join the free clusters at the end of the partition
+    before, after = _skipped(block_map)[-2:]
+    assert before[0] < gap_start and before[1] == gap_start + 5 * BLOCK_SIZE
+    assert after == (gap_start + 6 * BLOCK_SIZE, size)
+    assert block_map.mapped_bytes < size // 10
+
+
+def test_image_without_partition_table_skips_zero_blocks(tmp_path: Path):
+    size = 4 * MB + 1000
+    data = bytearray(size)
+    data[5000] = 1
+    data[3 * MB + 4095] = 1
+    path = tmp_path / "raw.img"
+    path.write_bytes(data)
+
+    block_map = compute_block_map(path)
+
+    # The zero partial block at the end can't be skipped without writing
+    # past the image, so it's written
+    tail = size // BLOCK_SIZE * BLOCK_SIZE
+    assert block_map.mapped == [
+        (BLOCK_SIZE, 2 * BLOCK_SIZE),
+        (3 * MB, 3 * MB + BLOCK_SIZE),
+        (tail, size),
+    ]
+
+
+def test_skippable_ranges_shrink_to_whole_blocks():
+    assert bmap._align_inward(
+        [
+            (1, BLOCK_SIZE - 1),
+            (100, 2 * BLOCK_SIZE + 5),
+            (3 * BLOCK_SIZE, 5 * BLOCK_SIZE),
+        ],
+        BLOCK_SIZE,
+    ) == [(BLOCK_SIZE, 2 * BLOCK_SIZE), (3 * BLOCK_SIZE, 5 * BLOCK_SIZE)]
+
+
+def test_block_map_is_cached_until_the_image_changes(fat_disk: Path, monkeypatch):
+    computed = []
+    compute = bmap.compute_block_map
+
+    def counting(image_path: Path) -> BlockMap:
+        computed.append(image_path)
+        return compute(image_path)
+
+    monkeypatch.setattr(bmap, "compute_block_map", counting)
+
+    first = load_block_map(fat_disk)
+    assert load_block_map(fat_disk) == first
+    assert len(computed) == 1
+
+    info = fat_disk.stat()
+    os.utime(fat_disk, ns=(info.st_atime_ns, info.st_mtime_ns + 1_000_000))
+    load_block_map(fat_disk)
+    assert len(computed) == 2
+
+    with open(fat_disk, "ab") as f:
+        f.write(bytes(BLOCK_SIZE))
+    assert load_block_map(fat_disk).image_size == info.st_size + BLOCK_SIZE
+    assert len(computed) == 3
+
+    bmap_path(fat_disk).write_text("{not json")
+    load_block_map(fat_disk)
+    assert len(computed) == 4
+    assert json.loads(bmap_path(fat_disk).read_text())["block_size"] == BLOCK_SIZE
+
+
+@pytest.mark.parametrize("extra", [-MB, MB + 1], ids=["shorter", "longer"])
+def test_write_mapped_reproduces_every_mapped_range(
+    fat_disk: Path, tmp_path: Path, extra: int
+):
+    block_map = compute_block_map(fat_disk)
+    target = tmp_path / "card.img"
+    target.write_bytes(b"\x55" * (block_map.image_size + extra))
+    digests = []
+
+    written = write_mapped(fat_disk, str(target), block_map, digests=digests)
+
+    image = fat_disk.read_bytes()
+    card = target.read_bytes()
+    assert written == block_map.mapped_bytes
+    assert len(card) == len(image)
+    for start, end in block_map.mapped:
+        assert card[start:end] == image[start:end]
+    assert verify_target(str(target), digests) is None
+
+    # The card mounts the same: its FAT and files are intact
+    with open(target, "rb") as f:
+        volume = open_boot_partition(f)
+        for name, content in FILES.items():
+            assert volume.read_file(name) == content.encode()
+
+
+@pytest.mark.skipif(
+    not all(
+        shutil.which(tool) for tool in ("mkfs.ext4", "dumpe2fs", "debugfs", "e2fsck")
+    ),
+    reason="needs e2fsprogs",
+)
+def test_ext4_free_blocks_are_skipped(tmp_path: Path):
+    content = tmp_path / "content"
+    content.mkdir()
+    data = os.urandom(MB + 123)
+    (content / "data.bin").write_bytes(data)
+
+    # Free blocks keep the garbage the file held before mkfs. Without
+    # checksums no group is left uninitialised, so every free block is known.
+    volume_path = tmp_path / "rootfs.img"
+    volume_path.write_bytes(GARBAGE * 32 * MB)
+    subprocess.run(
+        ["mkfs.ext4", "-q", "-F", "-b", str(BLOCK_SIZE), "-E", "nodiscard"]
+        + ["-O", "^metadata_csum,^uninit_bg", "-d", content, volume_path],
+        check=True,
+        capture_output=True,
+    )
+    superblock = subprocess.run(
+        ["dumpe2fs", "-h", volume_path], check=True, capture_output=True, text=True
+    ).stdout
+    free_blocks = int(re.search(r"^Free blocks:\s+(\d+)", superblock, re.M)[1])
+
+    disk = tmp_path / "disk.img"
+    disk.write_bytes(make_disk(volume_path.read_bytes(), LINUX_PARTITION_TYPE))
+    block_map = compute_block_map(disk)
+
+    assert block_map.mapped_bytes == block_map.image_size - free_blocks * BLOCK_SIZE
+
+    target = tmp_path / "card.img"
+    target.write_bytes(bytes(block_map.image_size))
+    write_mapped(disk, str(target), block_map)
+
+    volume_path.write_bytes(target.read_bytes()[PARTITION_LBA * SECTOR :])
+    fsck = subprocess.run(
+        ["e2fsck", "-fn", volume_path], capture_output=True, text=True
+    )
+    assert fsck.returncode == 0, fsck.stdout + fsck.stderr
+    dumped = tmp_path / "dumped.bin"
+    subprocess.run(
+        ["debugfs", "-R", f"dump /data.bin {dumped}", volume_path],
+        check=True,
+        capture_output=True,
+    )
+    assert dumped.read_bytes() == data
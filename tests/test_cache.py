@@ -0,0 +1,94 @@
+import hashlib
+import multiprocessing
+from pathlib import Path
+
+from src.imaging import cache
+
+BASE = "b" * 64
+
+
+def _add(sha256: str, size: int, **kwargs) -> cache.CacheEntry:
+    path = cache.image_path(sha256)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(bytes(size))
+    return cache.register(sha256, f"{sha256[:4]}.img", **kwargs)
+
+
+def test_batch_variants_survive_eviction(cache_dir, monkeypatch):
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "2500")
+    _add(BASE, 1000)
+
+    batch: set[str] = set()
+    for i in range(4):
+        key = f"{i}" * 64
+        _add(key, 1000, base=BASE, keep=batch)
+        batch.add(key)
+
+    assert set(cache.load_manifest()) == {BASE, *batch}
+
+
+def test_without_batch_older_variants_are_evicted(cache_dir, monkeypatch):
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "2500")
+    _add(BASE, 1000)
+
+    for i in range(4):
+        _add(f"{i}" * 64, 1000, base=BASE)
+
+    assert "0" * 64 not in cache.load_manifest()
+
+
+def test_reflinked_variants_count_their_unshared_size(cache_dir, monkeypatch):
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "1500")
+    _add(BASE, 1000)
+
+    for i in range(4):
+        _add(f"{i}" * 64, 1000, base=BASE, unshared=10)
+
+    assert len(cache.load_manifest()) == 5
+
+
+def test_variants_count_in_full_once_their_base_is_gone(cache_dir):
+    _add(BASE, 1000)
+    for i in range(2):
+        _add(f"{i}" * 64, 1000, base=BASE, unshared=10)
+
+    cache.remove(BASE)
+    evicted = cache.evict(1500)
+
+    assert [entry.sha256 for entry in evicted] == ["0" * 64]
+
+
+def _register_many(prefix: str, count: int) -> None:
+    for i in range(count):
+        _add(f"{prefix}{i:03d}".ljust(64, "0"), 10)
+
+
+def test_concurrent_processes_keep_each_others_entries(cache_dir):
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=_register_many, args=(prefix, 25)) for prefix in "ab"
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(cache.load_manifest()) == 50
+
+
+def test_legacy_images_are_migrated(cache_dir: Path, image: Path):
+    cache_dir.mkdir()
+    legacy = cache_dir / "raspios.img"
+    legacy.write_bytes(image.read_bytes())
+    (cache_dir / "raspios.img.xz").write_bytes(b"partial")
+    sha256 = hashlib.sha256(image.read_bytes()).hexdigest()
+
+    (entry,) = cache.migrate_legacy_files()
+
+    assert entry.sha256 == sha256 and entry.filename == "raspios.img"
+    assert cache.lookup(sha256).path.read_bytes() == image.read_bytes()
+    assert sorted(p.name for p in cache_dir.iterdir()) == [
+        "images",
+        "manifest.json",
+        "manifest.lock",
+    ]
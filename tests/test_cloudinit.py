@@ -0,0 +1,46 @@
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from src.imaging.cloudinit import render_fleet
+from tests.factories import make_pi
+
+
+def test_unchanged_pis_are_skipped(tmp_path: Path):
+    pis = [make_pi("pi-0"), make_pi("pi-1")]
+    render_fleet(pis, tmp_path, policy="stable")
+
+    pis[1] = dataclasses.replace(pis[1], timezone="UTC")
+    rendered, skipped = render_fleet(pis, tmp_path, policy="stable")
+
+    assert [pi.name for pi in rendered] == ["pi-1"]
+    assert [pi.name for pi in skipped] == ["pi-0"]
+
+
+def test_pi_names_stay_inside_the_output_dir(tmp_path: Path):
+    out_dir = tmp_path / "out"
+    pi = dataclasses.replace(make_pi("pi-0"), name="../../etc/pi 1")
+
+    render_fleet([pi], out_dir)
+
+    assert (out_dir / "etc-pi-1" / "user-data").is_file()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out"]
+
+
+def test_names_sharing_a_directory_are_rejected(tmp_path: Path):
+    pis = [make_pi("pi/1"), make_pi("pi 1")]
+
+    with pytest.raises(ValueError, match="pi-1"):
+        render_fleet(pis, tmp_path)
+
+
+def test_removed_pis_lose_their_bundle(tmp_path: Path):
+    (tmp_path / "notes").mkdir()
+    render_fleet([make_pi("pi-0"), make_pi("pi-1")], tmp_path)
+
+    render_fleet([make_pi("pi-0")], tmp_path)
+
+    assert (tmp_path / "pi-0").is_dir()
+    assert not (tmp_path / "pi-1").exists()
+    assert (tmp_path / "notes").is_dir()
@@ -0,0 +1,333 @@
+import os
+from pathlib import Path
+
+import pytest
+import yaml
+
+from src.config import loader
+
+CONFIG = {
+    "defaults": {
+        "wifi": {"ssid": "test", "password": "test", "country_code": "DE"},
+        "user": {
+            "name": "pi",
+            "password": "$6$test$hash",
+            "ssh_public_key": "ssh-ed25519 AAAA test",
+        },
+        "timezone": "Europe/Berlin",
+        "locale": "en_US.UTF-8",
+    },
+    "raspberry_pis": [{"name": "pi-0", "hostname": "pi-0"}],
+}
+
+
+@pytest.fixture
+def config_path(tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setattr(loader, "CONFIG_CACHE_DIR", tmp_path / "config-cache")
+    path = tmp_path / "pitool.yml"
+    path.write_text(yaml.safe_dump(CONFIG))
+    return path
+
+
+def test_damaged_cache_entry_is_a_miss(config_path: Path):
+    config, _ = loader.parse_config(config_path)
+    # Refers to a class that no longer exists, unpickling raises ImportError
+    loader._cache_path(config_path.resolve()).write_bytes(b"cgone\nPiConfig\n.")
+
+    assert loader.parse_config(config_path)[0] == config
+
+
+def test_cache_is_keyed_by_the_package_source(config_path: Path, monkeypatch):
+    loader.parse_config(config_path)
+    cached = loader._cache_path(config_path.resolve())
+
+    monkeypatch.setattr(loader, "_code_digest", lambda: "changed")
+
+    assert loader._cache_path(config_path.resolve()) != cached
+    assert loader.parse_config(config_path)[0].raspberry_pis[0].name == "pi-0"
+
+
+def _write(path: Path, data: dict) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(yaml.safe_dump(data))
+    return path
+
+
+def _pis(config_path: Path) -> dict:
+    config, _ = loader.parse_config(config_path)
+    return {pi.name: pi for pi in config.raspberry_pis}
+
+
+def _errors(config_path: Path) -> list[str]:
+    with pytest.raises(loader.ConfigError) as info:
+        loader.parse_config(config_path)
+    return info.value.errors
+
+
+def test_pis_are_deep_merged_over_defaults(config_path: Path):
+    _write(
+        config_path,
+        {
+            **CONFIG,
+            "raspberry_pis": [
+                {"name": "pi-0", "hostname": "pi-0"},
+                {
+                    "name": "pi-1",
+                    "hostname": "pi-1",
+                    "user": {"name": "admin"},
+                    "wifi": {"ssid": "other"},
+                    "packages": ["vim"],
+                },
+            ],
+        },
+    )
+
+    pis = _pis(config_path)
+
+    assert pis["pi-0"].user.name == "pi"
+    assert pis["pi-0"].packages is None
+    # Only the given keys are overridden, the rest comes from defaults
+    assert pis["pi-1"].user.name == "admin"
+    assert pis["pi-1"].user.password == "$6$test$hash"
+    assert pis["pi-1"].wifi.ssid == "other"
+    assert pis["pi-1"].wifi.country_code == "DE"
+    assert pis["pi-1"].packages == ["vim"]
+    assert CONFIG["defaults"]["user"]["name"] == "pi"
+
+
+def test_groups_sit_between_defaults_and_the_pi(config_path: Path):
+    _write(
+        config_path,
+        {
+            **CONFIG,
+            "groups": {
+                "lab": {"timezone": "UTC", "user": {"name": "lab"}, "update": True}
+            },
+            "raspberry_pis": [
+                {"name": "pi-0", "hostname": "pi-0", "group": "lab"},
+                {
+                    "name": "pi-1",
+                    "hostname": "pi-1",
+                    "group": "lab",
+                    "user": {"name": "own"},
+                },
+                {"name": "pi-2", "hostname": "pi-2"},
+            ],
+        },
+    )
+
+    pis = _pis(config_path)
+
+    assert (pis["pi-0"].timezone, pis["pi-0"].user.name) == ("UTC", "lab")
+    assert pis["pi-0"].update and pis["pi-0"].user.password == "$6$test$hash"
+    assert (pis["pi-1"].timezone, pis["pi-1"].user.name) == ("UTC", "own")
+    assert (pis["pi-2"].timezone, pis["pi-2"].user.name) == ("Europe/Berlin", "pi")
+    assert not pis["pi-2"].update
+
+
+def test_includes_resolve_relative_to_the_including_file(
+    config_path: Path, tmp_path: Path
+):
+    # pitool.yml -> fleet/lab.yml -> ../shared/base.yml and rooms/attic.yml
+    _write(
+        tmp_path / "shared" / "base.yml",
+        {
+            "defaults": CONFIG["defaults"],
+            "groups": {"lab": {"timezone": "UTC", "locale": "de_DE.UTF-8"}},
+        },
+    )
+    _write(
+        tmp_path / "fleet" / "rooms" / "attic.yml",
+        {"raspberry_pis": [{"name": "attic", "hostname": "attic"}]},
+    )
+    lab = _write(
+        tmp_path / "fleet" / "lab.yml",
+        {
+            "include": ["../shared/base.yml", "rooms/attic.yml"],
+            "groups": {"lab": {"locale": "en_GB.UTF-8"}},
+            "raspberry_pis": [{"name": "lab-0", "hostname": "lab-0", "group": "lab"}],
+        },
+    )
+    _write(
+        config_path,
+        {
+            "include": "fleet/lab.yml",
+            "defaults": {"timezone": "Europe/London"},
+            "raspberry_pis": [{"name": "pi-0", "hostname": "pi-0"}],
+        },
+    )
+
+    config, sources = loader.parse_config(config_path)
+    pis = {pi.name: pi for pi in config.raspberry_pis}
+
+    # Included Pis come first, and the including file's settings win
+    assert list(pis) == ["attic", "lab-0", "pi-0"]
+    assert pis["pi-0"].timezone == "Europe/London"
+    assert pis["attic"].timezone == "Europe/London"
+    # The group is merged across files, the group still beats defaults
+    assert (pis["lab-0"].timezone, pis["lab-0"].locale) == ("UTC", "en_GB.UTF-8")
+    assert sources == {
+        "attic": ((tmp_path / "fleet" / "rooms" / "attic.yml").resolve(), 0),
+        "lab-0": (lab.resolve(), 0),
+        "pi-0": (config_path.resolve(), 0),
+    }
+
+
+def test_include_cycles_are_reported(config_path: Path, tmp_path: Path):
+    _write(tmp_path / "sub" / "b.yml", {"include": "../pitool.yml"})
+    _write(config_path, {**CONFIG, "include": "sub/b.yml"})
+
+    assert _errors(config_path) == [
+        "b.yml: include cycle (pitool.yml -> b.yml -> pitool.yml)"
+    ]
+
+
+def test_self_include_is_a_cycle(config_path: Path):
+    _write(config_path, {**CONFIG, "include": "./pitool.yml"})
+
+    assert _errors(config_path) == [
+        "pitool.yml: include cycle (pitool.yml -> pitool.yml)"
+    ]
+
+
+def test_missing_include_is_reported(config_path: Path, tmp_path: Path):
+    _write(config_path, {**CONFIG, "include": "missing.yml"})
+
+    assert _errors(config_path) == [
+        f"pitool.yml: include: file not found: {tmp_path.resolve() / 'missing.yml'}"
+    ]
+
+
+def test_every_problem_is_reported_at_once(config_path: Path):
+    _write(
+        config_path,
+        {
+            **CONFIG,
+            "extra": 1,
+            "groups": {"lab": "oops"},
+            "raspberry_pis": [
+                {"name": "pi-0", "hostname": "-bad-", "colour": "red"},
+                {"name": "pi-1", "hostname": 42, "wifi": {"country_code": "de"}},
+                {"name": "pi-2", "hostname": "pi-2", "group": "nope"},
+                {"name": "pi-3", "hostname": "pi-3", "user": None, "packages": [1]},
+                {"name": "pi-4", "hostname": "shared"},
+                {"name": "pi-4", "hostname": "other"},
+                {"name": "pi-6", "hostname": "SHARED"},
+                "not a pi",
+            ],
+        },
+    )
+
+    assert _errors(config_path) == [
+        "pitool.yml: extra: unknown top level key",
+        "pitool.yml: groups.lab: expected a mapping",
+        "pitool.yml: raspberry_pis[0] (pi-0).colour: unknown field",
+        "pitool.yml: raspberry_pis[0] (pi-0).hostname: invalid hostname '-bad-'",
+        "pitool.yml: raspberry_pis[1] (pi-1).hostname: expected str, got int "
+        "(quote it)",
+        "pitool.yml: raspberry_pis[1] (pi-1).wifi.country_code: expected two upper "
+        "case letters, got 'de'",
+        "pitool.yml: raspberry_pis[2] (pi-2).group: unknown group 'nope'",
+        "pitool.yml: raspberry_pis[3] (pi-3).user: expected a mapping, got null",
+        "pitool.yml: raspberry_pis[3] (pi-3).packages: expected a list of strings",
+        "pitool.yml: raspberry_pis[5] (pi-4).name: duplicate Pi name 'pi-4'",
+        "pitool.yml: raspberry_pis[6] (pi-6).hostname: 'SHARED' is already used "
+        "by 'pi-4'",
+        "pitool.yml: raspberry_pis[7]: expected a mapping",
+    ]
+
+
+def test_missing_required_fields_are_reported(config_path: Path):
+    _write(config_path, {"raspberry_pis": [{"name": "pi-0"}]})
+
+    errors = _errors(config_path)
+
+    assert "pitool.yml: raspberry_pis[0] (pi-0).hostname: required" in errors
+    assert "pitool.yml: raspberry_pis[0] (pi-0).wifi: required" in errors
+    assert "pitool.yml: raspberry_pis[0] (pi-0).user: required" in errors
+    assert str(loader.ConfigError(errors)) == "\n".join(errors)
+
+
+def test_empty_config_needs_a_pi(config_path: Path):
+    config_path.write_text("# nothing yet\n")
+
+    assert _errors(config_path) == [
+        "pitool.yml: raspberry_pis: at least one Pi is required"
+    ]
+
+
+class Parses:
+    """Counts configs actually parsed rather than loaded from the cache"""
+
+    def __init__(self, monkeypatch):
+        self.count = 0
+        parse = loader._parse
+
+        def counting(config_path: Path):
+            self.count += 1
+            return parse(config_path)
+
+        monkeypatch.setattr(loader, "_parse", counting)
+
+
+def _touch(path: Path) -> None:
+    info = path.stat()
+    os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns + 1_000_000_000))
+
+
+def test_editing_an_included_file_invalidates_the_cache(
+    config_path: Path, tmp_path: Path, monkeypatch
+):
+    included = _write(
+        tmp_path / "fleet.yml",
+        {"raspberry_pis": [{"name": "pi-1", "hostname": "pi-1"}]},
+    )
+    _write(config_path, {**CONFIG, "include": "fleet.yml"})
+    parses = Parses(monkeypatch)
+
+    assert _pis(config_path)["pi-1"].hostname == "pi-1"
+    assert _pis(config_path)["pi-1"].hostname == "pi-1"
+    assert parses.count == 1
+
+    # Same size, so only the mtime tells the edit apart
+    included.write_text(
+        included.read_text().replace("hostname: pi-1", "hostname: pi-9")
+    )
+    _touch(included)
+
+    assert _pis(config_path)["pi-1"].hostname == "pi-9"
+    assert parses.count == 2
+
+
+def test_touched_but_unchanged_include_is_still_cached(
+    config_path: Path, tmp_path: Path, monkeypatch
+):
+    included = _write(
+        tmp_path / "fleet.yml",
+        {"raspberry_pis": [{"name": "pi-1", "hostname": "pi-1"}]},
+    )
+    _write(config_path, {**CONFIG, "include": "fleet.yml"})
+    parses = Parses(monkeypatch)
+    loader.parse_config(config_path)
+
+    _touch(included)
+
+    assert _pis(config_path)["pi-1"].hostname == "pi-1"
+    assert parses.count == 1
+
+
+def test_deleted_include_is_a_cache_miss(
+    config_path: Path, tmp_path: Path, monkeypatch
+):
+    included = _write(
+        tmp_path / "fleet.yml",
+        {"raspberry_pis": [{"name": "pi-1", "hostname": "pi-1"}]},
+    )
+    _write(config_path, {**CONFIG, "include": "fleet.yml"})
+    loader.parse_config(config_path)
+
+    included.unlink()
+
+    assert _errors(config_path) == [
+        f"pitool.yml: include: file not found: {included.resolve()}"
+    ]
@@ -0,0 +1,127 @@
+import lzma
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from src.imaging import decoders
+from src.imaging.decoders import (
+    LzmaDecoder,
+    XzBlockParallelDecoder,
+    XzPipeDecoder,
+    read_xz_blocks,
+    select_decoder,
+    uncompressed_size,
+)
+
+KB = 1024
+MB = 1024 * KB
+
+XZ_DECODERS = [
+    decoder
+    for decoder in (XzPipeDecoder(), XzBlockParallelDecoder(workers=2), LzmaDecoder())
+    if decoder.available()
+]
+
+needs_xz = pytest.mark.skipif(not shutil.which("xz"), reason="needs xz")
+
+
+@pytest.fixture(scope="module")
+def data() -> bytes:
+    """Partly compressible: random runs between zeros"""
+    return (os.urandom(256 * KB) + bytes(768 * KB)) * 3 + os.urandom(777)
+
+
+def _xz(path: Path, data: bytes, *args: str) -> Path:
+    path.write_bytes(
+        subprocess.run(
+            ["xz", "-c", "-0", *args], input=data, capture_output=True, check=True
+        ).stdout
+    )
+    return path
+
+
+def _decode_all(path: Path, expected: bytes) -> None:
+    for decoder in XZ_DECODERS:
+        decoded = b"".join(decoder.iter_chunks(path))
+        assert decoded == expected, decoder.name
+
+
+@needs_xz
+def test_multi_block_file_round_trips(tmp_path: Path, data: bytes):
+    path = _xz(tmp_path / "pi.img.xz", data, "-T2", "--block-size=256KiB")
+
+    blocks = read_xz_blocks(path)
+
+    assert len(blocks) == -(-len(data) // (256 * KB))
+    assert sum(block.uncompressed_size for block in blocks) == len(data)
+    assert uncompressed_size(path) == len(data)
+    assert XzBlockParallelDecoder().accepts(path)
+    assert lzma.decompress(path.read_bytes()) == data
+    _decode_all(path, data)
+
+
+def test_single_block_file_round_trips(tmp_path: Path, data: bytes):
+    path = tmp_path / "pi.img.xz"
+    path.write_bytes(lzma.compress(data, preset=0))
+
+    assert len(read_xz_blocks(path)) == 1
+    # Nothing to parallelise, left to the other backends
+    assert not XzBlockParallelDecoder().accepts(path)
+    _decode_all(path, data)
+
+
+def test_concatenated_streams_with_padding_round_trip(tmp_path: Path, data: bytes):
+    parts = [data[: MB + 3], data[MB + 3 : 2 * MB], data[2 * MB :]]
+    streams = [lzma.compress(part, preset=0) for part in parts]
+    path = tmp_path / "pi.img.xz"
+    path.write_bytes(streams[0] + bytes(4) + streams[1] + streams[2] + bytes(8))
+
+    blocks = read_xz_blocks(path)
+
+    assert [block.uncompressed_size for block in blocks] == [len(p) for p in parts]
+    assert XzBlockParallelDecoder().accepts(path)
+    assert [lzma.decompress(s) for s in streams] == parts
+    _decode_all(path, data)
+
+
+@pytest.mark.parametrize("damage", ["index", "footer"])
+def test_corrupt_index_falls_back_to_another_backend(
+    tmp_path: Path, data: bytes, damage: str, monkeypatch
+):
+    streams = [lzma.compress(data[:MB]), lzma.compress(data[MB:])]
+    compressed = bytearray(b"".join(streams))
+    # The last stream's index record sits just before its 12 byte footer
+    position = {"index": -16, "footer": -7}[damage]
+    compressed[position] ^= 0xFF
+    path = tmp_path / "pi.img.xz"
+    path.write_bytes(compressed)
+
+    with pytest.raises(ValueError, match="Invalid xz"):
+        read_xz_blocks(path)
+    assert not XzBlockParallelDecoder().accepts(path)
+    assert uncompressed_size(path) is None
+
+    monkeypatch.setattr(XzPipeDecoder, "available", lambda self: False)
+    assert select_decoder(path).name == "lzma"
+
+
+def test_truncated_file_fails_in_every_backend(tmp_path: Path, data: bytes):
+    path = tmp_path / "pi.img.xz"
+    path.write_bytes(lzma.compress(data, preset=0)[:-100])
+
+    for decoder in XZ_DECODERS:
+        with pytest.raises((ValueError, RuntimeError, lzma.LZMAError, EOFError)):
+            b"".join(decoder.iter_chunks(path))
+
+
+def test_fastest_backend_is_selected(tmp_path: Path, data: bytes, monkeypatch):
+    streams = [lzma.compress(data[:MB]), lzma.compress(data[MB:])]
+    path = tmp_path / "pi.img.xz"
+    path.write_bytes(b"".join(streams))
+
+    monkeypatch.setattr(XzPipeDecoder, "available", lambda self: False)
+    assert select_decoder(path).name == "xz-blocks"
+    assert select_decoder(path, name="lzma") is decoders.DECODERS[2]
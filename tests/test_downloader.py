@@ -0,0 +1,19 @@
+from pathlib import Path
+
+from src.imaging import downloader
+from src.imaging.models import RaspberryPiImage
+from src.imaging.ranged import download_ranged
+
+
+def test_streaming_matches_download_and_extract(
+    remote_image: RaspberryPiImage, image: Path, tmp_path: Path
+):
+    streamed = downloader._download_streaming(remote_image, tmp_path / "streamed.img")
+
+    compressed = download_ranged(remote_image.url, tmp_path / "pi.img.xz")
+    extracted = downloader._extract_image(
+        compressed, remote_image.extract_size, output_path=tmp_path / "extracted.img"
+    )
+
+    assert streamed.read_bytes() == extracted.read_bytes() == image.read_bytes()
+    assert not (tmp_path / "streamed.img.part").exists()
@@ -0,0 +1,123 @@
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from src.imaging.fat import open_boot_partition, write_boot_files
+from tests.factories import PARTITION_LBA, SECTOR, make_disk, make_fat_volume
+
+FILES = {
+    "user-data": "#cloud-config\n" + "packages:\n" + "  - vim\n" * 400,
+    "meta-data": "instance-id: pi-0\n",
+    "network-config": "version: 2\n",
+}
+
+
+class SectorFile:
+    """A file that, like a raw disk device, only takes whole sector I/O"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def seek(self, position: int, whence: int = 0) -> int:
+        assert position % SECTOR == 0, f"Unaligned seek to {position}"
+        return self.f.seek(position, whence)
+
+    def read(self, size: int) -> bytes:
+        assert size % SECTOR == 0, f"Unaligned read of {size} bytes"
+        return self.f.read(size)
+
+    def write(self, data: bytes) -> int:
+        assert len(data) % SECTOR == 0, f"Unaligned write of {len(data)} bytes"
+        return self.f.write(data)
+
+    def flush(self) -> None:
+        self.f.flush()
+
+
+@pytest.fixture(params=["fat16", "fat32"])
+def disk(request, tmp_path: Path) -> Path:
+    path = tmp_path / "disk.img"
+    path.write_bytes(make_disk(make_fat_volume(request.param == "fat32")))
+    return path
+
+
+def test_written_files_read_back(disk: Path):
+    write_boot_files(disk, FILES)
+    write_boot_files(disk, {"user-data": "#cloud-config\n"})
+
+    with open(disk, "rb") as f:
+        volume = open_boot_partition(f)
+        assert volume.volume_label() == "BOOTFS"
+        assert volume.read_file("user-data") == b"#cloud-config\n"
+        assert volume.read_file("meta-data") == FILES["meta-data"].encode()
+        assert volume.read_file("network-config") == FILES["network-config"].encode()
+        with pytest.raises(FileNotFoundError):
+            volume.read_file("cmdline.txt")
+
+        # One cluster per file plus FAT32's root directory, the replaced
+        # user-data's old clusters are free again
+        used = sum(1 for c in range(2, volume.cluster_count + 2) if volume._get(c))
+        assert used == len(FILES) + volume.fat32
+
+        f.seek(volume.fat_offset)
+        copies = f.read(volume.num_fats * volume.fat_size)
+    assert copies[: volume.fat_size] == copies[volume.fat_size :]
+
+
+def test_only_whole_sectors_are_written(disk: Path):
+    with open(disk, "r+b", buffering=0) as f:
+        volume = open_boot_partition(SectorFile(f))
+        for name, content in FILES.items():
+            volume.write_file(name, content.encode())
+        volume.flush()
+
+
+def test_fsinfo_hints_are_invalidated(tmp_path: Path):
+    disk = tmp_path / "disk.img"
+    disk.write_bytes(make_disk(make_fat_volume(fat32=True)))
+
+    write_boot_files(disk, FILES)
+
+    with open(disk, "rb") as f:
+        f.seek((PARTITION_LBA + 1) * SECTOR)
+        fsinfo = f.read(SECTOR)
+    assert fsinfo[0:4] == b"RRaA" and fsinfo[484:488] == b"rrAa"
+    assert struct.unpack_from("<II", fsinfo, 488) == (0xFFFFFFFF, 0xFFFFFFFF)
+    assert fsinfo[508:512] == b"\x00\x00\x55\xaa"
+
+
+@pytest.mark.skipif(
+    not (shutil.which("mkfs.vfat") and shutil.which("fsck.vfat")),
+    reason="needs dosfstools",
+)
+@pytest.mark.parametrize("fat_size", ["16", "32"])
+def test_fsck_accepts_the_written_volume(tmp_path: Path, fat_size: str):
+    volume_path = tmp_path / "bootfs.img"
+    subprocess.run(
+        ["mkfs.vfat", "-F", fat_size, "-n", "BOOTFS", "-C", str(volume_path), "65536"],
+        check=True,
+        capture_output=True,
+    )
+    disk = tmp_path / "disk.img"
+    disk.write_bytes(make_disk(volume_path.read_bytes()))
+
+    write_boot_files(disk, FILES)
+
+    volume_path.write_bytes(disk.read_bytes()[PARTITION_LBA * SECTOR :])
+    fsck = subprocess.run(
+        ["fsck.vfat", "-n", str(volume_path)], capture_output=True, text=True
+    )
+    assert fsck.returncode == 0, fsck.stdout + fsck.stderr
+
+    if shutil.which("mtype"):
+        for name, content in FILES.items():
+            typed = subprocess.run(
+                ["mtype", "-i", str(volume_path), f"::{name}"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            assert typed.stdout == content
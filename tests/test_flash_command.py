@@ -0,0 +1,245 @@
+import dataclasses
+import lzma
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from src.commands import flash
+from src.imaging import cache, flasher
+from src.imaging.models import RaspberryPiImage
+from src.imaging.writer import ImageHashError, TargetsFailedError
+from src.platform import linux
+from src.platform.linux import LinuxPlatform
+from src.platform.models import ExternalDevice
+from tests.factories import make_device, make_pi
+
+
+class FakePlatform:
+    """Records what the flash command does to each card"""
+
+    def __init__(self):
+        self.boot_files: dict[str, dict[str, str]] = {}
+        self.ejected: list[str] = []
+
+    def write_boot_files(self, device_id: str, files: dict[str, str]) -> None:
+        self.boot_files[device_id] = files
+
+    def unmount_and_eject(self, device_id: str) -> None:
+        self.ejected.append(device_id)
+
+
+class CardPlatform(LinuxPlatform):
+    """The Linux platform flashing image files in place of cards"""
+
+    def __init__(self, cards: list[Path]):
+        super().__init__()
+        self.cards = cards
+        self.boot_files: dict[str, dict[str, str]] = {}
+        self.ejected: list[str] = []
+
+    def list_external_devices(self) -> list[ExternalDevice]:
+        return [make_device(str(card)) for card in self.cards]
+
+    def unmount_device(self, device_id: str) -> None:
+        pass
+
+    def write_boot_files(self, device_id: str, files: dict[str, str]) -> None:
+        self.boot_files[device_id] = files
+
+    def unmount_and_eject(self, device_id: str) -> None:
+        self.ejected.append(device_id)
+
+
+@pytest.fixture
+def platform(monkeypatch) -> FakePlatform:
+    fake = FakePlatform()
+    monkeypatch.setattr(flash, "get_platform_handler", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def assignments():
+    return [
+        (make_pi(f"pi-{i}"), make_device(f"/dev/sd{letter}"))
+        for i, letter in enumerate("bcd")
+    ]
+
+
+@pytest.fixture
+def cards(tmp_path: Path, monkeypatch) -> CardPlatform:
+    """Three cards for _flash_while_downloading, all selected and confirmed"""
+    platform = CardPlatform([tmp_path / f"card{i}.img" for i in range(3)])
+    for card in platform.cards:
+        card.touch()
+    devices = platform.list_external_devices()
+
+    monkeypatch.setattr(flash, "get_platform_handler", lambda: platform)
+    monkeypatch.setattr(flasher, "get_platform_handler", lambda: platform)
+    monkeypatch.setattr(flash, "list_devices", lambda: devices)
+    monkeypatch.setattr(flash, "prompt_for_devices", lambda *_, **__: devices)
+    monkeypatch.setattr(
+        linux.inquirer,
+        "confirm",
+        lambda **_: SimpleNamespace(execute=lambda: True),
+    )
+    return platform
+
+
+def _flash_while_downloading(image: RaspberryPiImage) -> None:
+    pis = [make_pi(f"pi-{i}") for i in range(3)]
+    flash._flash_while_downloading(image, pis, all_pis=True, verify=True)
+
+
+def _assert_nothing_kept(platform: CardPlatform, image: RaspberryPiImage):
+    assert not platform.boot_files
+    assert not platform.ejected
+    assert cache.lookup(image.extract_sha256) is None
+    assert not list(cache.IMAGES_DIR.glob("*.part"))
+
+
+def test_pipeline_flashes_and_caches(
+    cards: CardPlatform, remote_image: RaspberryPiImage, image: Path, cache_dir
+):
+    _flash_while_downloading(remote_image)
+
+    for card in cards.cards:
+        assert card.read_bytes() == image.read_bytes()
+    assert cards.ejected == [str(card) for card in cards.cards]
+    assert set(cards.boot_files) == set(cards.ejected)
+
+    entry = cache.lookup(remote_image.extract_sha256)
+    assert entry is not None and entry.verified
+    assert lzma.decompress(entry.path.read_bytes()) == image.read_bytes()
+
+
+def test_pipeline_hash_mismatch_keeps_nothing(
+    cards: CardPlatform, remote_image: RaspberryPiImage, cache_dir
+):
+    bad_image = dataclasses.replace(remote_image, extract_sha256="0" * 64)
+
+    with pytest.raises(ImageHashError, match="card0.img"):
+        _flash_while_downloading(bad_image)
+
+    _assert_nothing_kept(cards, bad_image)
+
+
+def test_pipeline_truncated_download_keeps_nothing(
+    cards: CardPlatform, remote_image: RaspberryPiImage, http_server, cache_dir
+):
+    root, _ = http_server
+    compressed = root / "pi.img.xz"
+    compressed.write_bytes(compressed.read_bytes()[:-4096])
+
+    with pytest.raises(ValueError, match="Truncated download"):
+        _flash_while_downloading(remote_image)
+
+    _assert_nothing_kept(cards, remote_image)
+
+
+def test_pipeline_missing_image_keeps_nothing(
+    cards: CardPlatform, remote_image: RaspberryPiImage, cache_dir
+):
+    missing = dataclasses.replace(remote_image, url=remote_image.url + ".missing.xz")
+
+    with pytest.raises(requests.HTTPError, match="404"):
+        _flash_while_downloading(missing)
+
+    _assert_nothing_kept(cards, missing)
+    for card in cards.cards:
+        assert card.stat().st_size == 0
+
+
+def test_failed_card_doesnt_stop_the_others(platform, assignments):
+    def flash_some() -> bool:
+        raise TargetsFailedError({"/dev/sdc": "No space left on device"})
+
+    failures = flash._flash_cards(flash_some)
+
+    with pytest.raises(TargetsFailedError, match="/dev/sdc"):
+        flash._finish_cards(assignments, failures)
+
+    assert set(platform.boot_files) == {"/dev/sdb", "/dev/sdd"}
+    assert platform.ejected == ["/dev/sdb", "/dev/sdd"]
+
+
+def test_cancelled_flash_touches_no_card(platform):
+    assert flash._flash_cards(lambda: False) is None
+    assert not platform.boot_files
+
+
+def test_all_cards_finished(platform, assignments):
+    flash._finish_cards(assignments, flash._flash_cards(lambda: True))
+
+    assert platform.ejected == ["/dev/sdb", "/dev/sdc", "/dev/sdd"]
+
+
+@pytest.fixture
+def declined(platform, monkeypatch) -> list[Path]:
+    """Every erase prompt is declined, returns the images offered"""
+    offered: list[Path] = []
+
+    def flash_device(image_path: Path, device: ExternalDevice, **_) -> bool:
+        offered.append(image_path)
+        return False
+
+    monkeypatch.setattr(flash, "flash_device", flash_device)
+    monkeypatch.setattr(flash, "bake_variant", lambda path, sha256, pi: path)
+    monkeypatch.setattr(flash, "list_devices", lambda: [])
+    return offered
+
+
+@pytest.mark.parametrize("bake", [False, True])
+def test_declined_flash_leaves_the_card_alone(
+    declined, platform, monkeypatch, tmp_path: Path, bake: bool
+):
+    image = RaspberryPiImage(
+        name="Test OS",
+        description="",
+        icon="",
+        url="",
+        extract_size=0,
+        extract_sha256="ab" * 32,
+        image_download_size=0,
+        release_date="2025-12-12",
+        init_format="cloudinit",
+        devices=[],
+        capabilities=[],
+    )
+    monkeypatch.setattr(
+        flash, "load_config", lambda: SimpleNamespace(raspberry_pis=[make_pi("pi-0")])
+    )
+    monkeypatch.setattr(flash, "_select_image", lambda offline: image)
+    monkeypatch.setattr(flash, "download_image", lambda *_, **__: tmp_path / "pi.img")
+    monkeypatch.setattr(flash, "prompt_for_device", lambda _: make_device("/dev/sdb"))
+
+    flash.flash(
+        clear_cache=False,
+        stream=False,
+        connections=1,
+        bmap=False,
+        verify=False,
+        offline=False,
+        all_pis=False,
+        bake=bake,
+        compressed=False,
+        pipeline=False,
+        fsync="end",
+    )
+
+    assert len(declined) == 1
+    assert not platform.boot_files
+    assert not platform.ejected
+
+
+def test_declined_baked_card_stops_the_rest(declined, platform, monkeypatch):
+    devices = [make_device("/dev/sdb"), make_device("/dev/sdc")]
+    monkeypatch.setattr(flash, "prompt_for_devices", lambda *_, **__: devices)
+
+    flash._flash_all(
+        Path("pi.img"), [make_pi("pi-0"), make_pi("pi-1")], base_sha256="ab" * 32
+    )
+
+    assert len(declined) == 1
+    assert not platform.ejected
@@ -0,0 +1,200 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from src.config import loader
+from src.config.passwd import (
+    SALT_LENGTH,
+    hash_passwords_batch,
+    sha512_crypt,
+)
+
+# (password, salt, rounds, expected) from the SHA-crypt specification
+# https://www.akkadia.org/drepper/SHA-crypt.txt
+DREPPER_VECTORS = [
+    (
+        "Hello world!",
+        "saltstring",
+        5000,
+        "$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJu"
+        "esI68u4OTLiBFdcbYEdFCoEOfaS35inz1",
+    ),
+    (
+        "Hello world!",
+        "saltstringsaltstring",
+        10000,
+        "$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHb"
+        "bMCVNSnCM/UrjmM0Dp8vOuZeHBy/YTBmSK6H9qs/y3RnOaw5v.",
+    ),
+    (
+        # The specification spells out rounds=5000 because its input did,
+        # given as a number the default isn't written, as crypt(3) does
+        "This is just a test",
+        "toolongsaltstring",
+        5000,
+        "$6$toolongsaltstrin$lQ8jolhgVRVhY4b5pZKaysCLi0QBxGoNeKQzQ3glMhwllF7o"
+        "GDZxUhx1yxdYcz/e1JSbq3y6JMxxl8audkUEm0",
+    ),
+    (
+        "a very much longer text to encrypt.  This one even stretches over more"
+        "than one line.",
+        "anotherlongsaltstring",
+        1400,
+        "$6$rounds=1400$anotherlongsalts$POfYwTEok97VWcjxIiSOjiykti.o/pQs.wPvM"
+        "xQ6Fm7I6IoYN3CmLs66x9t0oSwbtEW7o7UmJEiDwGqd8p4ur1",
+    ),
+    (
+        "we have a short salt string but not a short password",
+        "short",
+        77777,
+        "$6$rounds=77777$short$WuQyW2YR.hBNpjjRhpYD/ifIw05xdfeEyQoMxIXbkvr0gge"
+        "1a1x3yRULJ5CCaUeOxFmtlcGZelFl5CxtgfiAc0",
+    ),
+    (
+        "a short string",
+        "asaltof16chars..",
+        123456,
+        "$6$rounds=123456$asaltof16chars..$BtCwjqMJGx5hrJhZywWvt0RLE8uZ4oPwcel"
+        "Cjmw2kSYu.Ec6ycULevoBK25fs2xXgMNrCzIMVcgEJAstJeonj1",
+    ),
+    (
+        # Too few rounds are raised to the minimum
+        "the minimum number is still observed",
+        "roundstoolow",
+        10,
+        "$6$rounds=1000$roundstoolow$kUMsbe306n21p9R.FRkW3IGn.S9NPN0x50YhH1xh"
+        "LsPuWGsUSklZt58jaTfF4ZEQpyUNGc0dqbpBYYBaHHrsX.",
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    ("password", "salt", "rounds", "expected"),
+    DREPPER_VECTORS,
+    ids=[f"rounds={vector[2]}" for vector in DREPPER_VECTORS],
+)
+def test_sha512_crypt_matches_the_specification(
+    password: str, salt: str, rounds: int, expected: str
+):
+    assert sha512_crypt(password, salt, rounds=rounds) == expected
+
+
+def test_salt_is_capped_at_16_characters():
+    capped = sha512_crypt("secret", "0123456789abcdefXYZ")
+
+    assert capped == sha512_crypt("secret", "0123456789abcdef")
+    assert capped.split("$")[2] == "0123456789abcdef"
+
+
+def test_random_salts_differ():
+    first, second = sha512_crypt("secret"), sha512_crypt("secret")
+
+    assert first != second
+    assert len(first.split("$")[2]) == SALT_LENGTH
+
+
+CONFIG = """\
+# Fleet of the lab, keep in sync with the wiki
+defaults:
+  wifi: {ssid: lab, password: "wifi pass", country_code: DE}
+  user:
+    name: pi
+    password: "$6$old$hash"  # replaced by pitool passwd --batch
+    ssh_public_key: ssh-ed25519 AAAA lab
+  timezone: Europe/Berlin
+  locale: en_US.UTF-8
+
+raspberry_pis:
+  # The one by the door
+  - name: door
+    hostname: door
+    user:
+      name: admin
+      password: '$6$old$door'  # rotated yearly
+      ssh_public_key: ssh-ed25519 AAAA door
+  - name: shelf  # inherits the default user
+    hostname: shelf
+  - {name: flow, hostname: flow, user: {name: pi, ssh_public_key: ssh-ed25519 B}}
+"""
+
+
+@pytest.fixture
+def fleet(tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setattr(loader, "CONFIG_CACHE_DIR", tmp_path / "config-cache")
+    path = tmp_path / "pitool.yml"
+    path.write_text(CONFIG)
+    return path
+
+
+def _passwords(tmp_path: Path, lines: str) -> str:
+    source = tmp_path / "passwords.txt"
+    source.write_text(lines)
+    return str(source)
+
+
+def test_batch_keeps_comments_and_formatting(fleet: Path, tmp_path: Path):
+    updated = hash_passwords_batch(
+        _passwords(tmp_path, "door:front\npi:shared\n"), fleet, rounds=1000
+    )
+
+    assert sorted(updated) == ["door", "flow", "shelf"]
+    text = fleet.read_text()
+    assert (fleet.parent / "pitool.yml.bak").read_text() == CONFIG
+    for comment in (
+        "# Fleet of the lab, keep in sync with the wiki",
+        '"$6$old$hash"  # replaced by pitool passwd --batch',
+        "# The one by the door",
+        "  # rotated yearly",
+        "    name: shelf  # inherits the default user",
+    ):
+        assert comment in text
+
+    # Only the password lines changed or were added
+    old_lines, new_lines = CONFIG.splitlines(), text.splitlines()
+    assert set(old_lines) - set(new_lines) == {
+        "      password: '$6$old$door'  # rotated yearly",
+        "  - name: shelf  # inherits the default user",
+        "  - {name: flow, hostname: flow, user: {name: pi, ssh_public_key: "
+        "ssh-ed25519 B}}",
+    }
+
+    config, _ = loader.parse_config(fleet)
+    users = {pi.name: pi.user for pi in config.raspberry_pis}
+    assert sha512_crypt("front", users["door"].password.split("$")[3], 1000) == (
+        users["door"].password
+    )
+    for name in ("shelf", "flow"):
+        salt = users[name].password.split("$")[3]
+        assert sha512_crypt("shared", salt, 1000) == users[name].password
+    # The shelf's user still inherits its other fields
+    assert users["shelf"].name == "pi"
+    assert users["shelf"].ssh_public_key == "ssh-ed25519 AAAA lab"
+    assert users["door"].name == "admin"
+
+
+def test_batch_writes_to_included_files(fleet: Path, tmp_path: Path):
+    included = tmp_path / "lab.yml"
+    included.write_text(
+        "# Included fleet\nraspberry_pis:\n  - name: attic\n    hostname: attic\n"
+    )
+    fleet.write_text("include: lab.yml\n" + CONFIG)
+
+    hash_passwords_batch(_passwords(tmp_path, "attic:up\n"), fleet, rounds=1000)
+
+    assert fleet.read_text() == "include: lab.yml\n" + CONFIG
+    text = included.read_text()
+    assert text.startswith("# Included fleet\nraspberry_pis:\n  - user:\n")
+    assert yaml.safe_load(text)["raspberry_pis"][0]["hostname"] == "attic"
+
+
+def test_aliased_user_is_refused(fleet: Path, tmp_path: Path):
+    fleet.write_text(
+        CONFIG.replace("  user:\n    name: pi", "  user: &default\n    name: pi")
+        + "  - {name: alias, hostname: alias, user: *default}\n"
+    )
+    before = fleet.read_text()
+
+    with pytest.raises(ValueError, match=r"raspberry_pis\[3\].user is an alias"):
+        hash_passwords_batch(_passwords(tmp_path, "alias:x\n"), fleet, rounds=1000)
+    assert fleet.read_text() == before
@@ -0,0 +1,21 @@
+import io
+import json
+
+from src.progress import Tracker
+
+
+def test_json_events_carry_stage_and_target():
+    stream = io.StringIO()
+
+    with Tracker(mode="json", stream=stream) as progress:
+        task = progress.add_task(
+            "[cyan]Flashing /dev/sdb", total=10, stage="flash", target="/dev/sdb"
+        )
+        task.advance(10)
+
+    (event,) = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert event["event"] == "done"
+    assert event["stage"] == "flash"
+    assert event["target"] == "/dev/sdb"
+    assert event["description"] == "Flashing /dev/sdb"
+    assert event["bytes"] == event["total"] == 10
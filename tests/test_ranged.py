@@ -0,0 +1,237 @@
+import hashlib
+import socket
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+
+import pytest
+import requests
+
+from src.imaging import ranged
+from src.imaging.ranged import ResumeJournal, download_ranged
+from tests.servers import range_handler, serve
+
+MB = 1024 * 1024
+
+
+class Recorder:
+    """Handler factory logging every GET and failing on demand"""
+
+    def __init__(self, root: Path, weak_etag: bool = False):
+        self.gets: list[tuple[int, str | None]] = []  # (range start, If-Range)
+        self.abort_at: int | None = None  # segment start cut off halfway
+        self.on_get = None
+
+        recorder = self
+
+        class Handler(range_handler(root, weak_etag)):
+            def do_GET(self) -> None:  # noqa: N802
+                start = int(self.headers["Range"][6:].split("-")[0])
+                recorder.gets.append((start, self.headers.get("If-Range")))
+                if recorder.on_get:
+                    recorder.on_get(len(recorder.gets))
+                super().do_GET()
+
+            def send_body(self, path: Path, start: int, end: int) -> None:
+                if start != recorder.abort_at:
+                    return super().send_body(path, start, end)
+                # Drop the connection halfway through the segment
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    self.wfile.write(f.read((end - start) // 2))
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+
+        self.handler = Handler
+
+    @property
+    def starts(self) -> list[int]:
+        return [start for start, _ in self.gets]
+
+
+@pytest.fixture
+def served(tmp_path: Path, image: Path):
+    """The image served with a Recorder, yields (url, recorder)"""
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / image.name).write_bytes(image.read_bytes())
+    recorder = Recorder(root)
+    with serve(recorder.handler) as base_url:
+        yield f"{base_url}/{image.name}", recorder
+
+
+@pytest.fixture
+def redirector(http_server):
+    """A server that redirects every request to http_server, yields (url, hits)"""
+    _, base_url = http_server
+    hits: list[str] = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def _redirect(self) -> None:
+            hits.append(self.command)
+            self.send_response(302)
+            self.send_header("Location", base_url + self.path)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_HEAD = do_GET = _redirect  # noqa: N815
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    with serve(Handler) as url:
+        yield url, hits
+
+
+def _download(url: str, destination: Path, totals: list | None = None) -> Path:
+    return download_ranged(
+        url,
+        destination,
+        segment_size=MB,
+        on_total=(lambda *total: totals.append(total)) if totals is not None else None,
+    )
+
+
+def test_download_ranged(http_server, image: Path, tmp_path: Path):
+    root, base_url = http_server
+    (root / image.name).write_bytes(image.read_bytes())
+    destination = tmp_path / "out.img"
+
+    _download(f"{base_url}/{image.name}", destination)
+
+    assert destination.read_bytes() == image.read_bytes()
+    assert not destination.with_name("out.img.part.json").exists()
+
+
+def test_segments_come_from_the_redirect_target(
+    http_server, redirector, image: Path, tmp_path: Path
+):
+    root, _ = http_server
+    (root / image.name).write_bytes(image.read_bytes())
+    url, hits = redirector
+    destination = tmp_path / "out.img"
+
+    _download(f"{url}/{image.name}", destination)
+
+    assert destination.read_bytes() == image.read_bytes()
+    assert hits == ["HEAD"]
+
+
+def test_interrupted_download_resumes_missing_segments(
+    served, image: Path, tmp_path: Path
+):
+    url, recorder = served
+    destination = tmp_path / "out.img"
+    recorder.abort_at = 5 * MB
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        _download(url, destination)
+
+    journal = ResumeJournal.load(tmp_path / "out.img.part.json")
+    assert journal is not None and journal.done
+    assert 5 not in journal.done
+
+    recorder.abort_at = None
+    recorder.gets.clear()
+    totals = []
+    _download(url, destination, totals)
+
+    segments = set(range(-(-image.stat().st_size // MB)))
+    assert sorted(recorder.starts) == [
+        i * MB for i in sorted(segments - set(journal.done))
+    ]
+    assert totals == [(image.stat().st_size, len(journal.done) * MB)]
+    digest = hashlib.sha256(destination.read_bytes()).hexdigest()
+    assert digest == hashlib.sha256(image.read_bytes()).hexdigest()
+    assert not (tmp_path / "out.img.part").exists()
+    assert not (tmp_path / "out.img.part.json").exists()
+
+
+def test_changed_file_restarts_the_download(served, image: Path, tmp_path: Path):
+    url, recorder = served
+    destination = tmp_path / "out.img"
+    recorder.abort_at = 5 * MB
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        _download(url, destination)
+
+    # A new release under the same URL, same size but a new ETag
+    updated = bytearray(image.read_bytes())
+    updated[:4] = b"\x01\x02\x03\x04"
+    (tmp_path / "www" / image.name).write_bytes(updated)
+    recorder.abort_at = None
+    recorder.gets.clear()
+
+    _download(url, destination)
+
+    assert sorted(recorder.starts) == [i * MB for i in range(len(updated) // MB + 1)]
+    assert destination.read_bytes() == updated
+
+
+def test_file_changing_mid_download_is_detected(served, image: Path, tmp_path: Path):
+    url, recorder = served
+    destination = tmp_path / "out.img"
+    served_path = tmp_path / "www" / image.name
+
+    def replace_after_first(count: int) -> None:
+        if count == 1:
+            served_path.write_bytes(served_path.read_bytes()[::-1])
+
+    recorder.on_get = replace_after_first
+
+    # The first segment's If-Range no longer matches, the server sends it all
+    with pytest.raises(RuntimeError, match="changed on the server"):
+        _download(url, destination)
+    assert all(if_range is not None for _, if_range in recorder.gets)
+
+    recorder.on_get = None
+    _download(url, destination)
+    assert destination.read_bytes() == served_path.read_bytes()
+
+
+def test_weak_etags_arent_sent_as_if_range(tmp_path: Path, image: Path):
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / image.name).write_bytes(image.read_bytes())
+    recorder = Recorder(root, weak_etag=True)
+    destination = tmp_path / "out.img"
+
+    with serve(recorder.handler) as base_url:
+        _download(f"{base_url}/{image.name}", destination)
+
+    assert recorder.gets and all(if_range is None for _, if_range in recorder.gets)
+    assert destination.read_bytes() == image.read_bytes()
+
+
+def test_server_ignoring_ranges_fails(tmp_path: Path, image: Path):
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / image.name).write_bytes(image.read_bytes())
+
+    class Handler(range_handler(root)):
+        def do_GET(self) -> None:  # noqa: N802
+            del self.headers["Range"]
+            super().do_GET()
+
+    with (
+        serve(Handler) as base_url,
+        pytest.raises(RuntimeError, match="ignored Range request"),
+    ):
+        _download(f"{base_url}/{image.name}", tmp_path / "out.img")
+
+
+def test_stalled_segment_times_out(tmp_path: Path, image: Path, monkeypatch):
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / image.name).write_bytes(image.read_bytes())
+    monkeypatch.setattr(ranged, "STREAM_TIMEOUT", (1, 0.2))
+
+    class Handler(range_handler(root)):
+        def send_body(self, path: Path, start: int, end: int) -> None:
+            time.sleep(1)
+
+    with (
+        serve(Handler) as base_url,
+        pytest.raises(requests.ConnectionError, match="timed out"),
+    ):
+        _download(f"{base_url}/{image.name}", tmp_path / "out.img")
@@ -0,0 +1,87 @@
+import asyncio
+import socket
+from pathlib import Path
+
+import pytest
+
+from src.networking.readiness import HostStatus, watch_hosts
+from src.networking.resolver import StaticResolver
+
+# Every Pi gets its own loopback address, all probed on the same port
+ADDRESSES = {"pi-0": "127.0.0.2", "pi-1": "127.0.0.3", "pi-2": "127.0.0.4"}
+
+
+@pytest.fixture
+def resolver(tmp_path: Path) -> StaticResolver:
+    hosts = tmp_path / "hosts"
+    hosts.write_text("".join(f"{a} {h}\n" for h, a in ADDRESSES.items()))
+    return StaticResolver(hosts)
+
+
+class Listeners:
+    """TCP listeners standing in for the SSH servers of booted Pis"""
+
+    def __init__(self):
+        # Holding the port on an address no Pi uses keeps it free for all
+        self.sockets = [socket.create_server(("127.0.0.1", 0))]
+        self.port = self.sockets[0].getsockname()[1]
+
+    def start(self, host: str) -> None:
+        # The kernel completes the handshake, nothing needs to accept
+        self.sockets.append(socket.create_server((ADDRESSES[host], self.port)))
+
+    def close(self) -> None:
+        for sock in self.sockets:
+            sock.close()
+
+
+@pytest.fixture
+def listeners():
+    listeners = Listeners()
+    yield listeners
+    listeners.close()
+
+
+def _watch(hosts: list[str], port: int, resolver, timeout: float, on_start=None):
+    async def collect() -> list[HostStatus]:
+        if on_start:
+            on_start(asyncio.get_running_loop())
+        return [
+            status
+            async for status in watch_hosts(
+                hosts,
+                port=port,
+                timeout=timeout,
+                connect_timeout=0.2,
+                initial_delay=0.05,
+                max_delay=0.1,
+                resolver=resolver,
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_listening_host_is_online_and_silent_one_times_out(listeners, resolver):
+    listeners.start("pi-0")
+
+    results = _watch(["pi-1", "pi-0"], listeners.port, resolver, timeout=0.5)
+
+    assert [(r.host, r.online) for r in results] == [("pi-0", True), ("pi-1", False)]
+    assert results[0].address == "127.0.0.2" and results[0].attempts == 1
+    assert results[1].attempts > 1 and results[1].elapsed >= 0.5
+
+
+def test_host_coming_up_later_is_reported_once_it_listens(listeners, resolver):
+    listeners.start("pi-0")
+
+    results = _watch(
+        ["pi-1", "pi-0"],
+        listeners.port,
+        resolver,
+        timeout=5,
+        on_start=lambda loop: loop.call_later(0.3, listeners.start, "pi-1"),
+    )
+
+    assert [(r.host, r.online) for r in results] == [("pi-0", True), ("pi-1", True)]
+    assert results[1].attempts > 1 and results[1].elapsed >= 0.3
@@ -0,0 +1,148 @@
+import asyncio
+import socket
+import struct
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from src.networking.resolver import (
+    CachingResolver,
+    MdnsResolver,
+    StaticResolver,
+    local_name,
+)
+
+TTL = 120
+
+
+class Responder:
+    """An mDNS responder on loopback answering A queries for known names"""
+
+    def __init__(self, records: dict[str, str], drop: int = 0):
+        self.records = records
+        self.drop = drop
+        self.queries: list[str] = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.05)
+        self.address = self.sock.getsockname()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self) -> None:
+        while not self._stop.is_set():
+            try:
+                query, sender = self.sock.recvfrom(512)
+            except TimeoutError:
+                continue
+
+            labels, offset = [], 12
+            while length := query[offset]:
+                labels.append(query[offset + 1 : offset + 1 + length].decode())
+                offset += 1 + length
+            name = ".".join(labels)
+            self.queries.append(name)
+
+            if len(self.queries) <= self.drop or name not in self.records:
+                continue
+
+            # Echo the question and point the answer's name back at it
+            question = query[12 : offset + 5]
+            answer = struct.pack(
+                "!HHHIH4s",
+                0xC00C,
+                1,
+                0x8001,
+                TTL,
+                4,
+                socket.inet_aton(self.records[name]),
+            )
+            header = struct.pack("!HHHHHH", 0, 0x8400, 1, 1, 0, 0)
+            self.sock.sendto(header + question + answer, sender)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.sock.close()
+
+
+@pytest.fixture
+def responder():
+    responder = Responder({"pi-0.local": "10.0.0.5"})
+    yield responder
+    responder.close()
+
+
+def _mdns(responder: Responder) -> MdnsResolver:
+    return MdnsResolver(server=responder.address, timeout=1.0, retry_interval=0.2)
+
+
+def test_mdns_query_is_answered(responder: Responder):
+    result = asyncio.run(_mdns(responder).resolve("pi-0"))
+
+    assert result is not None and result.address == "10.0.0.5"
+    assert result.expires == pytest.approx(time.time() + TTL, abs=5)
+    assert responder.queries == ["pi-0.local"]
+
+
+def test_unanswered_query_is_sent_again():
+    responder = Responder({"pi-0.local": "10.0.0.5"}, drop=1)
+    try:
+        result = asyncio.run(_mdns(responder).resolve("pi-0"))
+    finally:
+        responder.close()
+
+    assert result is not None and result.address == "10.0.0.5"
+    assert len(responder.queries) == 2
+
+
+def test_unknown_host_resolves_to_nothing(responder: Responder):
+    start = time.monotonic()
+
+    assert asyncio.run(_mdns(responder).resolve("pi-9")) is None
+    assert time.monotonic() - start == pytest.approx(1.0, abs=0.5)
+
+
+def test_answers_are_cached_across_commands(responder: Responder, tmp_path: Path):
+    cache_path = tmp_path / "hosts.json"
+    first = CachingResolver([_mdns(responder)], cache_path=cache_path)
+    asyncio.run(first.resolve("pi-0"))
+
+    # A later command loads the answer instead of asking again
+    second = CachingResolver([_mdns(responder)], cache_path=cache_path)
+    result = asyncio.run(second.resolve("pi-0.local"))
+
+    assert result is not None and result.address == "10.0.0.5"
+    assert len(responder.queries) == 1
+
+    second.forget("pi-0")
+    asyncio.run(
+        CachingResolver([_mdns(responder)], cache_path=cache_path).resolve("pi-0")
+    )
+    assert len(responder.queries) == 2
+
+
+def test_failures_arent_cached(responder: Responder, tmp_path: Path):
+    resolver = CachingResolver([_mdns(responder)], cache_path=tmp_path / "hosts.json")
+
+    assert asyncio.run(resolver.resolve("pi-9")) is None
+    responder.records[local_name("pi-9")] = "10.0.0.9"
+
+    result = asyncio.run(resolver.resolve("pi-9"))
+    assert result is not None and result.address == "10.0.0.9"
+
+
+def test_overrides_win_over_mdns(responder: Responder, tmp_path: Path):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("192.168.1.20 pi-0  # pinned\n")
+    resolver = CachingResolver(
+        [_mdns(responder)], overrides=StaticResolver(hosts), cache_path=None
+    )
+
+    result = asyncio.run(resolver.resolve("pi-0"))
+
+    assert result is not None and result.address == "192.168.1.20"
+    assert responder.queries == []
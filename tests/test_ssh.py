@@ -0,0 +1,178 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+from src.networking import ssh
+from src.networking.resolver import StaticResolver
+from src.networking.ssh import SSH_ERROR, run_fleet
+from tests.factories import make_pi
+
+ADDRESSES = {"pi-0": "10.0.0.10", "pi-1": "10.0.0.11", "pi-2": "10.0.0.12"}
+
+# Stands in for ssh: logs its arguments, refuses the addresses listed in
+# FAKE_SSH_DOWN and runs the remote command with the local shell
+FAKE_SSH = f"""#!{sys.executable}
+import json, os, subprocess, sys
+
+args = sys.argv[1:]
+with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+    log.write(json.dumps(args) + "\\n")
+
+destination = next(arg for arg in args if "@" in arg)
+address = destination.split("@", 1)[1]
+if address in os.environ.get("FAKE_SSH_DOWN", "").split():
+    print(f"ssh: connect to host {{address}} port 22: Connection refused",
+          file=sys.stderr)
+    sys.exit(255)
+if "-fN" in args:
+    sys.exit(0)
+sys.exit(subprocess.run(["sh", "-c", args[-1]]).returncode)
+"""
+
+
+class FakeSsh:
+    def __init__(self, log: Path):
+        self.log = log
+
+    def calls(self) -> list[list[str]]:
+        if not self.log.exists():
+            return []
+        return [json.loads(line) for line in self.log.read_text().splitlines()]
+
+
+@pytest.fixture
+def fake_ssh(tmp_path: Path, monkeypatch) -> FakeSsh:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "ssh"
+    script.write_text(FAKE_SSH)
+    script.chmod(0o755)
+
+    log = tmp_path / "ssh.log"
+    monkeypatch.setenv("PATH", f"{bin_dir}:{Path(sys.executable).parent}:/bin")
+    monkeypatch.setenv("FAKE_SSH_LOG", str(log))
+    return FakeSsh(log)
+
+
+@pytest.fixture
+def resolver(tmp_path: Path) -> StaticResolver:
+    hosts = tmp_path / "hosts"
+    hosts.write_text("".join(f"{a} {h}\n" for h, a in ADDRESSES.items()))
+    return StaticResolver(hosts)
+
+
+def _run(hosts: list[str], command: str, resolver):
+    lines: list[tuple[str, str, str]] = []
+    results = asyncio.run(
+        run_fleet(
+            [make_pi(host) for host in hosts],
+            command,
+            lambda pi, stream, line: lines.append((pi.name, stream, line)),
+            resolver=resolver,
+        )
+    )
+    return results, lines
+
+
+def test_output_and_exit_status_per_host(fake_ssh: FakeSsh, resolver):
+    results, lines = _run(["pi-0", "pi-1"], "echo up; echo warn >&2; exit 3", resolver)
+
+    assert [(r.pi.name, r.returncode) for r in results] == [("pi-0", 3), ("pi-1", 3)]
+    for host in ("pi-0", "pi-1"):
+        assert [(s, line) for h, s, line in lines if h == host] in (
+            [("stdout", "up"), ("stderr", "warn")],
+            [("stderr", "warn"), ("stdout", "up")],
+        )
+
+
+def test_connections_share_a_master_and_pin_the_host_key(fake_ssh: FakeSsh, resolver):
+    _run(["pi-0"], "true", resolver)
+
+    master, command = fake_ssh.calls()
+    assert "-fN" in master and master[-1] == "pi@10.0.0.10"
+    assert command[-2:] == ["pi@10.0.0.10", "true"]
+    for call in (master, command):
+        assert "HostKeyAlias=pi-0" in call and "ControlMaster=auto" in call
+        assert "BatchMode=yes" in call
+    paths = {a for call in (master, command) for a in call if "ControlPath=" in a}
+    assert len(paths) == 1
+
+
+def test_unreachable_host_reports_the_ssh_error(
+    fake_ssh: FakeSsh, resolver, monkeypatch
+):
+    monkeypatch.setenv("FAKE_SSH_DOWN", ADDRESSES["pi-1"])
+
+    results, lines = _run(["pi-0", "pi-1"], "echo up", resolver)
+
+    assert [r.returncode for r in results] == [0, SSH_ERROR]
+    assert (
+        "pi-1",
+        "stderr",
+        "ssh: connect to host 10.0.0.11 port 22: Connection refused",
+    ) in lines
+    # The command never runs on a host whose master failed
+    assert [c[-1] for c in fake_ssh.calls() if "-fN" not in c] == ["echo up"]
+
+
+def test_missing_ssh_fails_every_host(tmp_path: Path, resolver, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmp_path))
+
+    results, lines = _run(["pi-0", "pi-1"], "true", resolver)
+
+    assert [r.returncode for r in results] == [SSH_ERROR, SSH_ERROR]
+    assert {host for host, stream, _ in lines if stream == "stderr"} == {
+        "pi-0",
+        "pi-1",
+    }
+
+
+def test_concurrency_limits_hosts_running_at_once(fake_ssh: FakeSsh, resolver):
+    running, peak = 0, 0
+
+    def track(pi, stream, line):
+        nonlocal running, peak
+        running += {"start": 1, "end": -1}[line]
+        peak = max(peak, running)
+
+    asyncio.run(
+        run_fleet(
+            [make_pi(host) for host in ADDRESSES],
+            "echo start; sleep 0.2; echo end",
+            track,
+            concurrency=2,
+            resolver=resolver,
+        )
+    )
+
+    assert peak == 2
+
+
+def test_lines_over_the_stream_limit_come_through(fake_ssh: FakeSsh, resolver):
+    # Well over asyncio's 64 KiB StreamReader limit, on both streams
+    command = (
+        "head -c 200000 /dev/zero | tr '\\0' x; echo; echo done;"
+        "head -c 100000 /dev/zero | tr '\\0' y >&2"
+    )
+
+    results, lines = _run(["pi-0", "pi-1"], command, resolver)
+
+    assert [r.returncode for r in results] == [0, 0]
+    for host in ("pi-0", "pi-1"):
+        assert [(s, line) for h, s, line in lines if h == host and s == "stdout"] == [
+            ("stdout", "x" * 200000),
+            ("stdout", "done"),
+        ]
+        assert (host, "stderr", "y" * 100000) in lines
+
+
+def test_endless_lines_are_split(fake_ssh: FakeSsh, resolver, monkeypatch):
+    monkeypatch.setattr(ssh, "LINE_LIMIT", 150000)
+
+    results, lines = _run(["pi-0"], "head -c 400000 /dev/zero | tr '\\0' x", resolver)
+
+    assert results[0].returncode == 0
+    assert [len(line) for _, _, line in lines] == [150000, 150000, 100000]
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from src import utils
+from src.imaging.treehash import NODE_PREFIX, TreeHash, merkle_root, tree_hash
+from src.imaging.verify import chunk_digest, verify_target
+from src.utils import calculate_hash, calculate_hash_memoized, hash_memo_path
+
+CHUNK = 64 * 1024
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 7 * CHUNK + 12345])
+def test_tree_hash_matches_hashlib(tmp_path: Path, size: int):
+    data = os.urandom(size)
+    path = tmp_path / "pi.img"
+    path.write_bytes(data)
+
+    # Buffers of three chunks, so reads end mid-buffer as well
+    tree = tree_hash(path, chunk_size=CHUNK, buffer_size=3 * CHUNK, workers=3)
+
+    assert tree.sha256 == hashlib.sha256(data).hexdigest()
+    assert tree.size == size
+    assert tree.chunks == [
+        chunk_digest(offset, data[offset : offset + CHUNK])
+        for offset in range(0, size, CHUNK)
+    ]
+    assert calculate_hash(str(path), chunk_size=CHUNK) == tree.sha256
+
+
+def test_tree_hash_stops_at_size(tmp_path: Path):
+    data = os.urandom(5 * CHUNK)
+    path = tmp_path / "card.img"
+    path.write_bytes(data)
+
+    tree = tree_hash(path, size=2 * CHUNK + 10, chunk_size=CHUNK)
+
+    assert tree.sha256 == hashlib.sha256(data[: 2 * CHUNK + 10]).hexdigest()
+    assert [chunk.length for chunk in tree.chunks] == [CHUNK, CHUNK, 10]
+
+
+def test_merkle_root():
+    a, b, c = (hashlib.sha256(bytes([i])).digest() for i in range(3))
+
+    def node(left: bytes, right: bytes) -> bytes:
+        return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+    assert merkle_root([]) == hashlib.sha256().digest()
+    assert merkle_root([a]) == a
+    assert merkle_root([a, b]) == node(a, b)
+    # The odd digest is carried up a level unchanged
+    assert merkle_root([a, b, c]) == node(node(a, b), c)
+    assert merkle_root([b, a]) != merkle_root([a, b])
+
+
+def test_tree_survives_its_sidecar_format(tmp_path: Path):
+    path = tmp_path / "pi.img"
+    path.write_bytes(os.urandom(3 * CHUNK + 7))
+    tree = tree_hash(path, chunk_size=CHUNK)
+
+    restored = TreeHash.from_dict(json.loads(json.dumps(tree.to_dict())))
+
+    assert restored == tree
+    assert restored.root == tree.root
+
+
+def test_chunk_verification_catches_a_flipped_byte(tmp_path: Path):
+    path = tmp_path / "pi.img"
+    path.write_bytes(os.urandom(4 * CHUNK + 99))
+    original = tmp_path / "original.img"
+    original.write_bytes(path.read_bytes())
+    tree = tree_hash(path, chunk_size=CHUNK)
+
+    flipped = 2 * CHUNK + 4321
+    with open(path, "r+b") as f:
+        f.seek(flipped)
+        byte = f.read(1)[0]
+        f.seek(flipped)
+        f.write(bytes([byte ^ 0x01]))
+
+    assert verify_target(str(original), tree.chunks) is None
+    assert verify_target(str(path), tree.chunks) == 2 * CHUNK
+    assert verify_target(str(path), tree.chunks, source=original) == flipped
+
+
+class Hashes:
+    """Counts full hashes taken by calculate_hash_memoized"""
+
+    def __init__(self, monkeypatch):
+        self.count = 0
+        calculate_tree_hash = utils.calculate_tree_hash
+
+        def counting(*args, **kwargs) -> TreeHash:
+            self.count += 1
+            return calculate_tree_hash(*args, **kwargs)
+
+        monkeypatch.setattr(utils, "calculate_tree_hash", counting)
+
+
+@pytest.fixture
+def image_file(tmp_path: Path) -> Path:
+    path = tmp_path / "pi.img"
+    path.write_bytes(os.urandom(3 * CHUNK + 5))
+    return path
+
+
+def _sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def _touch(path: Path) -> None:
+    info = path.stat()
+    os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns + 1_000_000))
+
+
+def test_sidecar_is_reused_while_unchanged(image_file: Path, monkeypatch):
+    hashes = Hashes(monkeypatch)
+
+    first = calculate_hash_memoized(image_file)
+    second = calculate_hash_memoized(image_file)
+
+    assert first == second == _sha256(image_file)
+    assert hashes.count == 1
+    assert json.loads(hash_memo_path(image_file).read_text())["sha256"] == first
+
+
+def test_touched_file_is_checked_by_chunk(image_file: Path, monkeypatch):
+    hashes = Hashes(monkeypatch)
+    sha256 = calculate_hash_memoized(image_file)
+
+    # Same content, new mtime: the chunks match and no full hash is taken
+    _touch(image_file)
+    assert calculate_hash_memoized(image_file) == sha256
+    assert hashes.count == 1
+
+    # ...and the refreshed sidecar is reused as is
+    monkeypatch.setattr(utils, "_unchanged_since", None)
+    assert calculate_hash_memoized(image_file) == sha256
+
+
+def test_changed_content_is_hashed_again(image_file: Path, monkeypatch):
+    hashes = Hashes(monkeypatch)
+    calculate_hash_memoized(image_file)
+
+    data = bytearray(image_file.read_bytes())
+    data[CHUNK + 1] ^= 0xFF
+    image_file.write_bytes(data)
+    _touch(image_file)
+
+    assert calculate_hash_memoized(image_file) == _sha256(image_file)
+    assert hashes.count == 2
+
+
+def test_resized_file_is_hashed_again(image_file: Path, monkeypatch):
+    hashes = Hashes(monkeypatch)
+    calculate_hash_memoized(image_file)
+
+    with open(image_file, "ab") as f:
+        f.write(b"more")
+
+    assert calculate_hash_memoized(image_file) == _sha256(image_file)
+    assert hashes.count == 2
+
+
+def test_replaced_file_with_the_same_mtime_is_checked(
+    image_file: Path, tmp_path: Path, monkeypatch
+):
+    hashes = Hashes(monkeypatch)
+    calculate_hash_memoized(image_file)
+    info = image_file.stat()
+
+    # Same size and mtime, only the inode tells it apart
+    replacement = tmp_path / "replacement.img"
+    replacement.write_bytes(os.urandom(info.st_size))
+    os.utime(replacement, ns=(info.st_atime_ns, info.st_mtime_ns))
+    replacement.replace(image_file)
+
+    assert calculate_hash_memoized(image_file) == _sha256(image_file)
+    assert hashes.count == 2
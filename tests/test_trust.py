@@ -0,0 +1,93 @@
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from src.commands import trust
+from src.networking import certs
+from src.networking.certs import ROOT_CA_PATH
+from src.networking.fetch import FetchResult, store_blob
+from src.networking.readiness import HostStatus
+from src.platform import linux
+from src.platform.linux import LinuxPlatform
+from src.platform.macos import MacOSPlatform
+from tests.factories import make_pi
+
+CERTIFICATE = b"-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n"
+
+
+class StorePlatform(LinuxPlatform):
+    """The Linux platform installing into a CA store directory of its own"""
+
+    def __init__(self, store: Path):
+        super().__init__()
+        self.store = store
+        self.installed: list[str] = []
+
+    def trust_certificate(self, cert_path: str) -> None:
+        shutil.copy(cert_path, self.store / f"pitool-{Path(cert_path).stem}.crt")
+        self.installed.append(cert_path)
+
+
+@pytest.fixture
+def platform(tmp_path: Path, monkeypatch) -> StorePlatform:
+    """Two Pis serving the same root CA to a platform with an empty CA store"""
+    store = tmp_path / "anchors"
+    store.mkdir()
+    platform = StorePlatform(store)
+    pis = [make_pi("pi-0"), make_pi("pi-1")]
+
+    async def fetch_fleet(pis, paths):
+        return [FetchResult(pi, {ROOT_CA_PATH: store_blob(CERTIFICATE)}) for pi in pis]
+
+    monkeypatch.setattr(linux, "CA_CERTIFICATE_DIRS", [(store, ["true"])])
+    monkeypatch.setattr(certs, "TRUSTED_PATH", tmp_path / "trusted.json")
+    monkeypatch.setattr(
+        trust, "load_config", lambda: SimpleNamespace(raspberry_pis=pis)
+    )
+    monkeypatch.setattr(
+        trust, "wait_for_pis", lambda hosts: [HostStatus(h, True, 0, 1) for h in hosts]
+    )
+    monkeypatch.setattr(trust, "fetch_fleet", fetch_fleet)
+    monkeypatch.setattr(trust, "get_platform_handler", lambda: platform)
+    return platform
+
+
+def test_certificate_is_trusted_once(platform: StorePlatform):
+    trust.trust(force=False)
+    trust.trust(force=False)
+
+    assert len(platform.installed) == 1
+    assert platform.is_certificate_trusted(platform.installed[0])
+
+
+def test_certificate_missing_from_the_store_is_trusted_again(platform: StorePlatform):
+    trust.trust(force=False)
+    for path in platform.store.iterdir():
+        path.unlink()
+    assert not platform.is_certificate_trusted(platform.installed[0])
+
+    trust.trust(force=False)
+
+    assert len(platform.installed) == 2
+    assert platform.is_certificate_trusted(platform.installed[0])
+
+
+@pytest.mark.parametrize(("status", "trusted"), [(0, True), (1, False)])
+def test_macos_checks_trust_settings_not_presence(
+    tmp_path: Path, monkeypatch, status: int, trusted: bool
+):
+    # Stands in for security(1): logs its arguments, verify-cert exits with status
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "security.log"
+    script = bin_dir / "security"
+    script.write_text(f'#!/bin/sh\necho "$@" >> {log}\nexit {status}\n')
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:/bin")
+    cert_path = tmp_path / "root-ca.pem"
+    cert_path.write_bytes(CERTIFICATE)
+
+    assert MacOSPlatform().is_certificate_trusted(str(cert_path)) is trusted
+    assert log.read_text().split() == ["verify-cert", "-c", str(cert_path), "-l", "-L"]
@@ -0,0 +1,125 @@
+import os
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from src.imaging import verify
+from src.imaging.verify import (
+    _first_difference,
+    chunk_digest,
+    verify_target,
+    verify_targets,
+)
+
+CHUNK = 64 * 1024
+# An unaligned tail, so the last chunk is short
+SIZE = 5 * CHUNK + 1234
+
+
+@pytest.fixture(params=["o_direct", "buffered"])
+def image(tmp_path: Path, request, monkeypatch) -> Path:
+    """The source image, verified with and without O_DIRECT"""
+    if request.param == "buffered":
+        monkeypatch.setattr(verify, "O_DIRECT", 0)
+    path = tmp_path / "pi.img"
+    path.write_bytes(os.urandom(SIZE))
+    return path
+
+
+def _digests(path: Path) -> list:
+    data = path.read_bytes()
+    return [
+        chunk_digest(offset, data[offset : offset + CHUNK])
+        for offset in range(0, len(data), CHUNK)
+    ]
+
+
+def _copy(image: Path, name: str) -> Path:
+    path = image.with_name(name)
+    path.write_bytes(image.read_bytes())
+    return path
+
+
+def _flip(path: Path, offset: int) -> None:
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)[0]
+        f.seek(offset)
+        f.write(bytes([byte ^ 0x80]))
+
+
+def test_corrupt_byte_near_the_end_is_pinpointed(image: Path):
+    digests = _digests(image)
+    targets = [_copy(image, f"card-{i}.img") for i in range(3)]
+    corrupt = SIZE - 7
+    _flip(targets[1], corrupt)
+    progress = Counter()
+
+    def on_progress(target: str, advance: int) -> None:
+        progress[target] += advance
+
+    results = verify_targets(
+        [str(t) for t in targets], digests, source=image, on_progress=on_progress
+    )
+
+    assert results == {
+        str(targets[0]): None,
+        str(targets[1]): corrupt,
+        str(targets[2]): None,
+    }
+    assert progress == {str(target): SIZE for target in targets}
+
+
+def test_without_source_the_chunk_is_reported(image: Path):
+    target = _copy(image, "card.img")
+    _flip(target, SIZE - 7)
+
+    assert verify_target(str(target), _digests(image)) == 5 * CHUNK
+
+
+def test_first_of_several_mismatches_is_reported(image: Path):
+    digests = _digests(image)
+    target = _copy(image, "card.img")
+    for offset in (4 * CHUNK + 1, 2 * CHUNK + 4097, SIZE - 1):
+        _flip(target, offset)
+
+    assert verify_target(str(target), digests, source=image, workers=2) == (
+        2 * CHUNK + 4097
+    )
+
+
+def test_short_target_fails_where_it_ends(image: Path):
+    digests = _digests(image)
+    target = _copy(image, "card.img")
+    os.truncate(target, SIZE - 100)
+
+    assert verify_target(str(target), digests) == 5 * CHUNK
+    assert verify_target(str(target), digests, source=image) == SIZE - 100
+
+
+def test_longer_target_only_checks_the_image(image: Path):
+    target = _copy(image, "card.img")
+    with open(target, "ab") as f:
+        f.write(os.urandom(CHUNK))
+
+    assert verify_target(str(target), _digests(image), source=image) is None
+
+
+def test_nothing_to_verify():
+    assert verify_target("/nonexistent", []) is None
+    assert verify_targets([], []) == {}
+
+
+def test_first_difference(tmp_path: Path):
+    source = tmp_path / "source"
+    source.write_bytes(b"abcdefgh" * 10)
+    target = tmp_path / "target"
+    target.write_bytes(b"abcdefgh" * 5 + b"abcdeXgh" + b"abcdefgh" * 4)
+
+    assert _first_difference(source, str(target), 0, 80) == 45
+    assert _first_difference(source, str(target), 40, 8) == 45
+    # Identical ranges and truncated targets point past the common bytes
+    assert _first_difference(source, str(target), 48, 32) == 80
+    os.truncate(target, 30)
+    assert _first_difference(source, str(target), 16, 32) == 30
@@ -0,0 +1,104 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from src.imaging.writer import TargetsFailedError, write_images
+from src.paths import ROOT_DIR
+from src.platform.base import run_privileged_writer
+
+# Every write fails with ENOSPC, a card dying halfway through
+FAILING_TARGET = "/dev/full"
+
+
+def _run_helper(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-m", "src.imaging.writer", *args],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_write_images_writes_every_target(image: Path, tmp_path: Path):
+    targets = [str(tmp_path / f"card{i}.img") for i in range(3)]
+
+    written = write_images(image, targets)
+
+    assert written == dict.fromkeys(targets, image.stat().st_size)
+    for target in targets:
+        assert Path(target).read_bytes() == image.read_bytes()
+
+
+def test_longer_file_targets_are_truncated(image: Path, tmp_path: Path):
+    target = tmp_path / "card.img"
+    target.write_bytes(b"\xee" * (image.stat().st_size + 3 * 4096 + 1))
+
+    write_images(image, [str(target)])
+
+    assert target.read_bytes() == image.read_bytes()
+
+
+def test_failing_target_doesnt_stop_the_others(image: Path, tmp_path: Path):
+    good = [str(tmp_path / "card0.img"), str(tmp_path / "card1.img")]
+
+    with pytest.raises(TargetsFailedError) as error:
+        write_images(image, [good[0], FAILING_TARGET, good[1]])
+
+    assert list(error.value.failures) == [FAILING_TARGET]
+    for target in good:
+        assert Path(target).read_bytes() == image.read_bytes()
+
+
+def test_helper_lines_stay_whole_with_many_targets(image: Path, tmp_path: Path):
+    targets = [str(tmp_path / f"card{i}.img") for i in range(4)]
+
+    result = _run_helper(str(image), *targets, "--verify")
+
+    assert result.returncode == 0, result.stderr
+    written = [0] * len(targets)
+    verified = [0] * len(targets)
+    for line in result.stdout.splitlines():
+        match line.split():
+            case [index, advance]:
+                written[int(index)] += int(advance)
+            case [index, "verify", advance]:
+                verified[int(index)] += int(advance)
+            case _:
+                pytest.fail(f"Garbled helper line: {line!r}")
+    size = image.stat().st_size
+    assert written == [size] * len(targets)
+    assert verified == [size] * len(targets)
+
+
+def test_helper_reports_failed_target_and_verifies_the_rest(
+    image: Path, tmp_path: Path
+):
+    good = str(tmp_path / "card.img")
+
+    result = _run_helper(str(image), good, FAILING_TARGET, "--verify")
+
+    assert result.returncode == 1
+    lines = [line.split() for line in result.stdout.splitlines()]
+    assert any(line[:2] == ["1", "failed"] for line in lines)
+    assert any(line[:2] == ["0", "verify"] for line in lines)
+    assert not any(line[:2] == ["1", "verify"] for line in lines)
+    assert Path(good).read_bytes() == image.read_bytes()
+
+
+def test_privileged_writer_names_failed_targets(image: Path, tmp_path: Path, fake_sudo):
+    good = str(tmp_path / "card.img")
+
+    with pytest.raises(TargetsFailedError) as error:
+        run_privileged_writer(
+            "src.imaging.writer",
+            [str(image), good, FAILING_TARGET],
+            total=image.stat().st_size,
+            text="Flashing",
+            labels=["/dev/sdb", "/dev/sdc"],
+            verify=True,
+        )
+
+    assert list(error.value.failures) == ["/dev/sdc"]
+    assert Path(good).read_bytes() == image.read_bytes()